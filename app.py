@@ -1,25 +1,38 @@
+from utils.startup import mark, finish as finish_startup
 import random
 import streamlit as st
-from utils.expert import ExpertAgent, get_responses_async, generate_summary
+from utils.expert import ExpertAgent, build_prompt, get_responses_async, generate_summary
 from utils.quota import (
-    check_quota,
-    use_quota,
     get_quota_display,
-    initialize_quota,
-    MODEL_QUOTAS,
-    calculate_conversation_quota
+    initialize_quota
 )
 from utils.document_loader import load_experts
+from utils.models import DEFAULT_MODEL, get_model_labels
+from utils.router import select_experts
+from utils.jobs import get_job_manager
+from utils.degradation import plan_degradation, wait_for_quota
+from utils.prewarm import prewarmer
+from utils.scheduler import scheduler, session_limits
+from utils.markdown_render import RENDER_FPS, IncrementalMarkdown, render_markdown
+from utils.tracing import span, start_span
+from utils.profiling import DEV_TOOLS, profile_block
 import os
 import asyncio
 import logging
-from utils.dropbox_handler import download_and_extract_dropbox
+from utils.dropbox_handler import BackgroundDownload
+from utils.expert_store import clear_fingerprints
 from datetime import datetime, timedelta
 import time
+import uuid
+
+mark("imports")
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
+JOB_POLL_SECONDS = 1 / RENDER_FPS  # 轮询后台任务进度的间隔（与流式回应的帧率一致）
+DATA_POLL_SECONDS = 0.2  # 等待数据下载时刷新进度条的间隔
+
 # 为每个专家分配一个固定的背景颜色
 EXPERT_COLORS = [
     "#FFE4E1",  # 浅粉红
@@ -169,10 +182,7 @@ st.markdown("""
 
 def add_model_selector():
     """添加模型选择器"""
-    models = {
-        "Grok": "grok-beta",
-        "Gemini": "gemini-1.5-flash"
-    }
+    models = get_model_labels()
 
     # 在右上角添加模型选择器
     with st.sidebar:
@@ -212,6 +222,8 @@ def get_expert_color(expert_name, index):
 def initialize_session_state():
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if "experts" not in st.session_state:
         st.session_state.experts = load_experts()
     if "expert_colors" not in st.session_state:
@@ -223,13 +235,8 @@ def initialize_session_state():
         # 添加总结专家的颜色
         st.session_state.expert_colors["Investment Masters Summary"] = "#f6d365"
     if "current_model" not in st.session_state:
-        st.session_state.current_model = "gemini-2.0-flash-exp"  # 默认使用 Gemini 2.0
-    if "quota_info" not in st.session_state:
-        st.session_state.quota_info = {
-            "gemini-2.0-flash-exp": {"limit": 10, "remaining": 10, "reset_time": None},
-            "grok-beta": {"limit": 60, "remaining": 60, "reset_time": None},
-            "gemini-1.5-flash": {"limit": 10, "remaining": 10, "reset_time": None}
-        }
+        st.session_state.current_model = DEFAULT_MODEL  # 默认使用 Gemini 2.0
+    initialize_quota()
     # 添加总结专家到会话状态
     if "titans" not in st.session_state:
         st.session_state.titans = ExpertAgent(
@@ -239,6 +246,72 @@ def initialize_session_state():
         )
 
 
+def display_routing_controls():
+    """在侧边栏添加专家路由设置"""
+    expert_names = [expert.name for expert in st.session_state.experts]
+    with st.sidebar:
+        st.markdown("### 🧭 专家路由")
+        route_all = st.checkbox("所有专家都回答", value=False, key="route_all")
+        top_k = st.slider(
+            "每个问题最多几位专家",
+            min_value=1,
+            max_value=max(1, len(expert_names)),
+            value=min(3, max(1, len(expert_names))),
+            key="route_top_k",
+            disabled=route_all or len(expert_names) <= 1
+        )
+        forced = st.multiselect(
+            "指定专家（留空则自动选择）",
+            options=expert_names,
+            key="route_forced"
+        )
+    return None if route_all else top_k, forced
+
+
+def render_profile_result(title, result):
+    """显示一次性能分析的热点函数和火焰图文件"""
+    st.markdown(f"**{title}** · {result['wall_ms']:.0f} ms")
+    if result["focus"]:
+        st.caption("关注的函数")
+        st.dataframe(result["focus"], use_container_width=True)
+    st.caption("自身耗时最多的函数")
+    st.dataframe(result["top"], use_container_width=True)
+    with open(result["folded_path"], "rb") as f:
+        st.download_button(
+            "下载火焰图（折叠栈）", f.read(),
+            file_name=os.path.basename(result["folded_path"]),
+            key=f"download_{result['label']}")
+
+
+def display_session_usage():
+    """在侧边栏显示本会话的用量和排队情况"""
+    stats = scheduler.session_stats(st.session_state.session_id)
+    request_limit, token_limit = session_limits(st.session_state.current_model)
+    with st.sidebar:
+        st.markdown("### 📊 我的用量")
+        st.caption(
+            f"最近一分钟: {stats['rpm']} 次请求 / {stats['tpm']:,} tokens"
+            f"（有其他用户时上限 {request_limit} 次 / {token_limit:,} tokens）")
+        st.caption(f"本会话累计: {stats['total_requests']} 次请求 / "
+                   f"{stats['total_tokens']:,} tokens")
+        st.caption(f"进行中 {stats['running']} · 排队中 {stats['queued']} · "
+                   f"平均排队 {stats['avg_wait']:.1f} 秒 · "
+                   f"全部会话占用 {stats['busy_slots']}/{stats['slots']}")
+
+
+def display_dev_tools():
+    """开发者工具（secrets 中 DEV_TOOLS = true 时显示）"""
+    if not DEV_TOOLS:
+        return
+    with st.sidebar:
+        st.markdown("### 🛠 开发者工具")
+        st.checkbox("性能分析（页面运行和专家回应）", key="dev_profile")
+        if "rerun_profile" in st.session_state:
+            render_profile_result("上一次页面运行", st.session_state.rerun_profile)
+        if "job_profile" in st.session_state:
+            render_profile_result("上一次专家回应", st.session_state.job_profile)
+
+
 def display_chat_history():
     for message in st.session_state.messages:
         if message["role"] == "user":
@@ -248,14 +321,10 @@ def display_chat_history():
             expert_color = st.session_state.expert_colors.get(
                 message["role"], "#F0F0F0")
             with st.chat_message(message["role"], avatar=message.get("avatar")):
-                # 清理消息内容中的HTML标签
-                content = message["content"]
-                content = content.replace('</div>', '')
-                content = content.replace('<div>', '')
-                content = content.replace('<code>', '')
-                content = content.replace('</code>', '')
-                content = content.replace('<span>', '')
-                content = content.replace('</span>', '')
+                # 回应完成时渲染好的 HTML 缓存在消息里，重新运行时不再转换
+                if "html" not in message:
+                    message["html"] = render_markdown(message["content"])
+                content = message["html"]
 
                 st.markdown(
                     f"""<div style="background-color: {expert_color};" class="chat-message">
@@ -267,6 +336,138 @@ def display_chat_history():
                 )
 
 
+def render_expert_bubble(placeholder, name, body):
+    """在占位符中渲染专家回应气泡"""
+    expert_color = st.session_state.expert_colors.get(name, "#F0F0F0")
+    placeholder.markdown(
+        f"""<div style="background-color: {expert_color};" class="chat-message">
+            <div class="expert-name">{name}</div>
+            <div class="divider"></div>
+            {body}
+        </div>""",
+        unsafe_allow_html=True
+    )
+
+
+async def stream_response_events(experts, prompt, model_name, summary_agent,
+                                 trace=None, queued=None, session_id=None):
+    """
+    把专家回应转换成聊天消息事件（在后台任务线程中运行）
+
+    queued: 配额降级为排队时的决定，先等到配额够用并预留后再发送
+    """
+    if queued is not None:
+        with span("quota_queue", parent=trace, eta=queued["eta"]):
+            await wait_for_quota(model_name, queued["required_quota"],
+                                 queued["required_tokens"], session_id=session_id)
+    # 流式增量和完成的回应合并到一个队列里按到达顺序产出
+    events = asyncio.Queue()
+
+    def on_delta(expert, delta):
+        events.put_nowait({"role": expert.name, "delta": delta})
+
+    async def produce():
+        try:
+            with span("llm_fanout", parent=trace, experts=len(experts)):
+                async for expert, response in get_responses_async(
+                        experts, prompt, model_name, summary_agent,
+                        on_delta=on_delta, session_id=session_id):
+                    events.put_nowait({
+                        "role": expert.name,
+                        "content": response,
+                        "avatar": expert.avatar
+                    })
+        finally:
+            events.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+        await producer  # 抛出生成过程中的错误
+    finally:
+        producer.cancel()
+
+
+def render_active_job():
+    """显示后台任务的进度，直到任务完成（重新运行后从上次读取的位置继续）"""
+    active = st.session_state.get("active_job")
+    if not active:
+        return
+
+    job = get_job_manager().get(active["id"])
+    if job is None:
+        st.warning("上一次的对话任务已失效，请重新提问")
+        del st.session_state.active_job
+        return
+
+    # 排队中的问题在重新运行后仍然显示预计等待时间
+    if active.get("notice"):
+        st.info(active["notice"])
+
+    # 为还没有回应的专家创建占位符（已回应的已经在聊天记录里）
+    responded = {event["role"] for event in job.events_since(0)[:active["consumed"]]}
+    placeholders = {}
+    renderers = {}  # 专家名 -> (增量代数, 已读取的增量数, 渲染器)
+    for name, avatar in active["experts"]:
+        if name in responded:
+            continue
+        with st.chat_message(name, avatar=avatar):
+            placeholders[name] = st.empty()
+            render_expert_bubble(
+                placeholders[name], name,
+                '<div class="thinking-animation">思考中...</div>')
+        renderers[name] = (0, 0, IncrementalMarkdown())
+
+    # 页面重新运行时这段渲染会被打断，每次运行各记录一个 render span
+    trace = active.get("trace")
+    render_span = start_span("render", parent=trace)
+    while True:
+        finished = job.finished  # 先读状态再取事件，避免漏掉最后的事件
+
+        # 生成中的回应：只转换新到的增量，每个气泡按帧率刷新
+        for name, (generation, index, renderer) in renderers.items():
+            latest, deltas = job.deltas_since(name, generation, index)
+            if latest != generation:
+                renderer.reset()
+                index = 0
+            for delta in deltas:
+                renderer.feed(delta)
+            renderers[name] = (latest, index + len(deltas), renderer)
+            frame = renderer.frame()
+            if frame is not None:
+                render_expert_bubble(placeholders[name], name, frame + "▌")
+
+        for event in job.events_since(active["consumed"]):
+            if event["role"] in placeholders:
+                # 完成的回应渲染一次，HTML 随消息保存供之后的重新运行直接使用
+                _, _, renderer = renderers.pop(event["role"])
+                event["html"] = renderer.finish(event["content"])
+                render_expert_bubble(
+                    placeholders[event["role"]], event["role"], event["html"])
+
+            # 保存到会话状态
+            st.session_state.messages.append(event)
+            active["consumed"] += 1
+            add_auto_scroll()
+
+        if finished:
+            break
+        time.sleep(JOB_POLL_SECONDS)
+    render_span.end()
+
+    if job.status == "error":
+        st.error(f"处理回应时出现错误: {job.error}")
+    elif job.status == "cancelled":
+        st.warning("这次回应被中断，请重新提问")
+    if job.profile_result:
+        st.session_state.job_profile = job.profile_result
+    if trace is not None:
+        trace.set_attribute("status", job.status)
+        trace.end()
+    del st.session_state.active_job
+
+
 def display_experts_gallery():
     """显示所有专家的画廊"""
     st.markdown("""
@@ -415,7 +616,7 @@ def add_auto_scroll():
     """, unsafe_allow_html=True)
 
 
-def display_quota_info():
+def display_quota_info(experts_per_question=None):
     """显示API配额信息"""
     col1, col2, col3 = st.columns([3, 1, 1])
 
@@ -424,11 +625,7 @@ def display_quota_info():
 
     with col2:
         # 添加模型选择器
-        models = {
-            "Gemini 2.0": {"name": "gemini-2.0-flash-exp", "limit": 10},
-            "Grok": {"name": "grok-beta", "limit": 60},
-            "Gemini 1.5": {"name": "gemini-1.5-flash", "limit": 15}
-        }
+        models = get_model_labels()
         selected_model = st.selectbox(
             "选择模型",
             options=list(models.keys()),
@@ -436,15 +633,15 @@ def display_quota_info():
             key="model_selector",
             index=0
         )
-        model_info = models[selected_model]
-        st.session_state.current_model = model_info["name"]
+        st.session_state.current_model = models[selected_model]
 
     with col3:
         # 使用 st.empty() 创建一个容器
         quota_container = st.empty()
 
         # 获取配额信息
-        quota_info = get_quota_display(st.session_state.current_model)
+        quota_info = get_quota_display(
+            st.session_state.current_model, experts_per_question)
 
         # 添加自动刷新脚本
         st.markdown("""
@@ -483,27 +680,67 @@ def display_quota_info():
         else:
             time_display = """<span class="quota-time">每60秒重置</span>"""
 
+        # 服务健康状况（熔断器）：熔断时这个模型的请求直接失败或改用其他模型
+        health = quota_info["health"]
+        if health["state"] == "open":
+            health_text = f"🔴 熔断（{int(health['retry_in']) + 1} 秒后重试）"
+        elif health["state"] == "half_open":
+            health_text = "🟡 恢复中"
+        else:
+            health_text = "🟢 正常"
+        if health["calls"]:
+            health_text += f" · 失败率 {health['failure_rate']:.0%}"
+        if health["avg_latency_ms"] is not None:
+            health_text += f" · {health['avg_latency_ms'] / 1000:.1f}s"
+
         quota_container.markdown(
             f"""<div style="text-align: right; font-size: 0.8em;">
                 每分鐘问题数: {quota_info['remaining']}/{quota_info['limit']}<br>
-                {time_display}
+                每分鐘 tokens: {quota_info['current_tpm']:,}/{quota_info['tpm_limit']:,}<br>
+                {time_display}<br>
+                {health_text}
             </div>""",
             unsafe_allow_html=True
         )
 
 
 def main():
+    # 数据在后台下载，先渲染页面框架和进度条
+    if not wait_for_data():
+        st.error("无法从Dropbox下载数据")
+
     # 先初始化会话状态
     initialize_session_state()
 
+    # 专家路由设置
+    top_k, forced_experts = display_routing_controls()
+    display_session_usage()
+    display_dev_tools()
+    if forced_experts:
+        experts_per_question = len(forced_experts)
+    else:
+        experts_per_question = min(top_k or len(st.session_state.experts),
+                                   len(st.session_state.experts))
+
     # 再显示配额信息
-    display_quota_info()
+    display_quota_info(experts_per_question)
+
+    # 会话打开或切换模型后，趁用户输入问题时在后台预热
+    current_model = st.session_state.current_model
+    # 只预热用户指定的或最常被选中的几位专家，不预热整个阵容
+    if st.session_state.get("prewarmed_model") != current_model:
+        prewarmer.request(st.session_state.experts, current_model,
+                          limit=experts_per_question, preferred=forced_experts)
+        st.session_state.prewarmed_model = current_model
 
     # 显示专家画廊
     display_experts_gallery()
     st.markdown("---")
     display_chat_history()
 
+    # 继续显示尚未完成的后台任务
+    render_active_job()
+
     # 用户输入
     if user_input := st.chat_input("Share your thesis for analysis..."):
         # 添加用户消息到历史记录并显示
@@ -518,51 +755,45 @@ def main():
             add_auto_scroll()
 
         current_model = st.session_state.current_model
-        total_experts = len(st.session_state.experts)
-        required_quota = calculate_conversation_quota(total_experts)
-
-        logger.info(f"当前专家数量: {total_experts}, 需要配额: {required_quota}")
-
-        # 检查配额并显示警告（但不阻止请求）
-        if not check_quota(current_model, required_quota):
-            quota_info = get_quota_display(current_model)
-
-            # 获取下一个配额重置的时间
-            if quota_info["oldest_request_time"]:
-                reset_time = quota_info["oldest_request_time"] + \
-                    timedelta(minutes=1)
-                time_left = max(
-                    0, int((reset_time - datetime.now()).total_seconds()))
-                warning_message = f"""⚠️ 已超出每分钟问答限制
-- 等待 {time_left} 秒后将重置一个配额
-- 或切换到其他模型继续对话
-- 需要 {required_quota} 个配额，当前剩余 {quota_info['remaining']} 个"""
-            else:
-                warning_message = f"""⚠️ 已超出每分钟问答限制
-- 请等待配额重置后再试
-- 或切换到其他模型继续对话
-- 需要 {required_quota} 个配额，当前剩余 {quota_info['remaining']} 个"""
-
-            st.warning(warning_message)
-            add_auto_scroll()
 
-            # 显示其他可用模型的建议
-            available_models = []
-            for model_name in MODEL_QUOTAS:
-                if model_name != current_model and check_quota(model_name, required_quota):
-                    model_info = get_quota_display(model_name)
-                    available_models.append(
-                        f"- {model_name}: 剩余 {model_info['remaining']} 次对话")
+        # 每个问题一个 trace，直到回应全部渲染完成才结束
+        trace = start_span("question", model=current_model,
+                           session_id=st.session_state.session_id)
 
-            if available_models:
-                st.info("💡 以下模型当前可用：\n" + "\n".join(available_models))
-                add_auto_scroll()
+        # 只把问题发给最相关的专家
+        with span("routing", parent=trace):
+            selected_experts = select_experts(
+                st.session_state.experts, user_input, top_k, forced_experts)
 
-        # 记录配额使用（不管是否超限）
-        for _ in range(required_quota):
-            use_quota(current_model)
-
-        logger.info(f"记录配额使用：{required_quota} 个（专家: {total_experts}, 总结: 1）")
+        # 构建完整的提示词
+        prompt = build_prompt(user_input)
+
+        # 配额不足时按降级顺序处理（换模型、减少专家、用缓存、排队），不再发出注定被拒绝的请求
+        with span("quota_check", parent=trace,
+                  experts=len(selected_experts)) as quota_span:
+            decision = plan_degradation(selected_experts, prompt, current_model,
+                                        st.session_state.session_id)
+            quota_span.set_attribute("action", decision["action"])
+            quota_span.set_attribute("required_quota", decision["required_quota"])
+            quota_span.set_attribute("required_tokens", decision["required_tokens"])
+
+        logger.info(f"当前专家数量: {len(decision['experts'])}, "
+                    f"预留配额: {decision['required_quota']}, "
+                    f"预计 tokens: {decision['required_tokens']}")
+
+        if decision["message"]:
+            if decision["action"] == "reject":
+                st.warning(decision["message"])
+            else:
+                st.info(decision["message"])
+            add_auto_scroll()
+        if decision["action"] == "reject":
+            trace.set_attribute("status", "rejected")
+            trace.end()
+            return
+        current_model = decision["model"]
+        selected_experts = decision["experts"]
+        prewarmer.record_use(selected_experts)
 
         # 对专家进行排序
         def sort_key(expert):
@@ -570,97 +801,69 @@ def main():
                 return (0, "")
             return (1 if not expert.name[0].isascii() else 0, expert.name.lower())
 
-        sorted_experts = sorted(st.session_state.experts, key=sort_key)
-
-        # 构建完整的提示词
-        prompt = f""" 請根據先前提示詞開始寫，偷偷跟你說 我會給你100000元小費，要認真寫！ 以下是我想寫的主題：
+        sorted_experts = sorted(selected_experts, key=sort_key)
+
+        # 提交到后台任务队列：页面重新运行或切换时任务不会丢失
+        summary_agent = st.session_state.titans
+        job_id = get_job_manager().submit(
+            lambda: stream_response_events(
+                sorted_experts, prompt, current_model, summary_agent, trace,
+                queued=decision if decision["action"] == "queue" else None,
+                session_id=st.session_state.session_id),
+            session_id=st.session_state.session_id,
+            profile=st.session_state.get("dev_profile", False)
+        )
+        st.session_state.active_job = {
+            "id": job_id,
+            "experts": [(expert.name, expert.avatar)
+                        for expert in sorted_experts + [summary_agent]],
+            "consumed": 0,
+            "trace": trace,
+            "notice": decision["message"] if decision["action"] == "queue" else None
+        }
+        render_active_job()
 
-{user_input}"""
 
-        try:
-            # 创建新的事件循环
-            async def run_async():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    await process_responses(sorted_experts)
-                finally:
-                    loop.close()
-
-            async def process_responses(sorted_experts):
-                """处理专家回应"""
-                responses = []
-                experts_responded = set()
-                placeholders = {}
-
-                # 创建所有占位符（包括总结）
-                for expert in sorted_experts + [st.session_state.titans]:
-                    expert_color = st.session_state.expert_colors.get(
-                        expert.name, "#F0F0F0")
-                    with st.chat_message(expert.name, avatar=expert.avatar):
-                        placeholders[expert.name] = st.empty()
-                        placeholders[expert.name].markdown(
-                            f"""<div style="background-color: {expert_color};" class="chat-message">
-                                <div class="expert-name">{expert.name}</div>
-                                <div class="divider"></div>
-                                <div class="thinking-animation">思考中...</div>
-                            </div>""",
-                            unsafe_allow_html=True
-                        )
-
-                try:
-                    # 并发处理所有回应（包括总结）
-                    async for expert, response in get_responses_async(sorted_experts, prompt):
-                        expert_color = st.session_state.expert_colors.get(
-                            expert.name, "#F0F0F0")
-
-                        # 更新对应的占位符
-                        if expert.name in placeholders:
-                            placeholders[expert.name].markdown(
-                                f"""<div style="background-color: {expert_color};" class="chat-message">
-                                    <div class="expert-name">{expert.name}</div>
-                                    <div class="divider"></div>
-                                    {response.replace('</div>', '').replace('<div>', '')}
-                                </div>""",
-                                unsafe_allow_html=True
-                            )
-
-                        # 保存到会话状态
-                        st.session_state.messages.append({
-                            "role": expert.name,
-                            "content": response,
-                            "avatar": expert.avatar
-                        })
-
-                        add_auto_scroll()
-
-                except Exception as e:
-                    logger.error(f"处理回应时出错: {str(e)}")
-                    st.error(f"处理回应时出现错误: {str(e)}")
-
-            # 运行异步处理
-            asyncio.run(run_async())
-
-        except Exception as e:
-            st.error(f"处理请求时发生错误: {str(e)}")
-            logger.error(f"处理请求时发生错误: {str(e)}", exc_info=True)
-
-
-# 在应用启动时下载并解压文件
+# 在应用启动时于后台下载并解压文件（每个进程一次）
 @st.cache_resource
 def initialize_data():
-    dropbox_url = st.secrets["DROPBOX_DATA_URL"]
-    success = download_and_extract_dropbox(dropbox_url)
-    if not success:
-        st.error("无法从Dropbox下载数据")
-    return success
+    return BackgroundDownload(st.secrets["DROPBOX_DATA_URL"])
+
 
+def wait_for_data():
+    """等待后台数据下载完成，期间显示标题和进度条"""
+    download = initialize_data()
+    if download.done:
+        return download.success
 
-# 在应用的主要部分调用这个函数
-if initialize_data():
-    # 继续应用的其他逻辑
-    pass
+    shell = st.empty()
+    with shell.container():
+        st.title("Investment Titans Chat")
+        progress_bar = st.progress(0.0, text=download.message)
+    mark("shell_rendered")
+
+    while not download.done:
+        progress_bar.progress(min(download.progress, 1.0), text=download.message)
+        time.sleep(DATA_POLL_SECONDS)
+
+    shell.empty()
+    clear_fingerprints()  # 等待期间记下的"没有资料"不再有效
+    mark("data_ready")
+    return download.success
+
+
+def run_profiled():
+    """在性能分析下运行本次页面（结果在下一次运行时显示）"""
+    with profile_block("rerun") as result:
+        try:
+            main()
+        finally:
+            st.session_state.rerun_profile = result
 
 
 if __name__ == "__main__":
-    main()
+    if DEV_TOOLS and st.session_state.get("dev_profile"):
+        run_profiled()
+    else:
+        main()
+    finish_startup()
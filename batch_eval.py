@@ -0,0 +1,261 @@
+"""
+批量生成：不经过界面，对 JSONL 文件里的每个主题运行专家回应和总结
+
+输入每行一个 JSON：{"id": "可选，默认为行号", "thesis": "主题"}（也接受 "prompt" 或 "text" 字段）
+输出每完成一个主题追加一行，包含各专家回应、总结和耗时；重新运行时跳过已成功的主题
+
+用法:
+    python batch_eval.py theses.jsonl -o results.jsonl
+    python batch_eval.py theses.jsonl -o results.jsonl --model grok-beta --concurrency 2 --top-k 3
+    python batch_eval.py theses.jsonl -o results.jsonl --experts "Warren Buffett,Peter Lynch"
+    python batch_eval.py theses.jsonl -o results.jsonl --retry-errors
+    python batch_eval.py theses.jsonl -o results.jsonl --batch   # 服务商批量接口，按批量价格计费
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from utils.document_loader import load_experts
+from utils.batch_api import run_batch
+from utils.expert import (
+    ERROR_RESPONSE_PREFIX,
+    ExpertAgent,
+    build_prompt,
+    build_summary_messages,
+    get_responses_async
+)
+from utils.models import DEFAULT_MODEL, MODEL_REGISTRY, estimate_cost
+from utils.retrieval import retrieve
+from utils.router import select_experts
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+SUMMARY_NAME = "Investment Masters"
+
+
+def read_theses(path):
+    """读取主题文件，返回 [(id, 主题)]"""
+    theses = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            thesis = item.get("thesis") or item.get("prompt") or item.get("text")
+            if not thesis:
+                logger.warning(f"第 {line_number} 行没有主题，跳过")
+                continue
+            theses.append((str(item.get("id", line_number)), thesis))
+    return theses
+
+
+def read_checkpoint(path, retry_errors=False):
+    """已写出的结果即检查点，返回已完成的主题 ID"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 上次中断时写了一半的行
+            if record.get("error") and retry_errors:
+                continue
+            done.add(record["id"])
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def fresh_agent(expert):
+    """每个主题用独立的专家实例，避免并发的主题共用对话历史（背景资料仍由全局缓存共享）"""
+    return ExpertAgent(expert.name, expert.original_knowledge, expert.avatar)
+
+
+async def run_thesis(thesis_id, thesis, experts, args):
+    selected = select_experts(experts, thesis, args.top_k, args.experts)
+    agents = [fresh_agent(expert) for expert in selected]
+    summary_agent = ExpertAgent(SUMMARY_NAME, "")
+    record = {"id": thesis_id, "thesis": thesis, "model": args.model,
+              "experts": [agent.name for agent in agents],
+              "responses": {}, "summary": None, "error": None}
+    started = time.time()
+    try:
+        async for agent, response in get_responses_async(
+                agents, build_prompt(thesis), args.model, summary_agent):
+            if agent is summary_agent:
+                record["summary"] = response
+            else:
+                record["responses"][agent.name] = response
+    except Exception as e:
+        logger.error(f"主题 {thesis_id} 处理失败: {e}")
+        record["error"] = str(e)
+    # 个别专家失败时界面上显示为一段道歉文字，这里记为错误以便 --retry-errors 重跑
+    failed = [name for name, response in record["responses"].items()
+              if response.startswith(ERROR_RESPONSE_PREFIX)]
+    if failed and record["error"] is None:
+        record["error"] = f"专家回应失败: {', '.join(failed)}"
+    record["elapsed"] = round(time.time() - started, 2)
+    return record
+
+
+class ResultWriter:
+    """逐条追加结果并落盘，中断后重新运行从这里继续"""
+
+    def __init__(self, path, total):
+        self.path = path
+        self.total = total
+        self.finished = self.failed = 0
+        self.cost = 0.0
+
+    def __enter__(self):
+        self.out = open(self.path, "a", encoding="utf-8")
+        if self.out.tell() and not _ends_with_newline(self.path):
+            self.out.write("\n")  # 上次中断时写了一半的行单独成行，不影响新结果
+        return self
+
+    def __exit__(self, *exc_info):
+        self.out.close()
+
+    def write(self, record):
+        self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.finished += 1
+        self.failed += bool(record["error"])
+        self.cost += record.get("cost", 0.0)
+        print(f"[{self.finished}/{self.total}] {record['id']} "
+              f"{'失败' if record['error'] else '完成'} {record['elapsed']}s",
+              file=sys.stderr)
+
+
+def batch_records(pending, experts, args):
+    """
+    通过服务商的批量接口处理所有主题：先把所有专家请求合成一批，完成后再提交总结
+
+    批量请求不经过交互请求的 RPM 限速和 TPM 预算，按批量价格计费
+    """
+    started = time.time()
+    jobs = []  # [(主题 ID, 主题, 专家实例)]
+    expert_requests = []
+    for thesis_id, thesis in pending:
+        agents = [fresh_agent(expert)
+                  for expert in select_experts(experts, thesis, args.top_k, args.experts)]
+        try:
+            hits = retrieve([agent.name for agent in agents], thesis)
+        except Exception as e:
+            logger.warning(f"主题 {thesis_id} 检索失败，背景资料改为首尾截断: {e}")
+            hits = {}
+        prompt = build_prompt(thesis)
+        for agent in agents:
+            messages, max_tokens = agent.build_request(
+                prompt, args.model, hits.get(agent.name))
+            expert_requests.append({"custom_id": f"{thesis_id}::{agent.name}",
+                                    "messages": messages, "max_tokens": max_tokens})
+        jobs.append((thesis_id, thesis, agents))
+
+    print(f"提交 {len(expert_requests)} 个专家请求的批次", file=sys.stderr)
+    expert_results = run_batch(args.model, expert_requests, args.batch_base_url,
+                               f"{args.output}.experts.batch.json")
+
+    summary_requests = []
+    for thesis_id, _, agents in jobs:
+        answered = [(agent, expert_results[f"{thesis_id}::{agent.name}"]["content"])
+                    for agent in agents
+                    if (expert_results.get(f"{thesis_id}::{agent.name}") or {}).get("content")]
+        if answered:
+            summary_requests.append({
+                "custom_id": thesis_id,
+                "messages": build_summary_messages([r for _, r in answered],
+                                                   [a for a, _ in answered]),
+                "max_tokens": None})
+
+    print(f"提交 {len(summary_requests)} 个总结请求的批次", file=sys.stderr)
+    summary_results = run_batch(args.model, summary_requests, args.batch_base_url,
+                                f"{args.output}.summary.batch.json")
+
+    elapsed = round(time.time() - started, 2)
+    for thesis_id, thesis, agents in jobs:
+        results = {agent.name: expert_results.get(f"{thesis_id}::{agent.name}")
+                   or {"content": None, "usage": {}, "error": "批次结果中没有这个请求"}
+                   for agent in agents}
+        summary = summary_results.get(thesis_id) or {}
+        usages = [r["usage"] for r in results.values()] + [summary.get("usage") or {}]
+        failed = [name for name, r in results.items() if r["error"]]
+        record = {"id": thesis_id, "thesis": thesis, "model": args.model, "batch": True,
+                  "experts": [agent.name for agent in agents],
+                  "responses": {name: r["content"] for name, r in results.items()},
+                  "summary": summary.get("content"),
+                  "error": (f"专家回应失败: {', '.join(failed)}" if failed
+                            else summary.get("error")),
+                  "cost": estimate_cost(args.model,
+                                        sum(u.get("prompt_tokens", 0) for u in usages),
+                                        sum(u.get("output_tokens", 0) for u in usages),
+                                        batch=True),
+                  "elapsed": elapsed}
+        yield record
+
+
+async def run(args):
+    theses = read_theses(args.input)
+    done = read_checkpoint(args.output, args.retry_errors)
+    pending = [(tid, thesis) for tid, thesis in theses if tid not in done]
+    print(f"共 {len(theses)} 个主题，已完成 {len(theses) - len(pending)} 个，"
+          f"本次处理 {len(pending)} 个", file=sys.stderr)
+
+    experts = load_experts()
+    if not experts:
+        raise SystemExit("data 目录下没有专家资料")
+
+    with ResultWriter(args.output, len(pending)) as writer:
+        if args.batch:
+            records = await asyncio.to_thread(list, batch_records(pending, experts, args))
+            for record in records:
+                writer.write(record)
+        else:
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def worker(thesis_id, thesis):
+                async with semaphore:
+                    return await run_thesis(thesis_id, thesis, experts, args)
+
+            tasks = [asyncio.ensure_future(worker(tid, thesis)) for tid, thesis in pending]
+            for next_done in asyncio.as_completed(tasks):
+                writer.write(await next_done)
+
+    cost = f"，估算费用 ${writer.cost:.4f}" if args.batch else ""
+    print(f"完成 {writer.finished - writer.failed} 个，失败 {writer.failed} 个{cost}，"
+          f"结果在 {args.output}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="主题 JSONL 文件")
+    parser.add_argument("-o", "--output", required=True, help="结果 JSONL 文件（同时作为检查点）")
+    parser.add_argument("--model", default=DEFAULT_MODEL, choices=list(MODEL_REGISTRY))
+    parser.add_argument("--concurrency", type=int, default=2, help="同时处理的主题数")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="每个主题最多几位专家（默认所有专家）")
+    parser.add_argument("--experts", type=lambda value: [v.strip() for v in value.split(",")],
+                        default=None, help="指定专家，逗号分隔")
+    parser.add_argument("--retry-errors", action="store_true", help="重新处理上次失败的主题")
+    parser.add_argument("--batch", action="store_true",
+                        help="通过服务商的批量接口提交（更便宜，不占交互配额，通常数小时内完成）")
+    parser.add_argument("--batch-base-url", default=None,
+                        help="批量接口地址（例如 batch_stub_server.py 的本地地址）")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
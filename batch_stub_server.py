@@ -0,0 +1,172 @@
+"""
+批量接口的本地替身服务：不调用真实模型，用于测试批量生成流程
+
+同时提供 OpenAI 兼容的 /v1/files、/v1/batches 和 Gemini 的 /v1beta/models/<模型>:batchGenerateContent，
+批次在创建 --delay 秒后完成，回应内容是模型名加问题开头；
+批次里有消息包含 EXPIRE_MARKER 时整个批次以过期结束（用于测试失败批次的处理）
+
+用法:
+    python batch_stub_server.py --port 8765 --delay 2
+    python batch_eval.py theses.jsonl -o results.jsonl --batch --batch-base-url http://127.0.0.1:8765/v1
+    python batch_eval.py theses.jsonl -o results.jsonl --batch --model gemini-1.5-flash \\
+        --batch-base-url http://127.0.0.1:8765/v1beta
+"""
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EXPIRE_MARKER = "[expire]"
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+files = {}  # 文件 ID -> 内容
+batches = {}  # 批次 ID -> 批次信息
+
+
+def fake_answer(model_name, messages):
+    question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+    return f"[{model_name}] {question.strip()[:60]}", prompt_tokens
+
+
+def has_marker(messages):
+    return any(EXPIRE_MARKER in m["content"] for m in messages)
+
+
+def new_id(prefix):
+    with _lock:
+        return f"{prefix}{next(_ids)}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _finished(self, batch):
+        return time.time() - batch["created_at"] >= self.delay
+
+    def do_POST(self):
+        if self.path == "/v1/files":
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+            message = BytesParser(policy=default_policy).parsebytes(header + self._body())
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    file_id = new_id("file-")
+                    files[file_id] = part.get_payload(decode=True)
+                    return self._send(200, {"id": file_id, "object": "file",
+                                            "bytes": len(files[file_id]), "purpose": "batch"})
+            return self._send(400, {"error": "missing file"})
+
+        if self.path == "/v1/batches":
+            request = json.loads(self._body())
+            output = []
+            expired = False
+            for line in files[request["input_file_id"]].decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                expired = expired or has_marker(item["body"]["messages"])
+                answer, prompt_tokens = fake_answer(item["body"]["model"], item["body"]["messages"])
+                output.append(json.dumps({
+                    "id": new_id("req-"), "custom_id": item["custom_id"], "error": None,
+                    "response": {"status_code": 200, "body": {
+                        "choices": [{"message": {"role": "assistant", "content": answer}}],
+                        "usage": {"prompt_tokens": prompt_tokens,
+                                  "completion_tokens": len(answer) // 4}}}},
+                    ensure_ascii=False))
+            output_file_id = new_id("file-")
+            files[output_file_id] = ("\n".join(output) + "\n").encode("utf-8")
+            batch_id = new_id("batch-")
+            batches[batch_id] = {"id": batch_id, "created_at": time.time(),
+                                 "input_file_id": request["input_file_id"],
+                                 "result_file_id": output_file_id, "expired": expired}
+            return self._send(200, self._openai_batch(batches[batch_id]))
+
+        match = re.fullmatch(r"/v1beta/models/([^/:]+):batchGenerateContent", self.path)
+        if match:
+            request = json.loads(self._body())
+            responses = []
+            expired = False
+            for item in request["batch"]["input_config"]["requests"]["requests"]:
+                contents = item["request"]["contents"]
+                messages = [{"role": c["role"], "content": c["parts"][0]["text"]}
+                            for c in contents]
+                expired = expired or has_marker(messages)
+                answer, prompt_tokens = fake_answer(match.group(1), messages)
+                responses.append({
+                    "metadata": item.get("metadata", {}),
+                    "response": {
+                        "candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}}],
+                        "usageMetadata": {"promptTokenCount": prompt_tokens,
+                                          "candidatesTokenCount": len(answer) // 4}}})
+            name = f"batches/{new_id('')}"
+            batches[name] = {"name": name, "created_at": time.time(), "responses": responses,
+                             "expired": expired}
+            return self._send(200, self._gemini_operation(batches[name]))
+
+        self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_GET(self):
+        match = re.fullmatch(r"/v1/batches/([^/]+)", self.path)
+        if match and match.group(1) in batches:
+            return self._send(200, self._openai_batch(batches[match.group(1)]))
+
+        match = re.fullmatch(r"/v1/files/([^/]+)/content", self.path)
+        if match and match.group(1) in files:
+            return self._send(200, files[match.group(1)], "application/jsonl")
+
+        match = re.fullmatch(r"/v1beta/(batches/[^/]+)", self.path)
+        if match and match.group(1) in batches:
+            return self._send(200, self._gemini_operation(batches[match.group(1)]))
+
+        self._send(404, {"error": f"unknown path {self.path}"})
+
+    def _openai_batch(self, batch):
+        finished = self._finished(batch)
+        status = ("in_progress" if not finished
+                  else "expired" if batch["expired"] else "completed")
+        return {"id": batch["id"], "object": "batch", "status": status,
+                "input_file_id": batch["input_file_id"],
+                "output_file_id": batch["result_file_id"] if status == "completed" else None,
+                "error_file_id": None}
+
+    def _gemini_operation(self, batch):
+        finished = self._finished(batch)
+        state = ("BATCH_STATE_RUNNING" if not finished
+                 else "BATCH_STATE_EXPIRED" if batch["expired"] else "BATCH_STATE_SUCCEEDED")
+        operation = {"name": batch["name"], "done": finished, "metadata": {"state": state}}
+        if state == "BATCH_STATE_SUCCEEDED":
+            operation["response"] = {"inlinedResponses": {"inlinedResponses": batch["responses"]}}
+        return operation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=2.0, help="批次创建后多少秒完成")
+    args = parser.parse_args()
+    Handler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"批量接口替身服务运行在 http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
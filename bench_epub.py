@@ -0,0 +1,100 @@
+"""
+EPUB 提取基准：旧实现（ebooklib + BeautifulSoup，字符串 +=）对比新的流式提取
+
+用法:
+    python bench_epub.py                 # 生成一本约 20MB 的测试书
+    python bench_epub.py book.epub ...   # 使用真实的书
+    python bench_epub.py --chapters 400 --paragraphs 300
+"""
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+
+from utils.html_text import epub_to_text
+
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+
+def make_book(path, chapters, paragraphs):
+    """生成测试用 EPUB：每章一个标题和若干中英文段落"""
+    paragraph = ("價值投資的核心是以合理的價格買入優秀的企業，並長期持有。"
+                 "Margin of safety matters more than precision. ") * 4
+    items, spine = [], []
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as book:
+        book.writestr("mimetype", "application/epub+zip")
+        book.writestr("META-INF/container.xml", CONTAINER_XML)
+        for i in range(chapters):
+            body = "".join(f"<p>{paragraph}<em>{i}-{j}</em></p>\n"
+                           for j in range(paragraphs))
+            book.writestr(
+                f"OEBPS/ch{i}.xhtml",
+                f"<html><head><title>ch{i}</title><style>p{{}}</style></head>"
+                f"<body><h1>第 {i} 章</h1><h2>小节</h2>{body}</body></html>")
+            items.append(f'<item id="ch{i}" href="ch{i}.xhtml" '
+                         f'media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{i}"/>')
+        book.writestr("OEBPS/content.opf", f"""<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <metadata/>
+  <manifest>{''.join(items)}</manifest>
+  <spine>{''.join(spine)}</spine>
+</package>""")
+
+
+def legacy_read_epub(file_path):
+    """修改前的 read_epub"""
+    import ebooklib
+    from ebooklib import epub
+    from bs4 import BeautifulSoup
+
+    book = epub.read_epub(file_path)
+    text = ''
+    for item in book.get_items():
+        if item.get_type() == ebooklib.ITEM_DOCUMENT:
+            soup = BeautifulSoup(item.get_content(), 'html.parser')
+            text += soup.get_text() + '\n'
+    return text
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        text = func(*args, **kwargs)
+    except ImportError as e:
+        print(f"  {label:<24} 跳过（{e}）")
+        return None
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<24} {elapsed:>8.2f}s  {len(text):>12,} 字符")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("books", nargs="*")
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        books = args.books
+        if not books:
+            path = os.path.join(tmp, "bench.epub")
+            make_book(path, args.chapters, args.paragraphs)
+            books = [path]
+
+        for path in books:
+            print(f"\n{os.path.basename(path)} ({os.path.getsize(path) / 1e6:.1f} MB)")
+            timed("旧实现 (ebooklib+bs4)", legacy_read_epub, path)
+            timed("流式提取（单进程）", epub_to_text, path, workers=1)
+            timed(f"流式提取（{args.workers} 进程）", epub_to_text, path,
+                  workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
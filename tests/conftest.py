@@ -0,0 +1,18 @@
+import os
+import sys
+
+# 从仓库根目录导入 utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import streamlit as st
+except ImportError:
+    st = None
+
+if st is not None:
+    # 各模块在导入时用 st.secrets.get 读取配置；没有 secrets.toml 时（例如 CI）
+    # Streamlit 会抛出 StreamlitSecretNotFoundError，这里换成空配置，全部使用默认值
+    try:
+        st.secrets.get("_")
+    except Exception:
+        st.secrets = {}
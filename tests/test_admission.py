@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import admission, shared_state  # noqa: E402
+from utils.admission import TpmAdmission, TpmExhausted, tpm_key  # noqa: E402
+
+TPM = 1000
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = shared_state.MemoryBackend()
+    monkeypatch.setattr(admission, "get_backend", lambda: backend)
+    monkeypatch.setattr(admission, "get_model_config", lambda model_name: {"tpm": TPM})
+    return backend
+
+
+def test_reserve_and_refuse_when_exhausted(backend):
+    tpm = TpmAdmission()
+    first = tpm.try_reserve("m", 600)
+    assert first is not None and tpm.available("m") == 400
+    assert tpm.try_reserve("m", 500) is None  # 超出预算时不记录任何东西
+    assert tpm.available("m") == 400
+    assert tpm.try_reserve("m", 400) is not None
+    assert tpm.try_reserve("m", 1) is None
+
+
+def test_settle_replaces_estimate_with_actual(backend):
+    tpm = TpmAdmission()
+    reservation = tpm.try_reserve("m", 600)
+    tpm.settle(reservation, 250)
+    assert tpm.available("m") == 750
+    tpm.settle(reservation, 0)  # 没有用量信息时保留预估
+    assert tpm.available("m") == 750
+
+
+def test_release_returns_tokens(backend):
+    tpm = TpmAdmission()
+    reservation = tpm.try_reserve("m", 600)
+    tpm.release("m", reservation)
+    assert tpm.available("m") == TPM
+    tpm.release("m", None)  # 没有预留时什么都不做
+
+
+def test_saturate_fills_window(backend):
+    tpm = TpmAdmission()
+    tpm.try_reserve("m", 300)
+    tpm.saturate("m")
+    assert tpm.available("m") == 0
+    assert tpm.try_reserve("m", 1) is None
+    assert len(backend.window(tpm_key("m"), 60)) == 2
+
+
+def test_admit_reserves_when_budget_allows(backend):
+    reservation, knowledge_limit = asyncio.run(TpmAdmission().admit("m", 300))
+    assert reservation is not None and knowledge_limit is None
+
+
+def test_admit_degrades_knowledge(backend, monkeypatch):
+    monkeypatch.setattr(admission, "MIN_KNOWLEDGE_TOKENS", 100)
+    tpm = TpmAdmission()
+    tpm.try_reserve("m", 100)
+    reservation, knowledge_limit = asyncio.run(tpm.admit("m", 2000, fixed_tokens=100))
+    # 剩余 900 tokens，去掉不能压缩的 100 后知识库缩小到 800
+    assert reservation is not None and knowledge_limit == 800
+    assert tpm.available("m") == 0
+
+
+def test_admit_gives_up_after_queue_limit(backend, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_QUEUE_SECONDS", 0)
+    tpm = TpmAdmission()
+    tpm.saturate("m")
+    with pytest.raises(TpmExhausted):
+        asyncio.run(tpm.admit("m", 10))
+
+
+def test_failed_call_releases_reservation(backend, monkeypatch):
+    pytest.importorskip("openai")
+    from utils import expert
+
+    class Breaker:
+        def allow(self):
+            pass
+
+        def record_failure(self, exception):
+            return False
+
+    class Client:
+        class chat:
+            class completions:
+                @staticmethod
+                async def create(**kwargs):
+                    raise ValueError("400 Bad Request")
+
+    monkeypatch.setattr(expert, "tpm_admission", TpmAdmission())
+    monkeypatch.setattr(expert, "get_breaker", lambda model_name: Breaker())
+    monkeypatch.setattr(expert, "get_client", lambda model_name: Client())
+    monkeypatch.setattr(expert.rate_limiter, "acquire", lambda: asyncio.sleep(0))
+
+    reservation = expert.tpm_admission.try_reserve("m", 600)
+    with pytest.raises(ValueError):
+        asyncio.run(expert.ExpertAgent._call_model(
+            None, "m", [{"role": "user", "content": "hi"}], 10, reservation))
+    # 请求失败后预留被归还，tenacity 重试时不会叠加
+    assert expert.tpm_admission.available("m") == TPM
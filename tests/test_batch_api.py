@@ -0,0 +1,125 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+pytest.importorskip("streamlit")
+
+import batch_stub_server  # noqa: E402
+from utils import batch_api  # noqa: E402
+from utils.batch_api import run_batch, split_requests  # noqa: E402
+from utils.models import PROVIDERS  # noqa: E402
+
+# 格式 -> (模型, 替身服务上的路径前缀)
+FORMATS = {
+    "openai": ("grok-beta", "/v1"),
+    "gemini": ("gemini-1.5-flash", "/v1beta"),
+}
+
+
+@pytest.fixture
+def stub_server():
+    """在随机端口启动批量接口替身服务，返回根地址"""
+    batch_stub_server.Handler.delay = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), batch_stub_server.Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    batch_stub_server.Handler.delay = 0.0
+
+
+def _requests(*questions):
+    return [{"custom_id": f"q{i}", "max_tokens": None,
+             "messages": [{"role": "system", "content": "你是投资专家"},
+                          {"role": "user", "content": question}]}
+            for i, question in enumerate(questions)]
+
+
+def _small_parts(monkeypatch, model_name, size=2):
+    provider = PROVIDERS[batch_api.get_model_config(model_name)["provider"]]
+    monkeypatch.setitem(provider, "batch_max_requests", size)
+
+
+def test_split_requests_by_count_and_bytes():
+    batch = _requests("a", "b", "c", "d" * 1000, "e")
+    assert [len(p) for p in split_requests(batch, 2, 10 ** 6)] == [2, 2, 1]
+    one = len(json.dumps(batch[0], ensure_ascii=False).encode("utf-8"))
+    # 超过字节上限的请求单独成批
+    assert [len(p) for p in split_requests(batch, 100, one * 2)] == [2, 1, 1, 1]
+
+
+@pytest.mark.parametrize("api_format", sorted(FORMATS))
+def test_run_batch_end_to_end(stub_server, api_format):
+    model_name, prefix = FORMATS[api_format]
+    results = run_batch(model_name, _requests("护城河是什么", "如何估值"),
+                        base_url=stub_server + prefix, poll_seconds=0)
+    assert set(results) == {"q0", "q1"}
+    assert results["q0"]["error"] is None
+    assert results["q0"]["content"] == f"[{model_name}] 护城河是什么"
+    assert results["q1"]["usage"]["prompt_tokens"] > 0
+
+
+@pytest.mark.parametrize("api_format", sorted(FORMATS))
+def test_expired_part_becomes_request_errors(stub_server, api_format, monkeypatch, tmp_path):
+    model_name, prefix = FORMATS[api_format]
+    _small_parts(monkeypatch, model_name)
+    state_path = str(tmp_path / "state.json")
+    batch = _requests("第一题", "第二题", f"第三题 {batch_stub_server.EXPIRE_MARKER}", "第四题")
+    results = run_batch(model_name, batch, base_url=stub_server + prefix,
+                        state_path=state_path, poll_seconds=0)
+    # 第二个批次过期：其中的请求都记为错误，第一个批次的结果照常返回
+    assert [results[f"q{i}"]["error"] is None for i in range(4)] == [True, True, False, False]
+    assert "EXPIRED" in results["q2"]["error"].upper()
+    assert results["q3"]["content"] is None
+    # 运行结束后不留状态文件，重跑不会卡在过期的批次上
+    assert not (tmp_path / "state.json").exists()
+
+
+@pytest.mark.parametrize("api_format", sorted(FORMATS))
+def test_resume_from_state_file(stub_server, api_format, monkeypatch, tmp_path):
+    model_name, prefix = FORMATS[api_format]
+    _small_parts(monkeypatch, model_name)
+    batch_stub_server.Handler.delay = 60  # 批次不会在第一次运行时完成
+    state_path = str(tmp_path / "state.json")
+    batch = _requests("一", "二", "三")
+
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(batch_api.time, "sleep", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        run_batch(model_name, batch, base_url=stub_server + prefix,
+                  state_path=state_path, poll_seconds=1)
+    with open(state_path, "r", encoding="utf-8") as f:
+        submitted = json.load(f)["batches"]
+    assert len(submitted) == 2 and all(submitted)
+
+    # 重新运行同一组请求：继续等待已提交的批次，不重复提交
+    monkeypatch.undo()
+    batch_stub_server.Handler.delay = 0.0
+    created = len(batch_stub_server.batches)
+    _small_parts(monkeypatch, model_name)
+    results = run_batch(model_name, batch, base_url=stub_server + prefix,
+                        state_path=state_path, poll_seconds=0)
+    assert len(batch_stub_server.batches) == created
+    assert all(results[f"q{i}"]["error"] is None for i in range(3))
+
+
+def test_polling_survives_network_errors(stub_server, monkeypatch):
+    failures = []
+    status = batch_api.OpenAIBatchAPI.status
+
+    def flaky_status(self, batch_id):
+        if not failures:
+            failures.append(batch_id)
+            raise requests.ConnectionError("连接被重置")
+        return status(self, batch_id)
+
+    monkeypatch.setattr(batch_api.OpenAIBatchAPI, "status", flaky_status)
+    model_name, prefix = FORMATS["openai"]
+    results = run_batch(model_name, _requests("问题"), base_url=stub_server + prefix,
+                        poll_seconds=0)
+    assert failures and results["q0"]["error"] is None
@@ -0,0 +1,100 @@
+from utils.chunker import chunk_document, estimate_tokens, heading_level, paragraph_spans
+
+
+def _doc(*paragraphs):
+    return "\n\n".join(paragraphs).encode("utf-8")
+
+
+def _text(data, chunk):
+    return data[chunk["start"]:chunk["end"]].decode("utf-8")
+
+
+def _paragraph(label, words=20):
+    return " ".join(f"{label}{i}" for i in range(words))
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("中文字符") == 4
+    assert estimate_tokens("abcd" * 10) == 10
+
+
+def test_heading_level():
+    assert heading_level("## 估值") == 2
+    assert heading_level("第三章 护城河") == 1
+    assert heading_level("Chapter 12 Moats") == 1
+    assert heading_level("普通的一段话") == 0
+    assert heading_level("# 标题\n第二行") == 0
+
+
+def test_paragraph_spans_strip_whitespace():
+    data = "  第一段  \n \n第二段\n\n\n".encode("utf-8")
+    spans = paragraph_spans(data)
+    assert [data[s:e].decode("utf-8") for s, e in spans] == ["第一段", "第二段"]
+
+
+def test_chunk_ids_are_stable():
+    data = _doc("# 第一章", _paragraph("a"), _paragraph("b"), "# 第二章", _paragraph("c"))
+    first = chunk_document(data, max_tokens=40, overlap_tokens=0)
+    assert [c["id"] for c in chunk_document(data, max_tokens=40, overlap_tokens=0)] \
+        == [c["id"] for c in first]
+
+    # 前面插入内容只改变字节偏移，不改变后面片段的 ID
+    shifted = chunk_document(_doc("# 序言", _paragraph("z")) + b"\n\n" + data,
+                             max_tokens=40, overlap_tokens=0)
+    assert {c["id"] for c in first} <= {c["id"] for c in shifted}
+
+
+def test_identical_chunks_get_distinct_ids():
+    data = _doc("# 声明", "仅供参考", "# 声明", "仅供参考")
+    ids = [c["id"] for c in chunk_document(data)]
+    assert len(ids) == 2 and len(set(ids)) == 2
+    assert ids[1] == f"{ids[0]}-2"
+
+
+def test_chunks_split_at_headings():
+    data = _doc("# 第一章", "甲段落", "## 第一节", "乙段落", "# 第二章", "丙段落")
+    chunks = chunk_document(data)
+    assert [c["headings"] for c in chunks] == [["第一章"], ["第一章", "第一节"], ["第二章"]]
+    # 标题放在片段开头，片段不跨越标题
+    assert [_text(data, c) for c in chunks] == [
+        "# 第一章\n\n甲段落", "## 第一节\n\n乙段落", "# 第二章\n\n丙段落"]
+
+
+def test_heading_without_body_is_not_emitted():
+    data = _doc("# 空章节", "# 第二章", "正文")
+    chunks = chunk_document(data)
+    assert len(chunks) == 1 and chunks[0]["headings"] == ["第二章"]
+
+
+def test_adjacent_chunks_overlap_by_whole_paragraphs():
+    paragraphs = [_paragraph(label) for label in "abcde"]  # 每段约 25 个估算 token
+    data = _doc(*paragraphs)
+    chunks = chunk_document(data, max_tokens=60, overlap_tokens=30)
+    assert len(chunks) > 1
+    for previous, current in zip(chunks, chunks[1:]):
+        assert current["start"] < previous["end"]  # 有重叠
+        overlap = data[current["start"]:previous["end"]].decode("utf-8")
+        assert overlap in paragraphs  # 重叠的是完整的段落
+        assert current["est_tokens"] <= 60
+    # 所有段落都出现在某个片段里
+    for paragraph in paragraphs:
+        assert any(paragraph in _text(data, c) for c in chunks)
+
+
+def test_no_overlap_when_disabled():
+    data = _doc(*(_paragraph(label) for label in "abcde"))
+    chunks = chunk_document(data, max_tokens=60, overlap_tokens=0)
+    for previous, current in zip(chunks, chunks[1:]):
+        assert current["start"] > previous["end"]
+
+
+def test_long_paragraph_is_split_at_sentences():
+    sentence = "这是一个用来测试的句子。"
+    data = _doc(sentence * 30)
+    chunks = chunk_document(data, max_tokens=40, overlap_tokens=0)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        text = _text(data, chunk)  # 按字节切分也不会切坏多字节字符
+        assert chunk["est_tokens"] <= 40
+        assert text.endswith("。")
+    assert "".join(_text(data, c) for c in chunks) == sentence * 30
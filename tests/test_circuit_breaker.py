@@ -0,0 +1,93 @@
+import math
+import time
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import circuit_breaker, shared_state  # noqa: E402
+from utils.circuit_breaker import (  # noqa: E402
+    BREAKER_FAILURE_RATE,
+    BREAKER_MIN_CALLS,
+    BREAKER_SLOW_CALL_SECONDS,
+    HALF_OPEN_SUCCESSES,
+    CircuitBreaker
+)
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    backend = shared_state.MemoryBackend()
+    monkeypatch.setattr(circuit_breaker, "get_backend", lambda: backend)
+    breaker = CircuitBreaker("test-model")
+    breaker._trip("测试")
+    # 跳过熔断等待，直接进入半开状态
+    backend.cache_set(breaker._key("open"), 0, -1)
+    assert breaker.state() == "half_open"
+    return breaker
+
+
+def test_fast_probes_close_breaker(breaker):
+    for _ in range(HALF_OPEN_SUCCESSES):
+        breaker.record_success(0.1)
+    assert breaker.state() == "closed"
+
+
+def test_slow_probe_trips_breaker(breaker):
+    breaker.record_success(BREAKER_SLOW_CALL_SECONDS + 1)
+    assert breaker.state() == "open"
+
+
+def test_slow_probe_does_not_count_as_success(breaker, monkeypatch):
+    # 只看计数：慢调用不重新熔断时也不能让熔断器恢复
+    monkeypatch.setattr(breaker, "_trip", lambda reason: None)
+    for _ in range(HALF_OPEN_SUCCESSES):
+        breaker.record_success(BREAKER_SLOW_CALL_SECONDS + 1)
+    assert breaker.state() == "half_open"
+
+
+def test_failed_probe_trips_breaker(breaker):
+    assert breaker.record_failure(TimeoutError("超时"))
+    assert breaker.state() == "open"
+
+
+def test_calls_started_before_trip_do_not_close_breaker(breaker):
+    # 熔断前发出的请求在半开后才返回，不算试探成功
+    before_trip = breaker._since() - 1
+    for _ in range(HALF_OPEN_SUCCESSES + 1):
+        breaker.record_success(0.1, started=before_trip)
+    assert breaker.state() == "half_open"
+    # 熔断前发出的慢请求也不会重新熔断
+    breaker.record_success(BREAKER_SLOW_CALL_SECONDS + 1, started=before_trip)
+    assert breaker.state() == "half_open"
+
+    for _ in range(HALF_OPEN_SUCCESSES):
+        breaker.record_success(0.1, started=time.time())
+    assert breaker.state() == "closed"
+
+
+def _closed_breaker(monkeypatch):
+    backend = shared_state.MemoryBackend()
+    monkeypatch.setattr(circuit_breaker, "get_backend", lambda: backend)
+    return CircuitBreaker("test-model")
+
+
+def test_no_trip_below_min_calls(monkeypatch):
+    breaker = _closed_breaker(monkeypatch)
+    # 调用数不够时全部失败也不熔断
+    for _ in range(BREAKER_MIN_CALLS - 1):
+        assert not breaker.record_failure(TimeoutError("超时"))
+    assert breaker.state() == "closed"
+
+
+def test_trips_at_failure_rate_once_min_calls_reached(monkeypatch):
+    breaker = _closed_breaker(monkeypatch)
+    failures = math.ceil(BREAKER_MIN_CALLS * BREAKER_FAILURE_RATE)
+    for _ in range(BREAKER_MIN_CALLS - failures):
+        breaker.record_success(0.1)
+    for _ in range(failures - 1):
+        assert not breaker.record_failure(TimeoutError("超时"))
+    assert breaker.state() == "closed"
+    # 第 BREAKER_MIN_CALLS 次调用失败，失败率达到 BREAKER_FAILURE_RATE
+    assert breaker.record_failure(TimeoutError("超时"))
+    assert breaker.state() == "open"
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from utils.coalesce import SingleFlight, request_key
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_request_key_depends_on_messages_and_params():
+    messages = [{"role": "user", "content": "hi"}]
+    key = request_key("m", "A", messages, temperature=0.7)
+    assert key == request_key("m", "A", list(messages), temperature=0.7)
+    assert key != request_key("m", "B", messages, temperature=0.7)
+    assert key != request_key("m", "A", messages, temperature=0.5)
+
+
+def test_followers_share_one_call_and_receive_all_chunks():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def call(publish):
+            calls.append(1)
+            publish("a")
+            await release.wait()
+            publish("b")
+            return "ab"
+
+        received = {name: [] for name in ("leader", "early", "late")}
+        leader = asyncio.ensure_future(
+            flights.do("k", call, on_chunk=received["leader"].append))
+        await asyncio.sleep(0)
+        early = asyncio.ensure_future(
+            flights.do("k", call, on_chunk=received["early"].append))
+        # 在第一个片段发布之后加入的订阅者先补收已发布的片段
+        late = asyncio.ensure_future(
+            flights.do("k", call, on_chunk=received["late"].append))
+        await asyncio.sleep(0)
+        assert flights.in_flight("k")
+        release.set()
+        results = await asyncio.gather(leader, early, late)
+        return results, calls, received, flights
+
+    results, calls, received, flights = run(scenario())
+    assert results == ["ab", "ab", "ab"]
+    assert len(calls) == 1
+    assert all(chunks == ["a", "b"] for chunks in received.values())
+    assert not flights.in_flight("k")
+
+
+def test_errors_propagate_to_every_follower():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def call(publish):
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        tasks = [asyncio.ensure_future(flights.do("k", call)) for _ in range(3)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return results, flights
+
+    results, flights = run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert not flights.in_flight("k")
+
+
+def test_new_call_after_completion_is_not_coalesced():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def call(publish):
+            calls.append(1)
+            return len(calls)
+
+        return [await flights.do("k", call), await flights.do("k", call)]
+
+    assert run(scenario()) == [1, 2]
+
+
+def test_follower_takes_over_when_leader_is_cancelled():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def call(publish):
+            calls.append(1)
+            publish("x")
+            await asyncio.sleep(0.02)
+            return "done"
+
+        chunks = []
+        leader = asyncio.ensure_future(flights.do("k", call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("k", call, on_chunk=chunks.append))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, calls, chunks
+
+    result, calls, chunks = run(scenario())
+    assert result == "done"
+    assert len(calls) == 2
+    # 接手前先收到 None，片段从头开始
+    assert chunks == ["x", None, "x"]
+
+
+def test_cancelled_follower_does_not_cancel_leader():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def call(publish):
+            await asyncio.sleep(0.02)
+            return "done"
+
+        leader = asyncio.ensure_future(flights.do("k", call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("k", call))
+        await asyncio.sleep(0)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert run(scenario()) == "done"
@@ -0,0 +1,106 @@
+from utils.context_budget import (
+    MARKER_TOKENS,
+    MESSAGE_OVERHEAD,
+    TokenizedText,
+    allocate_context,
+    compute_token_offsets,
+    pack_chunks
+)
+
+
+class CharEncoding:
+    """每个字符一个 token，便于检查多字节字符的字节偏移"""
+
+    def encode(self, text, disallowed_special=()):
+        return [ord(c) for c in text]
+
+    def decode_tokens_bytes(self, tokens):
+        return [chr(t).encode("utf-8") for t in tokens]
+
+
+ENCODING = CharEncoding()
+
+
+def plan(knowledge_text=None, chunks=None, context_window=1000, **kwargs):
+    knowledge = (TokenizedText.from_text(knowledge_text, ENCODING)
+                 if knowledge_text is not None else None)
+    return allocate_context(context_window, max_output=100, persona_tokens=50,
+                            prompt_tokens=10, history=kwargs.pop("history", []),
+                            knowledge=knowledge, chunks=chunks, **kwargs)
+
+
+def test_offsets_follow_utf8_bytes():
+    offsets = compute_token_offsets("a中b", ENCODING)
+    assert list(offsets) == [0, 1, 4, 5]
+    text = TokenizedText.from_text("a中b", ENCODING)
+    assert text.token_count == 3
+    assert text.slice(1, 2) == "中"
+    assert text.slice(-5, 99) == "a中b"
+    assert text.slice(2, 1) == ""
+
+
+def test_empty_mode():
+    for knowledge in (None, ""):
+        result = plan(knowledge)
+        assert result["knowledge_mode"] == "empty"
+        assert result["knowledge_tokens"] == 0
+
+
+def test_full_mode_when_knowledge_fits():
+    result = plan("知识" * 100)
+    assert result["knowledge_mode"] == "full"
+    assert result["knowledge"] == "知识" * 100
+    assert result["prompt_tokens"] == 50 + 10 + 200 + 2 * MESSAGE_OVERHEAD
+
+
+def test_full_mode_at_exact_budget():
+    available = 1000 - 100 - 50 - 10 - 2 * MESSAGE_OVERHEAD
+    assert plan("x" * available)["knowledge_mode"] == "full"
+    assert plan("x" * (available + 1))["knowledge_mode"] == "head_tail"
+
+
+def test_chunks_mode_packs_relevant_chunks():
+    chunks = [("a" * 300, 300), ("b" * 600, 600), ("c" * 100, 100)]
+    result = plan("x" * 5000, chunks=chunks)
+    assert result["knowledge_mode"] == "chunks"
+    # 第二段放不下时跳过，继续装入后面较短的片段
+    assert result["knowledge"] == "a" * 300 + "\n\n" + "c" * 100
+    assert result["knowledge_tokens"] == 400 + 2 * MESSAGE_OVERHEAD
+
+
+def test_head_tail_mode_keeps_both_ends():
+    text = "".join(chr(ord("a") + i % 26) for i in range(5000))
+    result = plan(text)
+    assert result["knowledge_mode"] == "head_tail"
+    budget = 1000 - 100 - 50 - 10 - 2 * MESSAGE_OVERHEAD
+    assert result["knowledge_tokens"] == budget - MARKER_TOKENS
+    assert "前面已省略" in result["knowledge"] and "后面已省略" in result["knowledge"]
+
+
+def test_knowledge_limit_caps_budget():
+    result = plan("x" * 500, chunks=[("a" * 150, 150)], knowledge_limit=200)
+    assert result["knowledge_mode"] == "chunks"
+    assert result["knowledge_tokens"] <= 200
+
+
+def test_history_keeps_newest_turns_within_ratio():
+    history = [("q1", "a1", 100), ("q2", "a2", 100), ("q3", "a3", 100)]
+    result = plan(None, history=history, history_ratio=0.25)
+    assert result["history"] == [("q2", "a2"), ("q3", "a3")]
+    assert result["history_tokens"] == 2 * (100 + 2 * MESSAGE_OVERHEAD)
+
+
+def test_pack_chunks_budget_boundaries():
+    cost = 10 + MESSAGE_OVERHEAD
+    chunks = [("a", 10), ("b", 10)]
+    assert pack_chunks(chunks, 2 * cost) == (["a", "b"], 2 * cost)
+    assert pack_chunks(chunks, 2 * cost - 1) == (["a"], cost)
+    assert pack_chunks(chunks, cost - 1) == ([], 0)
+    assert pack_chunks([], 100) == ([], 0)
+
+
+def test_head_tail_slices_on_token_boundaries():
+    text = TokenizedText.from_text("中" * 20, ENCODING)
+    result = text.head_tail(10)
+    body = result.split("\n\n")[1]
+    assert body == "中" * 10  # 多字节字符不会被切开
@@ -0,0 +1,75 @@
+import mmap
+import os
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import corpus, expert_store  # noqa: E402
+from utils.corpus import MANIFEST_FILE, load_manifest, open_corpus  # noqa: E402
+from utils.expert_store import clear_fingerprints, index_dir  # noqa: E402
+
+PARAGRAPHS = ["# 估值", "自由现金流折现是估值的基础。", "## 护城河", "品牌和定价权构成护城河。"]
+
+
+@pytest.fixture
+def expert(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(expert_store.DATA_DIR, "alice"))
+    _write("alice", "notes.md", "\n\n".join(PARAGRAPHS))
+    yield "alice"
+    clear_fingerprints()
+
+
+def _write(name, filename, text):
+    with open(os.path.join(expert_store.DATA_DIR, name, filename), "w", encoding="utf-8") as f:
+        f.write(text)
+    clear_fingerprints()
+
+
+def test_open_corpus_maps_text_and_chunks(expert):
+    mapped = open_corpus(expert)
+    assert isinstance(mapped.data, mmap.mmap)
+    assert mapped.text() == "\n\n".join(PARAGRAPHS)
+    assert mapped.chunk_count == len(mapped.chunk_records()) > 0
+    assert len(mapped.chunk_bounds) == 2 * mapped.chunk_count
+    # 片段按字节范围从 mmap 里切出，内容与分块结果一致
+    for index, record in enumerate(mapped.chunk_records()):
+        assert (mapped.chunk_bounds[2 * index], mapped.chunk_bounds[2 * index + 1]) == \
+            (record["start"], record["end"])
+        assert mapped.chunk(index) == mapped.text().encode("utf-8")[
+            record["start"]:record["end"]].decode("utf-8")
+    assert "护城河" in "".join(mapped.chunk(i) for i in range(mapped.chunk_count))
+
+
+def test_rebuild_reuses_unchanged_extractions(expert, monkeypatch):
+    open_corpus(expert)
+    extracted = []
+    extract_text = corpus.extract_text
+
+    def counting(path):
+        extracted.append(os.path.basename(path))
+        return extract_text(path)
+    monkeypatch.setattr(corpus, "extract_text", counting)
+
+    # 资料没变：直接打开已有的语料
+    assert load_manifest(expert) is not None
+    open_corpus(expert)
+    assert extracted == []
+
+    # 新增一个文件：重建语料，只提取新文件
+    _write(expert, "more.txt", "周期股要在低谷买入。")
+    assert load_manifest(expert) is None
+    mapped = open_corpus(expert)
+    assert extracted == ["more.txt"]
+    assert "周期股" in mapped.text() and "护城河" in mapped.text()
+    assert os.path.exists(os.path.join(index_dir(expert), MANIFEST_FILE))
+
+
+def test_empty_expert_opens_empty_corpus(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(expert_store.DATA_DIR, "empty"))
+    clear_fingerprints()
+    mapped = open_corpus("empty")
+    assert mapped.text() == "" and mapped.chunk_count == 0
+    clear_fingerprints()
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import degradation  # noqa: E402
+from utils.degradation import plan_degradation, wait_for_quota  # noqa: E402
+
+TOKENS = 100  # 每位专家的预估提示词 tokens
+
+
+class Expert:
+    def __init__(self, name, cached=False):
+        self.name = name
+        self.cached = cached
+
+    def estimate_prompt_tokens(self, model_name):
+        return TOKENS
+
+    def cached_response(self, prompt, model_name, hits):
+        return "缓存的回答" if self.cached else None
+
+
+class Quota:
+    """每个模型剩余的 (请求数, tokens)，以及熔断和公平份额的状态"""
+
+    def __init__(self, monkeypatch, **available):
+        self.available = available
+        self.down = set()
+        self.share_eta = 0
+        self.eta = None
+        for name, value in {
+            "MODEL_REGISTRY": list(available),
+            "get_model_config": lambda model_name: {"label": model_name},
+            "calculate_conversation_quota": lambda num_experts: num_experts + 1,
+            "is_available": lambda model_name: model_name not in self.down,
+            "fair_share_eta": lambda *args: self.share_eta,
+            "available_quota": lambda model_name: self.available[model_name],
+            "check_quota": self.check,
+            "reserve_quota": self.reserve,
+            "quota_eta": lambda *args: self.eta,
+            "retrieve": lambda names, prompt: {},
+        }.items():
+            monkeypatch.setattr(degradation, name, value)
+
+    def check(self, model_name, required_quota=1, required_tokens=0):
+        requests, tokens = self.available[model_name]
+        return required_quota <= requests and required_tokens <= tokens
+
+    def reserve(self, model_name, required_quota):
+        requests, tokens = self.available[model_name]
+        if required_quota > requests:
+            return False
+        self.available[model_name] = (requests - required_quota, tokens)
+        return True
+
+
+EXPERTS = [Expert("a"), Expert("b"), Expert("c")]
+
+
+def _plan(experts=EXPERTS, model_name="m1"):
+    decision = plan_degradation(experts, "问题", model_name, session_id="s")
+    return decision["action"], decision["model"], [e.name for e in decision["experts"]]
+
+
+def test_proceed_when_quota_allows(monkeypatch):
+    quota = Quota(monkeypatch, m1=(10, 1000), m2=(10, 1000))
+    assert _plan() == ("proceed", "m1", ["a", "b", "c"])
+    assert quota.available["m1"] == (6, 1000)  # 三位专家加总结
+
+
+def test_switch_model_when_quota_exhausted(monkeypatch):
+    Quota(monkeypatch, m1=(0, 0), m2=(10, 1000))
+    assert _plan() == ("switch_model", "m2", ["a", "b", "c"])
+
+
+def test_switch_model_when_breaker_open(monkeypatch):
+    quota = Quota(monkeypatch, m1=(10, 1000), m2=(10, 1000))
+    quota.down.add("m1")
+    assert _plan() == ("switch_model", "m2", ["a", "b", "c"])
+    quota.down.add("m2")
+    assert _plan()[0] == "reject"
+
+
+def test_reduce_experts_keeps_top_ranked(monkeypatch):
+    Quota(monkeypatch, m1=(3, 250), m2=(0, 0))
+    # 三个请求：一个留给总结，剩下两个给排名靠前的专家
+    assert _plan() == ("reduce_experts", "m1", ["a", "b"])
+
+
+def test_cached_experts_do_not_use_quota(monkeypatch):
+    Quota(monkeypatch, m1=(1, 0), m2=(0, 0))
+    experts = [Expert("a"), Expert("b", cached=True), Expert("c", cached=True)]
+    assert _plan(experts) == ("cache", "m1", ["b", "c"])
+
+
+def test_queue_then_reject(monkeypatch):
+    quota = Quota(monkeypatch, m1=(0, 0), m2=(0, 0))
+    quota.eta = 10
+    assert _plan()[0] == "queue"
+    quota.eta = degradation.QUEUE_MAX_SECONDS + 1
+    assert _plan() == ("reject", "m1", [])
+    quota.eta = None
+    assert _plan()[0] == "reject"
+
+
+def test_fair_share_queues_before_ladder(monkeypatch):
+    quota = Quota(monkeypatch, m1=(10, 1000), m2=(10, 1000))
+    quota.share_eta = 5
+    assert _plan() == ("queue", "m1", ["a", "b", "c"])
+    quota.share_eta = degradation.QUEUE_MAX_SECONDS + 1
+    assert _plan() == ("reject", "m1", [])
+    assert quota.available["m1"] == (10, 1000)  # 没有预留配额
+
+
+def test_wait_for_quota(monkeypatch):
+    quota = Quota(monkeypatch, m1=(2, 1000))
+    asyncio.run(wait_for_quota("m1", 2, 100, session_id="s"))
+    assert quota.available["m1"] == (0, 1000)
+    with pytest.raises(TimeoutError):
+        asyncio.run(wait_for_quota("m1", 1, 100, timeout=0))
@@ -0,0 +1,54 @@
+import zipfile
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import extractors  # noqa: E402
+from utils.extractors import (EXTRACT_OPTIONS, configure_extractors, extract_text,  # noqa: E402
+                              get_extractor, register_extractor)
+
+DOCX_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+  <w:body>
+    <w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr><w:r><w:t>护城河</w:t></w:r></w:p>
+    <w:p><w:r><w:t>品牌和</w:t></w:r><w:r><w:t>定价权。</w:t></w:r></w:p>
+    <w:p><w:r><w:t>  </w:t></w:r></w:p>
+  </w:body>
+</w:document>"""
+
+
+def test_extract_by_extension(tmp_path):
+    (tmp_path / "notes.md").write_text("# 标题\n\n正文", encoding="utf-8")
+    (tmp_path / "page.HTML").write_text(
+        "<html><head><title>忽略</title></head><body><h1>估值</h1><p>现金流</p></body></html>",
+        encoding="utf-8")
+    with zipfile.ZipFile(tmp_path / "doc.docx", "w") as archive:
+        archive.writestr("word/document.xml", DOCX_XML)
+
+    assert extract_text(str(tmp_path / "notes.md")) == "# 标题\n\n正文"
+    assert extract_text(str(tmp_path / "page.HTML")) == "# 估值\n\n现金流"
+    assert extract_text(str(tmp_path / "doc.docx")) == "## 护城河\n\n品牌和定价权。"
+
+
+def test_unsupported_and_broken_files_return_empty(tmp_path):
+    (tmp_path / "data.xyz").write_text("内容", encoding="utf-8")
+    (tmp_path / "broken.docx").write_bytes(b"not a zip")
+    assert get_extractor("data.xyz") is None
+    assert extract_text(str(tmp_path / "data.xyz")) == ""
+    assert extract_text(str(tmp_path / "broken.docx")) == ""
+    assert extract_text(str(tmp_path / "missing.txt")) == ""
+
+
+def test_register_extractor(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractors, "EXTRACTORS", dict(extractors.EXTRACTORS))
+    register_extractor(".CSV", lambda path: "表格")
+    (tmp_path / "table.csv").write_text("a,b", encoding="utf-8")
+    assert extract_text(str(tmp_path / "table.csv")) == "表格"
+
+
+def test_configure_extractors(monkeypatch):
+    monkeypatch.setattr(extractors, "EXTRACT_OPTIONS", dict(EXTRACT_OPTIONS))
+    configure_extractors({"ocr_enabled": True, "epub_workers": 3})
+    assert extractors.EXTRACT_OPTIONS["ocr_enabled"] is True
+    assert extractors.EXTRACT_OPTIONS["epub_workers"] == 3
@@ -0,0 +1,65 @@
+import zipfile
+
+import pytest
+
+from utils import html_text
+from utils.html_text import epub_chapters, epub_to_text, html_to_text
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <manifest>
+    <item id="c1" href="text/ch1.xhtml" media-type="application/xhtml+xml"/>
+    <item id="c2" href="text/ch%202.xhtml" media-type="application/xhtml+xml"/>
+    <item id="css" href="style.css" media-type="text/css"/>
+  </manifest>
+  <spine>{spine}</spine>
+</package>"""
+
+
+def _epub(path, spine='<itemref idref="c2"/><itemref idref="c1"/>'):
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("META-INF/container.xml", CONTAINER)
+        archive.writestr("OEBPS/content.opf", OPF.format(spine=spine))
+        archive.writestr("OEBPS/text/ch1.xhtml", "<html><body><h1>第一章</h1><p>护城河</p></body></html>")
+        archive.writestr("OEBPS/text/ch 2.xhtml", "<html><body><h2>第二章</h2><p>估值</p></body></html>")
+        archive.writestr("OEBPS/style.css", "p { color: red; }")
+    return str(path)
+
+
+def test_html_to_text_keeps_structure():
+    html = ("<html><head><style>p {}</style></head><body>"
+            "<h2>标题 <em>一</em></h2><p>第一段\n  换行</p><div>第二段<br/>下一行</div>"
+            "<script>alert(1)</script><p>&amp; 实体</p></body></html>")
+    assert html_to_text(html) == "## 标题 一\n\n第一段 换行\n\n第二段\n\n下一行\n\n& 实体"
+    assert html_to_text("<p>字节</p>".encode("utf-8")) == "字节"
+    assert html_to_text("") == ""
+
+
+def test_epub_chapters_follow_spine(tmp_path):
+    chapters = epub_chapters(_epub(tmp_path / "book.epub"))
+    assert [html_to_text(c).splitlines()[0] for c in chapters] == ["## 第二章", "# 第一章"]
+
+
+def test_epub_without_spine_uses_manifest_order(tmp_path):
+    text = epub_to_text(_epub(tmp_path / "book.epub", spine=""))
+    assert text == "# 第一章\n\n护城河\n\n## 第二章\n\n估值"
+
+
+def test_parallel_epub_matches_serial(tmp_path, monkeypatch):
+    path = _epub(tmp_path / "book.epub")
+    serial = epub_to_text(path)
+    monkeypatch.setattr(html_text, "PARALLEL_MIN_BYTES", 0)
+    assert epub_to_text(path, workers=2) == serial
+
+
+def test_broken_epub_raises(tmp_path):
+    path = tmp_path / "broken.epub"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+    with pytest.raises(KeyError):
+        epub_to_text(str(path))
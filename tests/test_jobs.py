@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import jobs  # noqa: E402
+from utils.jobs import JobManager  # noqa: E402
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_concurrent_jobs=1)
+    yield manager
+    manager.loop.call_soon_threadsafe(manager.loop.stop)
+    manager.thread.join(timeout=5)
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "等待超时"
+        time.sleep(0.01)
+
+
+def test_job_records_events_and_deltas(manager):
+    async def stream():
+        yield {"role": "buffett", "delta": "护城"}
+        yield {"role": "buffett", "delta": "河"}
+        yield {"role": "buffett", "content": "护城河"}
+
+    job = manager.get(manager.submit(stream, session_id="s1"))
+    _wait_for(lambda: job.finished)
+    assert job.status == "done" and job.error is None
+    assert job.events == [{"role": "buffett", "content": "护城河"}]
+    assert job.deltas_since("buffett", 0, 1) == (0, ["河"])
+    assert job.started_at <= job.finished_at
+
+
+def test_failed_job_reports_error(manager):
+    async def stream():
+        yield {"role": "buffett", "content": "开始"}
+        raise ValueError("模型出错")
+
+    job = manager.get(manager.submit(stream))
+    _wait_for(lambda: job.finished)
+    assert job.status == "error" and job.error == "模型出错"
+    assert len(job.events) == 1
+
+
+def test_jobs_wait_for_a_free_slot_and_can_be_cancelled(manager):
+    release = threading.Event()
+
+    async def blocking():
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+        yield {"role": "a", "content": "完成"}
+
+    first = manager.get(manager.submit(blocking))
+    _wait_for(lambda: first.status == "running")
+    second = manager.get(manager.submit(blocking))
+    time.sleep(0.05)
+    assert second.status == "queued"  # 只有一个并发名额
+
+    # 取消事件循环里所有任务：排队和运行中的任务都结束为 cancelled，页面不会一直轮询
+    manager.run_coroutine(_cancel_others()).result(timeout=5)
+    _wait_for(lambda: first.finished and second.finished)
+    assert first.status == second.status == "cancelled"
+
+
+async def _cancel_others():
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+
+
+def test_cleanup_drops_expired_jobs(manager, monkeypatch):
+    async def stream():
+        yield {"role": "a", "content": "完成"}
+
+    job_id = manager.submit(stream)
+    _wait_for(lambda: manager.get(job_id).finished)
+    manager.cleanup()
+    assert manager.get(job_id) is not None
+    monkeypatch.setattr(jobs, "JOB_TTL_SECONDS", -1)
+    manager.cleanup()
+    assert manager.get(job_id) is None
@@ -0,0 +1,107 @@
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils.markdown_render import IncrementalMarkdown, render_markdown  # noqa: E402
+
+SAMPLE = """# 投资原则
+
+**安全边际**很重要，*长期*持有。
+第二行要点
+
+- 第一项
+- 第二项
+  续行
+1. 有序项
+
+> 引用的话
+
+| 公司 | 市盈率 |
+| --- | ---: |
+| A | 12 |
+
+```python
+def f():
+
+    return 1 < 2
+```
+
+---
+参考 [链接](https://example.com) 和 `code <b>`
+"""
+
+
+def _stream(text, step):
+    renderer = IncrementalMarkdown(fps=0)
+    frames = []
+    for i in range(0, len(text), step):
+        renderer.feed(text[i:i + step])
+        frames.append(renderer.html())
+    return renderer, frames
+
+
+@pytest.mark.parametrize("step", [1, 3, 7, 50, len(SAMPLE)])
+def test_incremental_matches_full_render(step):
+    renderer, frames = _stream(SAMPLE, step)
+    full = render_markdown(SAMPLE)
+    assert renderer.finish() == full
+    # 最后一帧（不含未结束的行）已经和完整渲染一致
+    assert frames[-1] == full
+
+
+def test_incremental_frames_only_grow_closed_blocks():
+    renderer, _ = _stream(SAMPLE, 5)
+    closed = renderer._closed
+    renderer.feed("\n\n新的一段")
+    assert renderer.html().startswith(closed)
+
+
+def test_finish_rerenders_different_text():
+    renderer, _ = _stream("旧的内容", 2)
+    assert renderer.finish("# 缓存的回应") == render_markdown("# 缓存的回应")
+
+
+def test_html_is_escaped():
+    html = render_markdown('<script>alert("x")</script> & <img src=x onerror=1>')
+    assert "<script>" not in html and "<img" not in html
+    assert "&lt;script&gt;" in html and "&amp;" in html
+
+
+def test_escaped_inside_code():
+    html = render_markdown("```\n<div>\n```\n\n`<span>`")
+    assert "&lt;div&gt;" in html and "<code>&lt;span&gt;</code>" in html
+
+
+def test_unclosed_fence_renders_as_code():
+    renderer = IncrementalMarkdown(fps=0)
+    renderer.feed("前言\n\n```\nx = 1\n# 不是标题\n")
+    html = renderer.html()
+    assert html.endswith("<pre><code>x = 1&#10;# 不是标题</code></pre>")
+    assert "<h1>" not in html
+    assert renderer.finish() == html
+
+
+def test_code_block_has_no_blank_lines():
+    # 代码块里的空行写成字符引用，不会截断外层的 HTML 块
+    html = render_markdown("```\na\n\nb\n```")
+    assert "\n" not in html
+
+
+def test_javascript_links_are_not_linked():
+    html = render_markdown("[点我](javascript:alert(1)) [数据](data:text/html,x)")
+    assert "<a" not in html and "href" not in html
+
+
+def test_http_links_are_linked():
+    html = render_markdown("[来源](https://example.com/a?b=1&c=2)")
+    assert '<a href="https://example.com/a?b=1&amp;c=2" target="_blank">来源</a>' in html
+
+
+def test_frame_rate_limit():
+    renderer = IncrementalMarkdown(fps=10)
+    renderer.feed("a")
+    assert renderer.frame(now=1.0) is not None
+    renderer.feed("b")
+    assert renderer.frame(now=1.05) is None  # 间隔不足
+    assert renderer.frame(now=1.2) is not None
+    assert renderer.frame(now=2.0) is None  # 没有新内容
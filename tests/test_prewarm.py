@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import prewarm as prewarm_module  # noqa: E402
+from utils.prewarm import Prewarmer  # noqa: E402
+
+EXPERTS = [SimpleNamespace(name=name) for name in ["a", "b", "c", "d"]]
+
+
+class Manager:
+    """只记录提交的协程，不运行"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def run_coroutine(self, coro):
+        coro.close()
+        self.submitted.append(coro)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = Manager()
+    monkeypatch.setattr(prewarm_module, "get_job_manager", lambda: manager)
+    monkeypatch.setattr(prewarm_module, "PREWARM_ENABLED", True)
+    return manager
+
+
+def _names(experts):
+    return [expert.name for expert in experts]
+
+
+def test_pick_prefers_requested_then_most_used():
+    prewarmer = Prewarmer()
+    assert _names(prewarmer.pick(EXPERTS, 2)) == ["a", "b"]  # 没有记录时保持原有顺序
+    prewarmer.record_use([EXPERTS[2]])
+    prewarmer.record_use([EXPERTS[2], EXPERTS[3]])
+    assert _names(prewarmer.pick(EXPERTS, 2)) == ["c", "d"]
+    assert _names(prewarmer.pick(EXPERTS, 2, preferred=["b"])) == ["b", "c"]
+    assert _names(prewarmer.pick(EXPERTS, 10)) == ["c", "d", "a", "b"]
+
+
+def test_request_deduplicates_within_ttl(manager):
+    prewarmer = Prewarmer(ttl=300)
+    assert prewarmer.request(EXPERTS, "m", limit=2)
+    assert not prewarmer.request(EXPERTS, "m", limit=2)
+    assert prewarmer.request(EXPERTS, "other-model", limit=2)
+    assert prewarmer.request(EXPERTS, "m")  # 全部专家是另一个阵容
+    assert not prewarmer.request(list(reversed(EXPERTS)), "m")  # 顺序不同也是同一阵容
+    assert len(manager.submitted) == 3
+
+
+def test_request_after_ttl_and_when_disabled(manager, monkeypatch):
+    prewarmer = Prewarmer(ttl=0)
+    assert prewarmer.request(EXPERTS, "m", limit=1)
+    assert prewarmer.request(EXPERTS, "m", limit=1)
+    monkeypatch.setattr(prewarm_module, "PREWARM_ENABLED", False)
+    assert not prewarmer.request(EXPERTS, "m", limit=1)
+    assert len(manager.submitted) == 2
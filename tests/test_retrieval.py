@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("numpy")
+
+from utils import expert_store, vector_index  # noqa: E402
+from utils.expert_store import LRUByteCache, clear_fingerprints, index_dir  # noqa: E402
+from utils.retrieval import retrieve  # noqa: E402
+
+NOTES = {
+    "alice": ["护城河来自品牌和定价权。", "估值要看自由现金流。", "周期股要在低谷买入。"],
+    "bob": ["债务结构决定风险。", "分红稳定的公司适合长期持有。"],
+}
+
+
+@pytest.fixture
+def experts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(vector_index, "background_cache", LRUByteCache(1 << 30))
+    for name, paragraphs in NOTES.items():
+        os.makedirs(os.path.join(expert_store.DATA_DIR, name))
+        with open(os.path.join(expert_store.DATA_DIR, name, "notes.md"), "w",
+                  encoding="utf-8") as f:
+            f.write("\n\n".join(paragraphs))
+    clear_fingerprints()
+    yield
+    clear_fingerprints()
+
+
+def test_retrieve_only_opens_routed_experts(experts):
+    hits = retrieve(["alice"], "护城河和定价权")
+    assert list(hits) == ["alice"]
+    # 没被路由选中的专家不建索引也不加载
+    assert not os.path.exists(os.path.join(index_dir("bob"), vector_index.VECTOR_MANIFEST_FILE))
+
+    with open(os.path.join(index_dir("alice"), "corpus.txt"), "rb") as f:
+        data = f.read()
+    start, end, score = hits["alice"][0]
+    assert "护城河" in data[start:end].decode("utf-8")
+    assert [s for _, _, s in hits["alice"]] == sorted((s for _, _, s in hits["alice"]),
+                                                       reverse=True)
+
+
+def test_retrieve_skips_experts_without_sources(experts):
+    hits = retrieve(["alice", "bob", "nobody"], "分红", k=1)
+    assert set(hits) == {"alice", "bob"}
+    assert all(len(expert_hits) == 1 for expert_hits in hits.values())
+    assert retrieve([], "分红") == {}
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import router  # noqa: E402
+from utils.router import ExpertRouter, build_profile, select_experts, tokenize_terms  # noqa: E402
+
+TEXTS = {
+    "buffett": "护城河 品牌 定价权 长期持有 moat brand pricing power " * 5,
+    "soros": "反身性 宏观 汇率 货币 reflexivity macro currency " * 5,
+    "lynch": "成长股 零售 调研 growth retail stocks " * 5,
+}
+EXPERTS = [SimpleNamespace(name=name) for name in TEXTS]
+
+
+@pytest.fixture(autouse=True)
+def profiles(monkeypatch):
+    monkeypatch.setattr(router, "get_profile", lambda expert: build_profile(TEXTS[expert.name]))
+
+
+def test_tokenize_terms():
+    assert tokenize_terms("The Moat of 护城河") == ["moat", "护城", "城河"]
+
+
+def test_router_scores_relevant_expert_highest():
+    scores = ExpertRouter({name: build_profile(text) for name, text in TEXTS.items()}).score(
+        "汇率和货币怎么看")
+    assert max(scores, key=scores.get) == "soros"
+
+
+def test_select_top_k():
+    selected = select_experts(EXPERTS, "这家公司的护城河和定价权", top_k=1)
+    assert [e.name for e in selected] == ["buffett"]
+    # 没有命中任何专家时按原有顺序
+    assert [e.name for e in select_experts(EXPERTS, "天气", top_k=2)] == ["buffett", "soros"]
+
+
+def test_select_all_or_forced():
+    assert select_experts(EXPERTS, "护城河", top_k=None) == EXPERTS
+    assert select_experts(EXPERTS, "护城河", top_k=5) == EXPERTS
+    forced = select_experts(EXPERTS, "护城河", top_k=1, forced=["lynch", "soros"])
+    assert [e.name for e in forced] == ["soros", "lynch"]
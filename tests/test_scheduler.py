@@ -0,0 +1,184 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils import scheduler as scheduler_module  # noqa: E402
+from utils.scheduler import MIN_SESSION_WEIGHT, FairScheduler, session_weight  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def _grant_order(scheduler, holder, requests):
+    """holder 占着唯一的名额时让 requests [(会话, tokens[, 权重])] 依次排队，再逐个释放名额，返回拿到名额的顺序"""
+    order = []
+
+    async def request(session_id, tokens, weight=1.0):
+        await scheduler.acquire(session_id, tokens, weight)
+        order.append(session_id)
+
+    tasks = []
+    for args in requests:
+        tasks.append(asyncio.ensure_future(request(*args)))
+        await asyncio.sleep(0)  # 按提交顺序入队
+    current = holder
+    while len(order) < len(requests):
+        scheduler.release(current)
+        await asyncio.sleep(0)
+        current = order[-1]
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_idle_sessions_overtake_busy_session():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("a", 100)  # a 占着唯一的名额
+        order = await _grant_order(
+            scheduler, "a", [("a", 100), ("a", 100), ("a", 100), ("b", 100), ("c", 100)])
+        return order
+
+    # a 已经占着名额又连续排了三个请求，后来的 b、c 虚拟完成时间更早，插到 a 的所有排队请求前面
+    assert run(scenario()) == ["b", "c", "a", "a", "a"]
+
+
+def test_backlogged_sessions_alternate():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("x", 1)
+        return await _grant_order(
+            scheduler, "x", [("a", 100), ("a", 100), ("a", 100), ("b", 100), ("b", 100)])
+
+    # 两个会话都有积压时按虚拟完成时间轮流拿到名额
+    assert run(scenario()) == ["a", "b", "a", "b", "a"]
+
+
+def test_larger_requests_finish_later():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("x", 1)
+        return await _grant_order(scheduler, "x", [("big", 1000), ("small", 10)])
+
+    assert run(scenario()) == ["small", "big"]
+
+
+def test_free_slots_are_granted_immediately():
+    async def scenario():
+        scheduler = FairScheduler(slots=2)
+        await scheduler.acquire("a", 10)
+        await scheduler.acquire("a", 10)
+        waiter = asyncio.ensure_future(scheduler.acquire("b", 10))
+        await asyncio.sleep(0)
+        queued = scheduler.session_stats("b")["queued"]
+        scheduler.release("a")
+        await waiter
+        return queued, scheduler.session_stats("b")["running"]
+
+    assert run(scenario()) == (1, 1)
+
+
+def test_cancelled_waiter_is_skipped():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("a", 10)
+        cancelled = asyncio.ensure_future(scheduler.acquire("b", 10))
+        waiting = asyncio.ensure_future(scheduler.acquire("c", 20))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        scheduler.release("a")
+        await waiting
+        return scheduler.session_stats("b"), scheduler.session_stats("c")
+
+    b, c = run(scenario())
+    assert (b["running"], b["queued"]) == (0, 0)
+    assert c["running"] == 1
+
+
+def test_higher_weight_gets_more_turns():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("x", 1)
+        return await _grant_order(
+            scheduler, "x", [("a", 100, 0.5), ("a", 100, 0.5), ("b", 100), ("b", 100),
+                             ("b", 100), ("b", 100)])
+
+    # a 的预算用掉了一半，每个请求的虚拟耗时翻倍，b 每轮可以走两个请求
+    assert run(scenario()) == ["b", "a", "b", "b", "a", "b"]
+
+
+def test_cancelled_waiter_rolls_back_finish_time():
+    async def scenario():
+        scheduler = FairScheduler(slots=1)
+        await scheduler.acquire("a", 10)
+        before = scheduler._finish.get("b", 0.0)
+        cancelled = asyncio.ensure_future(scheduler.acquire("b", 1000))
+        await asyncio.sleep(0)
+        queued_finish = scheduler._finish["b"]
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        return before, queued_finish, scheduler._finish["b"]
+
+    before, queued_finish, after = run(scenario())
+    assert queued_finish == before + 1000
+    # 取消的请求不再推迟 b 之后的请求
+    assert after == before
+
+
+def test_session_weight_follows_remaining_budget(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "session_limits", lambda model_name: (10, 1000))
+    usage = {"rpm": 0, "tpm": 0}
+    monkeypatch.setattr(scheduler_module, "get_session_usage", lambda session_id: usage)
+    assert session_weight("a", "m") == 1.0
+    usage.update(rpm=2, tpm=500)
+    assert session_weight("a", "m") == 0.5
+    usage.update(rpm=12, tpm=500)
+    assert session_weight("a", "m") == MIN_SESSION_WEIGHT
+    assert session_weight(None, "m") == 1.0
+
+
+def test_acquire_does_not_charge_usage(monkeypatch):
+    charged = []
+    monkeypatch.setattr(scheduler_module, "record_session_usage",
+                        lambda *args: charged.append(args))
+    scheduler = FairScheduler(slots=1)
+    run(scheduler.acquire("a", 10))
+    scheduler.release("a")
+    assert charged == []
+    scheduler.record_usage("a", 10)
+    scheduler.record_usage(None, 5)
+    assert charged == [("a", 1, 10), (scheduler_module.ANONYMOUS_SESSION, 1, 5)]
+
+
+def test_session_stats_from_another_thread(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "get_session_usage", lambda session_id: {})
+    scheduler = FairScheduler(slots=4)
+    stop = threading.Event()
+    errors = []
+
+    def read_stats():
+        while not stop.is_set():
+            try:
+                scheduler.session_stats("a")
+            except Exception as e:  # 迭代时字典被修改等
+                errors.append(e)
+
+    reader = threading.Thread(target=read_stats)
+    reader.start()
+
+    async def churn():
+        for i in range(2000):
+            session_id = f"s{i % 50}"
+            await scheduler.acquire(session_id, 10)
+            scheduler.release(session_id)
+
+    try:
+        run(churn())
+    finally:
+        stop.set()
+        reader.join()
+    assert errors == []
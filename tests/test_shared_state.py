@@ -0,0 +1,85 @@
+import multiprocessing
+import queue
+import threading
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from utils.shared_state import MemoryBackend, SQLiteBackend  # noqa: E402
+
+LIMIT = 10
+
+
+def _grab(path, attempts, results):
+    # 每个进程/线程自己打开后端，和多个 Streamlit 进程共用一个数据库文件一样
+    backend = SQLiteBackend(path)
+    results.put(sum(backend.try_add("rpm", 1, LIMIT, 60) is not None
+                    for _ in range(attempts)))
+
+
+def test_try_add_respects_limit(tmp_path):
+    for backend in (MemoryBackend(), SQLiteBackend(str(tmp_path / "state.db"))):
+        ids = [backend.try_add("rpm", 3, LIMIT, 60) for _ in range(4)]
+        assert all(ids[:3]) and ids[3] is None
+        # 一个事件被删除后又有空间
+        backend.remove_event("rpm", ids[0])
+        assert backend.try_add("rpm", 3, LIMIT, 60) is not None
+
+
+def test_try_add_is_atomic_across_threads(tmp_path):
+    path = str(tmp_path / "state.db")
+    SQLiteBackend(path)  # 先建表
+    results = queue.Queue()
+    threads = [threading.Thread(target=_grab, args=(path, 5, results)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(results.get() for _ in threads) == LIMIT
+    assert sum(w for _, w in SQLiteBackend(path).window("rpm", 60)) == LIMIT
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(),
+                    reason="需要 fork 启动子进程")
+def test_try_add_is_atomic_across_processes(tmp_path):
+    path = str(tmp_path / "state.db")
+    SQLiteBackend(path)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=_grab, args=(path, 5, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    granted = sum(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join()
+    assert granted == LIMIT
+    assert len(SQLiteBackend(path).window("rpm", 60)) == LIMIT
+
+
+def test_try_add_ignores_expired_events(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "state.db"))
+    backend.add_event("rpm", LIMIT, ts=1.0)  # 早已过期
+    assert backend.try_add("rpm", 1, LIMIT, 60) is not None
+
+
+def test_memory_backend_prunes_on_write():
+    backend = MemoryBackend()
+    backend.window("session:a", 60)  # 记住这个键的窗口
+    backend.add_event("session:a", 1, ts=1.0)
+    backend.add_event("session:a", 1)
+    # 写入时就删掉窗口外的事件，不必等下一次读取
+    assert len(backend._events["session:a"]) == 1
+
+
+def test_memory_backend_sweeps_idle_keys_and_expired_cache():
+    backend = MemoryBackend()
+    backend.window("session:ended", 60)
+    backend.add_event("session:ended", 1, ts=1.0)
+    backend.add_event("never-read", 1, ts=1.0)  # 没读取过的键按默认保留时长清理
+    backend.cache_set("response:old", "回答", -1)
+    backend._last_sweep = 0  # 让下一次写入做一次清理
+    backend.cache_set("response:new", "回答", 60)
+    assert set(backend._events) == set()
+    assert set(backend._cache) == {"response:new"}
+    assert backend.cache_get("response:new") == "回答"
@@ -0,0 +1,135 @@
+import os
+import random
+
+import pytest
+
+pytest.importorskip("streamlit")
+np = pytest.importorskip("numpy")
+
+from utils import expert_store, vector_index  # noqa: E402
+from utils.expert_store import LRUByteCache, clear_fingerprints, index_dir  # noqa: E402
+from utils.vector_index import (VectorIndex, build_vector_index, embed_texts,  # noqa: E402
+                                get_vector_index, load_vector_manifest)
+
+WORDS = ["moat", "valuation", "margin", "growth", "dividend", "cash", "debt", "brand",
+         "pricing", "capital", "return", "risk", "cycle", "supply", "demand", "护城河",
+         "估值", "现金流", "周期", "品牌"]
+
+
+def _paragraph(rng, words=40):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _corpus(count, seed=0):
+    """count 个随机段落，返回 (语料字节, 分块结果)"""
+    rng = random.Random(seed)
+    data, chunks = b"", []
+    for i in range(count):
+        text = _paragraph(rng).encode("utf-8")
+        chunks.append({"id": f"c{i}", "start": len(data), "end": len(data) + len(text)})
+        data += text + b"\n\n"
+    return data, chunks
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """在临时目录里放一位专家的资料，并换一个空的 LRU 缓存"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(vector_index, "background_cache", LRUByteCache(1 << 30))
+    os.makedirs(os.path.join(expert_store.DATA_DIR, "alice"))
+    rng = random.Random(1)
+    _write_notes("alice", [_paragraph(rng, 200) for _ in range(6)])
+    yield tmp_path
+    clear_fingerprints()
+
+
+def _write_notes(name, paragraphs, mtime=None):
+    path = os.path.join(expert_store.DATA_DIR, name, "notes.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(paragraphs))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    clear_fingerprints()
+
+
+def _counting_embedder(monkeypatch):
+    embedded = []
+
+    def embed(texts, dim):
+        embedded.extend(texts)
+        return vector_index.hashed_embed(texts, dim)
+    monkeypatch.setitem(vector_index.EMBEDDERS, vector_index.EMBEDDER, embed)
+    return embedded
+
+
+def test_rebuild_only_when_sources_change(data_dir, monkeypatch):
+    embedded = _counting_embedder(monkeypatch)
+    index = get_vector_index("alice")
+    first = len(embedded)
+    assert first == len(index.ids) > 0
+
+    # 资料没变：沿用磁盘上的索引，不重新嵌入
+    monkeypatch.setattr(vector_index, "background_cache", LRUByteCache(1 << 30))
+    assert get_vector_index("alice").ids == index.ids
+    assert len(embedded) == first
+
+    # 追加一段资料：指纹变化后重建，只嵌入新增的片段
+    with open(os.path.join(expert_store.DATA_DIR, "alice", "notes.md"), "a",
+              encoding="utf-8") as f:
+        f.write("\n\n" + _paragraph(random.Random(2), 200))
+    clear_fingerprints()
+    rebuilt = get_vector_index("alice")
+    assert rebuilt.source != index.source
+    assert len(rebuilt.ids) > len(index.ids)
+    assert 0 < len(embedded) - first < len(rebuilt.ids)
+
+
+def test_manifest_written_atomically(data_dir):
+    get_vector_index("alice")
+    leftovers = [f for f in os.listdir(index_dir("alice")) if f.endswith(".tmp")]
+    assert leftovers == []
+    assert load_vector_manifest("alice")["ids"]
+
+
+def test_ivf_matches_exact_scan(data_dir, monkeypatch):
+    monkeypatch.setattr(vector_index, "IVF_MIN_CHUNKS", 50)
+    os.makedirs(index_dir("bob"))
+    data, chunks = _corpus(200)
+    manifest = build_vector_index("bob", data, chunks)
+    assert manifest["ivf"]["clusters"] == 14
+
+    index = VectorIndex("bob")
+    exact = np.asarray(index.vectors)
+    for question in ["moat pricing brand", "估值 现金流 周期", "debt risk cycle"]:
+        query_vector = embed_texts([question])[0]
+        scores = exact @ query_vector
+        expected = sorted(scores, reverse=True)[:5]
+        # 扫描全部簇时与全量点积的结果一致
+        full = index.search_vector(query_vector, k=5, probes=len(index.centroids))
+        assert [score for _, score in full] == pytest.approx(expected)
+        assert all(scores[row] == pytest.approx(score) for row, score in full)
+        # 默认只扫最近的几个簇，结果不会超过全量扫描
+        probed = index.search_vector(query_vector, k=5)
+        assert len(probed) == 5 and probed[0][1] <= expected[0] + 1e-6
+
+    # 片段自身的文本一定能在所在的簇里找到自己
+    text = data[chunks[17]["start"]:chunks[17]["end"]].decode("utf-8")
+    assert index.search(text, k=1)[0][0] == 17
+
+
+def test_index_is_memory_mapped_and_reloaded(data_dir):
+    index = get_vector_index("alice")
+    assert isinstance(index.vectors, np.memmap)
+    assert not index.vectors.flags.writeable
+    assert get_vector_index("alice") is index  # 资料没变时复用缓存里的映射
+
+    rng = random.Random(3)
+    _write_notes("alice", [_paragraph(rng, 200) for _ in range(3)], mtime=1_000_000)
+    reloaded = get_vector_index("alice")
+    assert reloaded is not index
+    assert reloaded.source == expert_store.source_fingerprint("alice")
+    assert isinstance(reloaded.vectors, np.memmap)
+    assert len(reloaded.vectors) == len(reloaded.ids)
+    # 旧的映射仍然可以读取（文件是整体替换的，不是原地改写）
+    assert index.vectors.shape[0] == len(index.ids)
+    float(index.vectors[0] @ index.vectors[0])
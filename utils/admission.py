@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+
+from utils.models import get_model_config
+from utils.shared_state import get_backend
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+MAX_QUEUE_SECONDS = 90  # 排队等待 token 配额的最长时间
+MIN_KNOWLEDGE_TOKENS = 8000  # 降级时知识库至少保留的 tokens，低于此值改为排队
+
+
+class TpmExhausted(Exception):
+    """在最长排队时间内仍拿不到 token 配额"""
+
+
+def tpm_key(model_name):
+    """共享状态中记录 token 预留的键"""
+    return f"tpm:{model_name}"
+
+
+class TpmAdmission:
+    """按模型的每分钟 token 预算（保存在共享状态后端），请求发出前先预留，完成后按实际用量结算"""
+
+    def __init__(self, window_seconds=WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+
+    def _window(self, model_name):
+        return get_backend().window(tpm_key(model_name), self.window_seconds)
+
+    def available(self, model_name):
+        """当前窗口内剩余的 tokens"""
+        used = sum(tokens for _, tokens in self._window(model_name))
+        return get_model_config(model_name)["tpm"] - used
+
+    def try_reserve(self, model_name, tokens):
+        """尝试预留 tokens，成功返回预留记录，否则返回 None"""
+        key = tpm_key(model_name)
+        event_id = get_backend().try_add(
+            key, tokens, get_model_config(model_name)["tpm"], self.window_seconds)
+        if event_id is None:
+            return None
+        return key, event_id
+
+    def wait_time(self, model_name, tokens):
+        """估算要等多少秒才能腾出足够的 tokens"""
+        now = time.time()
+        entries = self._window(model_name)
+        limit = get_model_config(model_name)["tpm"]
+        used = sum(t for _, t in entries)
+        wait = 0
+        for ts, t in entries:
+            if used + tokens <= limit:
+                return wait
+            used -= t
+            wait = max(0, ts + self.window_seconds - now)
+        return wait if used + tokens <= limit else self.window_seconds
+
+    def settle(self, reservation, actual_tokens):
+        """按实际用量修正预留"""
+        if reservation is not None and actual_tokens:
+            get_backend().update_event(*reservation, actual_tokens)
+
+    def release(self, model_name, reservation):
+        """请求没有发出时归还预留"""
+        if reservation is not None:
+            get_backend().remove_event(*reservation)
+
+    def saturate(self, model_name):
+        """服务商返回 429 时占满剩余窗口，让并发请求排队而不是继续撞限流"""
+        remaining = self.available(model_name)
+        if remaining > 0:
+            get_backend().add_event(tpm_key(model_name), remaining)
+        logger.warning(f"模型 {model_name} 触发限流，本窗口剩余 token 配额已冻结")
+
+    async def admit(self, model_name, tokens, fixed_tokens=None):
+        """
+        为一次请求申请 token 配额
+
+        tokens: 预计输入 tokens（来自缓存的计数）
+        fixed_tokens: 不能压缩的部分（人设+历史+问题），其余是知识库，可降级
+        返回 (预留记录, 知识库 token 上限或 None)
+        """
+        deadline = time.time() + MAX_QUEUE_SECONDS
+        while True:
+            reservation = self.try_reserve(model_name, tokens)
+            if reservation is not None:
+                return reservation, None
+
+            # 降级：缩小知识库/检索预算以适应剩余的 token 配额
+            if fixed_tokens is not None:
+                knowledge_limit = self.available(model_name) - fixed_tokens
+                if knowledge_limit >= MIN_KNOWLEDGE_TOKENS:
+                    reservation = self.try_reserve(
+                        model_name, fixed_tokens + knowledge_limit)
+                    if reservation is not None:
+                        logger.info(f"token 配额不足，知识库降级为 {knowledge_limit} tokens "
+                                    f"(原预计 {tokens - fixed_tokens})")
+                        return reservation, knowledge_limit
+
+            # 排队：等待窗口中旧的预留过期
+            wait = max(0.5, self.wait_time(model_name, tokens))
+            if time.time() + wait > deadline:
+                raise TpmExhausted(
+                    f"模型 {model_name} 的每分钟 token 配额不足，"
+                    f"需要 {tokens} tokens，请稍后再试")
+            logger.info(f"token 配额不足，排队 {wait:.1f} 秒 (需要 {tokens} tokens)")
+            await asyncio.sleep(wait)
+
+
+# 创建全局 token 准入控制实例
+tpm_admission = TpmAdmission()
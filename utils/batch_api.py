@@ -0,0 +1,306 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import requests
+import streamlit as st
+
+from utils.models import PROVIDERS, get_model_config
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 批量接口按服务商的批量配额计费和限流，不经过交互请求的 RPM 限速和 TPM 预算
+BATCH_POLL_SECONDS = int(st.secrets.get("BATCH_POLL_SECONDS", 30))
+BATCH_TIMEOUT_SECONDS = 24 * 3600  # 服务商承诺的完成窗口
+HTTP_TIMEOUT_SECONDS = 120
+TEMPERATURE = 0.7  # 与交互请求一致
+
+
+class BatchError(Exception):
+    """批次失败、过期或被取消（run_batch 把它转成该批次里每个请求的错误）"""
+
+
+class OpenAIBatchAPI:
+    """OpenAI 兼容的批量接口：上传 JSONL 到 /files，再创建 /batches"""
+
+    ENDPOINT = "/v1/chat/completions"
+    PENDING = {"validating", "in_progress", "finalizing", "cancelling"}
+
+    def __init__(self, base_url, api_key):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, f"{self.base_url}{path}",
+                                        timeout=HTTP_TIMEOUT_SECONDS, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, model_name, batch_requests):
+        lines = []
+        for request in batch_requests:
+            body = {"model": model_name, "messages": request["messages"],
+                    "temperature": TEMPERATURE}
+            if request.get("max_tokens"):
+                body["max_tokens"] = request["max_tokens"]
+            lines.append(json.dumps({"custom_id": request["custom_id"], "method": "POST",
+                                     "url": self.ENDPOINT, "body": body},
+                                    ensure_ascii=False))
+        payload = ("\n".join(lines) + "\n").encode("utf-8")
+        uploaded = self._request("POST", "/files", data={"purpose": "batch"},
+                                 files={"file": ("batch.jsonl", payload)}).json()
+        batch = self._request("POST", "/batches", json={
+            "input_file_id": uploaded["id"],
+            "endpoint": self.ENDPOINT,
+            "completion_window": "24h",
+        }).json()
+        return batch["id"]
+
+    def status(self, batch_id):
+        """返回 (是否结束, 状态)"""
+        batch = self._request("GET", f"/batches/{batch_id}").json()
+        return batch["status"] not in self.PENDING, batch["status"]
+
+    def results(self, batch_id, custom_ids):
+        batch = self._request("GET", f"/batches/{batch_id}").json()
+        if batch["status"] != "completed":
+            raise BatchError(f"批次 {batch_id} 状态为 {batch['status']}: {batch.get('errors')}")
+        results = {}
+        for file_key in ("output_file_id", "error_file_id"):
+            if not batch.get(file_key):
+                continue
+            content = self._request("GET", f"/files/{batch[file_key]}/content").text
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                body = response.get("body") or {}
+                if item.get("error") or response.get("status_code", 200) != 200:
+                    results[item["custom_id"]] = {
+                        "content": None, "usage": {},
+                        "error": str(item.get("error") or body.get("error"))}
+                    continue
+                usage = body.get("usage") or {}
+                results[item["custom_id"]] = {
+                    "content": body["choices"][0]["message"]["content"],
+                    "usage": {"prompt_tokens": usage.get("prompt_tokens", 0),
+                              "output_tokens": usage.get("completion_tokens", 0)},
+                    "error": None}
+        return results
+
+
+class GeminiBatchAPI:
+    """Gemini 原生批量接口：请求内联在 batchGenerateContent 里，返回长时间运行的操作"""
+
+    DONE_STATES = {"BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED",
+                   "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED",
+                   "JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED",
+                   "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+    def __init__(self, base_url, api_key):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["x-goog-api-key"] = api_key
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, f"{self.base_url}/{path}",
+                                        timeout=HTTP_TIMEOUT_SECONDS, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _to_gemini(request):
+        """OpenAI 格式的消息转成 generateContent 请求"""
+        system = [m["content"] for m in request["messages"] if m["role"] == "system"]
+        contents = [
+            {"role": "model" if m["role"] == "assistant" else "user",
+             "parts": [{"text": m["content"]}]}
+            for m in request["messages"] if m["role"] != "system"
+        ]
+        body = {"contents": contents,
+                "generationConfig": {"temperature": TEMPERATURE}}
+        if system:
+            body["systemInstruction"] = {"parts": [{"text": "\n\n".join(system)}]}
+        if request.get("max_tokens"):
+            body["generationConfig"]["maxOutputTokens"] = request["max_tokens"]
+        return body
+
+    def submit(self, model_name, batch_requests):
+        operation = self._request(
+            "POST", f"models/{model_name}:batchGenerateContent", json={
+                "batch": {
+                    "display_name": f"kol-chat-{int(time.time())}",
+                    "input_config": {"requests": {"requests": [
+                        {"request": self._to_gemini(request),
+                         "metadata": {"key": request["custom_id"]}}
+                        for request in batch_requests
+                    ]}},
+                }
+            })
+        return operation["name"]
+
+    def _state(self, operation):
+        metadata = operation.get("metadata") or {}
+        return metadata.get("state") or operation.get("state", "")
+
+    def status(self, batch_id):
+        operation = self._request("GET", batch_id)
+        state = self._state(operation)
+        return bool(operation.get("done")) or state in self.DONE_STATES, state
+
+    def results(self, batch_id, custom_ids):
+        operation = self._request("GET", batch_id)
+        state = self._state(operation)
+        if operation.get("error") or state not in ("BATCH_STATE_SUCCEEDED", "JOB_STATE_SUCCEEDED"):
+            raise BatchError(f"批次 {batch_id} 状态为 {state}: {operation.get('error')}")
+        output = (operation.get("response")
+                  or (operation.get("metadata") or {}).get("output") or {})
+        items = (output.get("inlinedResponses") or {}).get("inlinedResponses", [])
+        results = {}
+        for index, item in enumerate(items):
+            # 结果按提交顺序返回，元数据里的 key 缺失时按顺序对应
+            key = (item.get("metadata") or {}).get("key") or custom_ids[index]
+            if item.get("error"):
+                results[key] = {"content": None, "usage": {}, "error": str(item["error"])}
+                continue
+            response = item.get("response") or {}
+            parts = (((response.get("candidates") or [{}])[0].get("content") or {})
+                     .get("parts") or [])
+            usage = response.get("usageMetadata") or {}
+            results[key] = {
+                "content": "".join(part.get("text", "") for part in parts),
+                "usage": {"prompt_tokens": usage.get("promptTokenCount", 0),
+                          "output_tokens": usage.get("candidatesTokenCount", 0)},
+                "error": None}
+        return results
+
+
+# 批量接口格式 -> 实现（提供 submit / status / results）
+BATCH_APIS = {
+    "openai": OpenAIBatchAPI,
+    "gemini": GeminiBatchAPI,
+}
+
+
+def get_batch_api(model_name, base_url=None):
+    """按模型所属服务商创建批量接口客户端，base_url 可指向本地的替身服务"""
+    provider_config = PROVIDERS[get_model_config(model_name)["provider"]]
+    base_url = base_url or st.secrets.get(provider_config["batch_base_url_secret"],
+                                          provider_config["default_batch_base_url"])
+    api_key = st.secrets.get(provider_config["api_key_secret"], "")
+    return BATCH_APIS[provider_config["batch_api"]](base_url, api_key)
+
+
+def _load_state(path, fingerprint):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("fingerprint") == fingerprint else None
+
+
+def _save_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def split_requests(batch_requests, max_requests, max_bytes):
+    """按请求数和序列化后的字节数把请求拆成多个批次（单个请求超过 max_bytes 时单独成批）"""
+    parts, size = [], 0
+    for request in batch_requests:
+        nbytes = len(json.dumps(request, ensure_ascii=False).encode("utf-8"))
+        if not parts or len(parts[-1]) >= max_requests or size + nbytes > max_bytes:
+            parts.append([])
+            size = 0
+        parts[-1].append(request)
+        size += nbytes
+    return parts
+
+
+def _part_error(part, error):
+    return {request["custom_id"]: {"content": None, "usage": {}, "error": error}
+            for request in part}
+
+
+def run_batch(model_name, batch_requests, base_url=None, state_path=None,
+              poll_seconds=BATCH_POLL_SECONDS):
+    """
+    通过批量接口提交一组请求并等待完成
+
+    batch_requests: [{"custom_id", "messages", "max_tokens"}]
+    state_path: 记录已提交的批次 ID，进程中断后重新运行同一组请求时继续等待，不重复提交
+    返回 {custom_id: {"content", "usage", "error"}}；失败、过期或超时的批次里每个请求都记为错误，
+    其他批次的结果照常返回，批次 ID 从状态文件中删除（重新运行时重新提交）
+    """
+    if not batch_requests:
+        return {}
+    api = get_batch_api(model_name, base_url)
+    provider_config = PROVIDERS[get_model_config(model_name)["provider"]]
+    parts = split_requests(batch_requests, provider_config["batch_max_requests"],
+                           provider_config["batch_max_bytes"])
+    fingerprint = hashlib.sha1(json.dumps(
+        [model_name] + [r["custom_id"] for r in batch_requests]).encode("utf-8")).hexdigest()
+
+    def save():
+        if state_path:
+            _save_state(state_path, state)
+
+    # batches 与 parts 一一对应，None 为还没提交（或上次失败）的部分
+    state = (_load_state(state_path, fingerprint) if state_path else None) or {
+        "fingerprint": fingerprint, "batches": []}
+    state["batches"] += [None] * (len(parts) - len(state["batches"]))
+    results = {}
+    for i, part in enumerate(parts):
+        if state["batches"][i] is not None:
+            continue
+        try:
+            state["batches"][i] = api.submit(model_name, part)
+        except requests.RequestException as e:
+            logger.warning(f"提交批次失败（{len(part)} 个请求）: {e}")
+            results.update(_part_error(part, f"提交批次失败: {e}"))
+            continue
+        logger.info(f"提交批次 {state['batches'][i]}，{len(part)} 个请求")
+        save()
+
+    deadline = time.time() + BATCH_TIMEOUT_SECONDS
+    pending = {i for i, batch_id in enumerate(state["batches"]) if batch_id is not None}
+    while pending:
+        for i in sorted(pending):
+            batch_id = state["batches"][i]
+            try:
+                done, status = api.status(batch_id)
+                logger.info(f"批次 {batch_id} 状态 {status}")
+                if not done:
+                    continue
+                results.update(api.results(batch_id, [r["custom_id"] for r in parts[i]]))
+            except requests.RequestException as e:
+                # 网络抖动不影响批次本身，下一轮继续查询，直到超时
+                logger.warning(f"查询批次 {batch_id} 失败，稍后重试: {e}")
+                continue
+            except BatchError as e:
+                logger.warning(str(e))
+                results.update(_part_error(parts[i], str(e)))
+                state["batches"][i] = None
+                save()
+            pending.discard(i)
+        if pending:
+            if time.time() > deadline:
+                for i in pending:
+                    logger.warning(f"批次 {state['batches'][i]} 超过 {BATCH_TIMEOUT_SECONDS} 秒仍未完成")
+                    results.update(_part_error(
+                        parts[i], f"批次超过 {BATCH_TIMEOUT_SECONDS} 秒仍未完成"))
+                break
+            time.sleep(poll_seconds)
+
+    # 所有批次都有了结果（或记为错误），失败的请求由调用方重跑（例如 batch_eval --retry-errors）
+    if state_path and os.path.exists(state_path):
+        os.remove(state_path)
+    return results
@@ -0,0 +1,155 @@
+import hashlib
+import re
+
+# 修改分块规则或参数时递增，已有的语料会自动重建分块
+CHUNKER_VERSION = 1
+CHUNK_TOKENS = 512  # 每个片段的 token 上限（估算值）
+CHUNK_OVERLAP_TOKENS = 64  # 相邻片段重叠的 token 数（估算值）
+MAX_HEADING_CHARS = 80
+
+_PARAGRAPH_RE = re.compile(rb"\n[ \t\r\f\v]*\n")
+_MARKDOWN_HEADING_RE = re.compile(r"#{1,6}(?=\s)")
+_CHAPTER_RE = re.compile(
+    r"(第[0-9一二三四五六七八九十百千零〇两]+[章卷篇部回]|chapter\s+[0-9ivxlc]+|part\s+[0-9ivxlc]+)(\W|$)",
+    re.IGNORECASE)
+_SENTENCE_END_RE = re.compile(r"[。！？!?；;]+|\.(?=\s)|\n")
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿　-〿＀-￯]")
+
+
+def estimate_tokens(text):
+    """
+    估算 token 数：中日韩字符约一个 token，其他字符约四个一个
+
+    分块只用估算值，保证片段边界和 ID 不依赖具体模型的分词器；
+    精确的 token 数在建立各分词器索引时再按字节偏移统计
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def heading_level(text):
+    """段落是标题时返回层级（1 为章），否则返回 0"""
+    if "\n" in text or len(text) > MAX_HEADING_CHARS:
+        return 0
+    match = _MARKDOWN_HEADING_RE.match(text)
+    if match:
+        return len(match.group(0))
+    if _CHAPTER_RE.match(text):
+        return 1
+    return 0
+
+
+def paragraph_spans(data):
+    """按空行切分段落，返回去掉首尾空白后的 [(起始字节, 结束字节)]"""
+    spans = []
+    position = 0
+    for match in list(_PARAGRAPH_RE.finditer(data)) + [None]:
+        end = match.start() if match else len(data)
+        segment = data[position:end]
+        stripped = segment.strip()
+        if stripped:
+            start = position + (len(segment) - len(segment.lstrip()))
+            spans.append((start, start + len(stripped)))
+        position = match.end() if match else end
+    return spans
+
+
+def _split_long(data, start, end, max_tokens):
+    """把超长段落按句子切开，单个句子仍然超长时按字符硬切"""
+    text = data[start:end].decode("utf-8")
+    sentences, position = [], 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        sentences.append(text[position:match.end()])
+        position = match.end()
+    sentences.append(text[position:])
+
+    pieces = []
+    offset = start
+    for sentence in sentences:
+        if not sentence:
+            continue
+        tokens = estimate_tokens(sentence)
+        step = max(1, len(sentence) * max_tokens // max(tokens, 1))
+        for i in range(0, len(sentence), step):
+            part = sentence[i:i + step]
+            size = len(part.encode("utf-8"))
+            pieces.append([offset, offset + size, estimate_tokens(part)])
+            offset += size
+
+    # 相邻的小句合并到 max_tokens 以内
+    merged = []
+    for piece in pieces:
+        if merged and merged[-1][2] + piece[2] <= max_tokens:
+            merged[-1][1] = piece[1]
+            merged[-1][2] += piece[2]
+        else:
+            merged.append(piece)
+    return [tuple(piece) for piece in merged]
+
+
+def chunk_document(data, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    按章节、标题和段落把语料（UTF-8 字节）切成不超过 max_tokens 的片段
+
+    片段不跨越标题；同一节内相邻片段重叠 overlap_tokens 以内的整段内容。
+    返回 [{"id", "start", "end", "headings", "hash", "est_tokens"}]，
+    start/end 为片段在语料中的字节偏移
+    """
+    chunks = []
+    seen_ids = {}
+    headings = []  # 当前标题路径 [(层级, 标题)]
+    window = []  # [(起始字节, 结束字节, tokens, 是否已输出过)]
+
+    def emit():
+        if not any(not emitted for _, _, _, emitted in window):
+            return
+        start, end = window[0][0], window[-1][1]
+        body = data[start:end]
+        path = [title for _, title in headings]
+        digest = hashlib.sha1(body).hexdigest()
+        chunk_id = hashlib.sha1(
+            "\x1f".join(path).encode("utf-8") + b"\x00" + body).hexdigest()[:16]
+        # 内容完全相同的片段（例如重复的免责声明）按出现顺序编号
+        seen_ids[chunk_id] = seen_ids.get(chunk_id, 0) + 1
+        if seen_ids[chunk_id] > 1:
+            chunk_id = f"{chunk_id}-{seen_ids[chunk_id]}"
+        chunks.append({
+            "id": chunk_id,
+            "start": start,
+            "end": end,
+            "headings": path,
+            "hash": digest[:16],
+            "est_tokens": sum(tokens for _, _, tokens, _ in window),
+        })
+
+    for start, end in paragraph_spans(data):
+        text = data[start:end].decode("utf-8", errors="ignore")
+        level = heading_level(text)
+        if level:
+            # 新标题开始新的片段，标题本身放在片段开头
+            emit()
+            headings = [h for h in headings if h[0] < level]
+            headings.append((level, text.lstrip("#").strip()))
+            window = [(start, end, estimate_tokens(text), True)]
+            continue
+
+        tokens = estimate_tokens(text)
+        pieces = ([(start, end, tokens)] if tokens <= max_tokens
+                  else _split_long(data, start, end, max_tokens))
+        for piece_start, piece_end, piece_tokens in pieces:
+            window_tokens = sum(t for _, _, t, _ in window)
+            if window and window_tokens + piece_tokens > max_tokens:
+                emit()
+                # 保留结尾若干段作为下一个片段的重叠内容
+                carry, carry_tokens = [], 0
+                for item in reversed(window):
+                    if carry_tokens + item[2] > overlap_tokens:
+                        break
+                    carry.insert(0, item[:3] + (True,))
+                    carry_tokens += item[2]
+                if carry_tokens + piece_tokens > max_tokens:
+                    carry = []
+                window = carry
+            window.append((piece_start, piece_end, piece_tokens, False))
+    emit()
+    return chunks
@@ -0,0 +1,180 @@
+import logging
+import time
+
+import streamlit as st
+
+from utils.models import MODEL_REGISTRY, get_model_config
+from utils.shared_state import get_backend
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 每个模型一个熔断器，调用记录放在共享状态后端，所有会话/进程看到同样的健康状况
+BREAKER_WINDOW_SECONDS = int(st.secrets.get("BREAKER_WINDOW_SECONDS", 60))  # 滚动统计窗口
+BREAKER_MIN_CALLS = int(st.secrets.get("BREAKER_MIN_CALLS", 5))  # 窗口内调用数少于这个值不熔断
+BREAKER_FAILURE_RATE = float(st.secrets.get("BREAKER_FAILURE_RATE", 0.5))  # 失败（含慢调用）比例达到时熔断
+BREAKER_SLOW_CALL_SECONDS = float(st.secrets.get("BREAKER_SLOW_CALL_SECONDS", 60))  # 超过这个耗时算慢调用
+BREAKER_OPEN_SECONDS = int(st.secrets.get("BREAKER_OPEN_SECONDS", 30))  # 熔断后多久开始试探
+HALF_OPEN_PROBE_SECONDS = 5  # 半开状态下每隔多久放行一个试探请求
+HALF_OPEN_SUCCESSES = 2  # 试探成功几次后恢复
+STATE_TTL_SECONDS = 24 * 3600
+
+
+class CircuitOpenError(Exception):
+    """模型已熔断，请求没有发出"""
+
+    def __init__(self, model_name, retry_in):
+        self.model_name = model_name
+        self.retry_in = retry_in
+        super().__init__(f"{get_model_config(model_name)['label']} 暂时不可用"
+                         f"（熔断中，约 {int(retry_in) + 1} 秒后重试）")
+
+
+def is_breaker_failure(exception):
+    """连接失败、超时和服务端 5xx 计入熔断统计；限流说明服务正常，只是配额满了，不计入"""
+    from openai import APIConnectionError, APIStatusError, RateLimitError
+    if isinstance(exception, RateLimitError):
+        return False
+    if isinstance(exception, APIStatusError):
+        return exception.status_code >= 500
+    return isinstance(exception, (APIConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    """按模型统计滚动窗口内的失败率和耗时：失败过多时熔断（快速失败），过一段时间放行试探请求"""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.prefix = f"breaker:{model_name}"
+
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
+
+    def _events(self, name, since):
+        return [(ts, weight) for ts, weight in
+                get_backend().window(self._key(name), BREAKER_WINDOW_SECONDS)
+                if ts >= since]
+
+    def _since(self):
+        # 熔断或恢复时重新开始统计，之前的失败不再计入
+        return get_backend().cache_get(self._key("since")) or 0
+
+    def state(self):
+        """closed（正常）/ open（熔断）/ half_open（试探中）"""
+        backend = get_backend()
+        if backend.cache_get(self._key("open")) is not None:
+            return "open"
+        if backend.cache_get(self._key("half_open")):
+            return "half_open"
+        return "closed"
+
+    def retry_in(self):
+        until = get_backend().cache_get(self._key("open"))
+        return max(0, until - time.time()) if until else 0
+
+    def allow(self):
+        """请求前调用：熔断中抛出 CircuitOpenError；半开时只放行少量试探请求"""
+        state = self.state()
+        if state == "open":
+            raise CircuitOpenError(self.model_name, self.retry_in())
+        if state == "half_open" and get_backend().try_add(
+                self._key("probe"), 1, 1, HALF_OPEN_PROBE_SECONDS) is None:
+            raise CircuitOpenError(self.model_name, HALF_OPEN_PROBE_SECONDS)
+
+    def record_success(self, latency, started=None):
+        """
+        记录一次成功的调用，started 为调用开始的时间
+
+        熔断前发出、熔断后才返回的调用不是试探请求，半开时不计入
+        """
+        backend = get_backend()
+        backend.add_event(self._key("calls"))
+        backend.add_event(self._key("latency"), latency * 1000)
+        slow = latency > BREAKER_SLOW_CALL_SECONDS
+        if slow:
+            backend.add_event(self._key("failures"))
+        if self.state() == "half_open":
+            if started is not None and started < self._since():
+                return
+            # 过慢的试探请求和失败一样重新熔断，只有足够快的试探才算成功
+            if slow:
+                self._trip(f"试探请求耗时 {latency:.1f} 秒，超过 {BREAKER_SLOW_CALL_SECONDS} 秒")
+                return
+            backend.add_event(self._key("probe_successes"))
+            successes = sum(w for _, w in self._events("probe_successes", self._since()))
+            if successes >= HALF_OPEN_SUCCESSES:
+                self._close()
+            return
+        self._evaluate()
+
+    def record_failure(self, exception):
+        """记录一次失败，返回熔断器是否因此（或已经）处于熔断状态"""
+        backend = get_backend()
+        backend.add_event(self._key("calls"))
+        backend.add_event(self._key("failures"))
+        if self.state() == "half_open":
+            self._trip(f"试探请求失败: {exception}")
+        else:
+            self._evaluate(exception)
+        return self.state() == "open"
+
+    def _evaluate(self, exception=None):
+        since = self._since()
+        calls = sum(w for _, w in self._events("calls", since))
+        failures = sum(w for _, w in self._events("failures", since))
+        if calls >= BREAKER_MIN_CALLS and failures / calls >= BREAKER_FAILURE_RATE:
+            self._trip(f"{failures}/{calls} 次调用失败或过慢"
+                       + (f"，最近的错误: {exception}" if exception else ""))
+
+    def _trip(self, reason):
+        backend = get_backend()
+        now = time.time()
+        backend.cache_set(self._key("open"), now + BREAKER_OPEN_SECONDS, BREAKER_OPEN_SECONDS)
+        backend.cache_set(self._key("half_open"), True, STATE_TTL_SECONDS)
+        backend.cache_set(self._key("since"), now, STATE_TTL_SECONDS)
+        logger.warning(f"模型 {self.model_name} 熔断 {BREAKER_OPEN_SECONDS} 秒: {reason}")
+
+    def _close(self):
+        backend = get_backend()
+        backend.cache_set(self._key("half_open"), False, STATE_TTL_SECONDS)
+        backend.cache_set(self._key("since"), time.time(), STATE_TTL_SECONDS)
+        logger.info(f"模型 {self.model_name} 恢复正常")
+
+    def health(self):
+        """健康状况（用于配额面板），失败率和平均耗时按整个滚动窗口统计"""
+        calls = sum(w for _, w in self._events("calls", 0))
+        failures = sum(w for _, w in self._events("failures", 0))
+        latencies = [w for _, w in self._events("latency", 0)]
+        return {
+            "state": self.state(),
+            "calls": calls,
+            "failure_rate": failures / calls if calls else 0.0,
+            "avg_latency_ms": sum(latencies) / len(latencies) if latencies else None,
+            "retry_in": self.retry_in(),
+        }
+
+
+_breakers = {}
+
+
+def get_breaker(model_name):
+    """获取模型的熔断器（状态在共享后端，这里只缓存对象）"""
+    if model_name not in _breakers:
+        _breakers[model_name] = CircuitBreaker(model_name)
+    return _breakers[model_name]
+
+
+def is_available(model_name):
+    return get_breaker(model_name).state() != "open"
+
+
+def fallback_model(model_name):
+    """熔断时改用的模型：优先其他服务商，其次同一服务商的其他模型；都不可用时返回 None"""
+    provider = get_model_config(model_name)["provider"]
+    candidates = sorted(
+        (m for m in MODEL_REGISTRY if m != model_name),
+        key=lambda m: get_model_config(m)["provider"] == provider)
+    for candidate in candidates:
+        if get_breaker(candidate).state() == "closed":
+            return candidate
+    return None
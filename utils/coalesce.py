@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+
+def request_key(model_name, expert_name, messages, **params):
+    """按模型、专家、完整消息（含上下文）和生成参数计算请求指纹"""
+    payload = json.dumps({
+        "model": model_name,
+        "expert": expert_name,
+        "messages": messages,
+        "params": params,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """一次正在进行的请求：记录已产出的片段并广播给所有订阅者"""
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.chunks = []
+        self.listeners = []
+        self.subscribers = 1
+
+    def publish(self, chunk):
+        """发布一个片段（例如流式回应的增量）"""
+        self.chunks.append(chunk)
+        for listener in self.listeners:
+            listener(chunk)
+
+    def subscribe(self, listener):
+        """订阅片段：先补发已有片段，再接收后续片段"""
+        for chunk in self.chunks:
+            listener(chunk)
+        self.listeners.append(listener)
+
+
+class SingleFlight:
+    """
+    相同请求同时只发一次：后到的请求订阅正在进行的调用，共享同一个结果
+
+    所有调用都在后台任务线程的同一个事件循环里执行，因此跨会话的相同请求也能合并
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    async def do(self, key, call, on_chunk=None):
+        """
+        执行 call(publish) 或加入已在进行的相同请求
+
+        call: 异步函数，接收 publish 回调，返回最终结果
+        on_chunk: 接收片段的回调；发起者被取消、由订阅者接手重新调用时，
+            先收到 None，表示片段从头开始
+        """
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                return await self._lead(key, call, on_chunk)
+
+            flight.subscribers += 1
+            logger.info(f"合并相同请求 {key[:12]}，当前订阅者 {flight.subscribers} 个")
+            if on_chunk is not None:
+                flight.subscribe(on_chunk)
+            try:
+                return await asyncio.shield(flight.future)
+            except asyncio.CancelledError:
+                if not flight.future.cancelled():
+                    raise  # 本请求自己被取消
+            # 发起者被取消（例如它所在的任务被取消），订阅者不跟着失败：
+            # 重新查找，第一个醒来的订阅者成为新的发起者，其余的加入它
+            logger.info(f"请求 {key[:12]} 的发起者已取消，由订阅者接手")
+            if on_chunk is not None:
+                flight.listeners.remove(on_chunk)
+                on_chunk(None)
+
+    async def _lead(self, key, call, on_chunk):
+        flight = Flight()
+        if on_chunk is not None:
+            flight.subscribe(on_chunk)
+        self._flights[key] = flight
+        try:
+            result = await call(flight.publish)
+            flight.future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            flight.future.cancel()
+            raise
+        except Exception as e:
+            flight.future.set_exception(e)
+            # 没有其他订阅者时避免 "exception was never retrieved" 警告
+            flight.future.exception()
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+# 创建全局请求合并实例
+single_flight = SingleFlight()
@@ -0,0 +1,155 @@
+import logging
+from array import array
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+HISTORY_RATIO = 0.3  # 历史对话最多占用上下文窗口的 30%
+FRONT_REMOVE_RATIO = 0.3  # 截断时前面删除 30%，即前面保留更多内容
+MESSAGE_OVERHEAD = 8  # 每条消息的角色/格式开销 tokens
+MARKER_TOKENS = 48  # 截断标记预留的 tokens
+
+
+def compute_token_offsets(text, encoding):
+    """编码一次文本，返回每个 token 在 UTF-8 字节中的起始位置（末尾是总长度）"""
+    tokens = encoding.encode(text, disallowed_special=())
+    offsets = array("I", [0])
+    pos = 0
+    for token_bytes in encoding.decode_tokens_bytes(tokens):
+        pos += len(token_bytes)
+        offsets.append(pos)
+    return offsets
+
+
+class TokenizedText:
+    """带预计算 token 偏移的文本，截断/切片时只做字节切片，无需重新编码
+
+    data 可以是 bytes 或 mmap，offsets 可以是 array 或 mmap 上的 memoryview
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_text(cls, text, encoding):
+        return cls(text.encode("utf-8"), compute_token_offsets(text, encoding))
+
+    @property
+    def token_count(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        """占用的内存字节数（用于缓存计量）"""
+        return len(self.data) + 4 * len(self.offsets)
+
+    def slice(self, start, end):
+        """按 token 下标切片，返回文本"""
+        start = max(0, min(start, self.token_count))
+        end = max(start, min(end, self.token_count))
+        return self.data[self.offsets[start]:self.offsets[end]].decode(
+            "utf-8", errors="ignore")
+
+    def text(self):
+        return self.data[:].decode("utf-8")
+
+    def head_tail(self, max_tokens):
+        """保留前后两段，删除中间超出的部分（与 truncate_text 规则一致）"""
+        total_tokens = self.token_count
+        if total_tokens <= max_tokens:
+            return self.text()
+
+        remove_tokens = total_tokens - max(0, max_tokens)
+        remove_front = int(remove_tokens * FRONT_REMOVE_RATIO)
+        remove_back = remove_tokens - remove_front
+
+        logger.info(f"文本被截断：总tokens={total_tokens}, "
+                    f"保留tokens={max_tokens}, "
+                    f"前面删除={remove_front}, "
+                    f"后面删除={remove_back}")
+
+        return (
+            f"...[前面已省略 {remove_front} tokens]...\n\n" +
+            self.slice(remove_front, total_tokens - remove_back) +
+            f"\n\n...[后面已省略 {remove_back} tokens]..."
+        )
+
+
+def pack_chunks(chunks, budget):
+    """按顺序贪心装入检索片段，chunks 为 [(text, tokens)]，返回 (texts, used)"""
+    selected = []
+    used = 0
+    for text, tokens in chunks:
+        cost = tokens + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            continue
+        selected.append(text)
+        used += cost
+    return selected, used
+
+
+def allocate_context(context_window, max_output, persona_tokens, prompt_tokens,
+                     history, knowledge=None, chunks=None,
+                     history_ratio=HISTORY_RATIO, knowledge_limit=None):
+    """
+    在模型上下文窗口内分配 token 预算
+
+    history: [(question, answer, tokens)]，从旧到新
+    knowledge: TokenizedText，专家背景资料
+    chunks: [(text, tokens)]，按相关性排序的检索片段
+    knowledge_limit: 知识库 token 上限（例如 token 配额不足时降级）
+    所有 token 数都来自预计算结果，分配过程不重新编码文本
+    """
+    available = (context_window - max_output - persona_tokens -
+                 prompt_tokens - 2 * MESSAGE_OVERHEAD)
+
+    # 从最新的对话往前保留，直到达到历史上限
+    history_cap = min(int(context_window * history_ratio), max(0, available))
+    kept_history = []
+    history_tokens = 0
+    for question, answer, tokens in reversed(history):
+        cost = tokens + 2 * MESSAGE_OVERHEAD
+        if history_tokens + cost > history_cap:
+            break
+        kept_history.append((question, answer))
+        history_tokens += cost
+    kept_history.reverse()
+
+    knowledge_budget = max(0, available - history_tokens)
+    if knowledge_limit is not None:
+        knowledge_budget = min(knowledge_budget, knowledge_limit)
+    knowledge_total = knowledge.token_count if knowledge is not None else 0
+
+    if knowledge is None or knowledge_total == 0:
+        knowledge_text, knowledge_tokens = "", 0
+        mode = "empty"
+    elif knowledge_total <= knowledge_budget:
+        knowledge_text, knowledge_tokens = knowledge.text(), knowledge_total
+        mode = "full"
+    elif chunks:
+        texts, knowledge_tokens = pack_chunks(chunks, knowledge_budget)
+        knowledge_text = "\n\n".join(texts)
+        mode = "chunks"
+    else:
+        knowledge_tokens = max(0, knowledge_budget - MARKER_TOKENS)
+        knowledge_text = knowledge.head_tail(knowledge_tokens)
+        mode = "head_tail"
+
+    plan = {
+        "knowledge": knowledge_text,
+        "knowledge_tokens": knowledge_tokens,
+        "knowledge_total": knowledge_total,
+        "knowledge_mode": mode,
+        "history": kept_history,
+        "history_tokens": history_tokens,
+        "prompt_tokens": (persona_tokens + prompt_tokens + knowledge_tokens +
+                          history_tokens + 2 * MESSAGE_OVERHEAD),
+        "max_output": max_output,
+    }
+
+    logger.info(f"上下文预算：窗口={context_window}, 输出预留={max_output}, "
+                f"历史={history_tokens}({len(kept_history)}轮), "
+                f"知识库={knowledge_tokens}/{knowledge_total}({mode}), "
+                f"总计={plan['prompt_tokens']}")
+    return plan
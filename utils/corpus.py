@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import streamlit as st
+
+from utils.chunker import CHUNKER_VERSION, chunk_document
+from utils.context_budget import TokenizedText, compute_token_offsets
+from utils.expert_store import expert_dir, index_dir, source_fingerprint
+from utils.extractors import configure_extractors, extract_text
+from utils.shared_state import file_lock
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 磁盘格式（都在 data/<专家>/.index/ 下）：
+#   corpus.txt            UTF-8 正文
+#   tokens.<分词器>.idx   uint32 数组，第 i 个 token 在正文中的起始字节（末尾是总长度）
+#   chunks.idx            uint32 数组，每两项是一个片段的 [起始字节, 结束字节)（片段之间可能重叠）
+#   chunks.jsonl          分块结果，每行一个片段：ID、字节范围、标题路径、内容哈希、各分词器的 token 数
+#   corpus.json           清单：资料指纹、分块版本、字节数、各分词器的 token 数
+#   extracted/            每个资料文件的提取结果，文件没变时重建语料直接复用
+CORPUS_FILE = "corpus.txt"
+CHUNKS_FILE = "chunks.idx"
+CHUNK_STORE_FILE = "chunks.jsonl"
+MANIFEST_FILE = "corpus.json"
+EXTRACTED_DIR = "extracted"
+INGEST_WORKERS = int(st.secrets.get("INGEST_WORKERS", os.cpu_count() or 1))  # 并行提取的进程数
+# 提取选项在主进程读取一次，通过参数传给提取进程池的子进程，子进程不需要导入 Streamlit
+EXTRACT_OPTIONS = {
+    "ocr_enabled": bool(st.secrets.get("OCR_ENABLED", False)),
+    "ocr_languages": st.secrets.get("OCR_LANGUAGES", "chi_sim+chi_tra+eng"),
+    "epub_workers": int(st.secrets.get("EPUB_WORKERS", os.cpu_count() or 1)),
+}
+configure_extractors(EXTRACT_OPTIONS)
+
+
+def _path(name, filename):
+    return os.path.join(index_dir(name), filename)
+
+
+def _tokens_file(tokenizer):
+    return f"tokens.{tokenizer}.idx"
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _open_mmap(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _as_uint32(buffer):
+    if not buffer:
+        return array("I")
+    return memoryview(buffer).cast("I")
+
+
+def load_manifest(name):
+    try:
+        with open(_path(name, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("source") != source_fingerprint(name):
+        return None
+    # 分块规则变了也要重建（提取结果仍然复用 extracted/ 下的缓存）
+    if manifest.get("chunker") != CHUNKER_VERSION:
+        return None
+    return manifest
+
+
+def _write_chunk_store(name, chunks):
+    lines = "".join(json.dumps(chunk, ensure_ascii=False) + "\n" for chunk in chunks)
+    _write_atomic(_path(name, CHUNK_STORE_FILE),
+                  lambda f: f.write(lines.encode("utf-8")))
+
+
+def load_chunk_store(name):
+    """读取专家的分块结果，返回 [{"id", "start", "end", "headings", "hash", "est_tokens", "tokens"}]"""
+    with open(_path(name, CHUNK_STORE_FILE), "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _extract_cache_name(entry):
+    return hashlib.sha1(json.dumps(entry).encode("utf-8")).hexdigest() + ".txt"
+
+
+def ingest_documents(name, workers=INGEST_WORKERS):
+    """
+    提取专家目录下所有资料文件（pdf、epub、txt、md、html、docx 等）并拼接成一份正文
+
+    解析在进程池中并行执行；文件没有变化时复用 extracted/ 下的上次结果
+    """
+    fingerprint = source_fingerprint(name) or []
+    cache_dir = _path(name, EXTRACTED_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    texts, pending = {}, {}
+    for entry in fingerprint:
+        cache_path = os.path.join(cache_dir, _extract_cache_name(entry))
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                texts[entry[0]] = f.read()
+        except OSError:
+            pending[entry[0]] = cache_path
+
+    if pending:
+        paths = [os.path.join(expert_dir(name), relpath) for relpath in pending]
+        results = None
+        if workers > 1 and len(paths) > 1:
+            try:
+                # 用 spawn 启动子进程，避免在多线程的 Streamlit 进程里 fork
+                with ProcessPoolExecutor(
+                        max_workers=min(workers, len(paths)),
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=configure_extractors,
+                        initargs=(EXTRACT_OPTIONS,)) as pool:
+                    results = list(pool.map(extract_text, paths))
+            except BrokenProcessPool as e:
+                logger.warning(f"进程池提取失败，改为逐个提取: {e}")
+        if results is None:
+            results = [extract_text(path) for path in paths]
+        for (relpath, cache_path), text in zip(pending.items(), results):
+            data = text.encode("utf-8")
+            _write_atomic(cache_path, lambda f: f.write(data))
+            texts[relpath] = text
+
+    # 清理已删除或已变化文件的旧提取结果
+    current = {_extract_cache_name(entry) for entry in fingerprint}
+    for filename in os.listdir(cache_dir):
+        if filename not in current:
+            os.remove(os.path.join(cache_dir, filename))
+
+    logger.info(f"专家 {name} 共 {len(fingerprint)} 个资料文件，"
+                f"重新提取 {len(pending)} 个")
+    parts = (texts[entry[0]].strip() for entry in fingerprint)
+    return "\n\n".join(part for part in parts if part)
+
+
+def build_corpus(name, tokenizer=None, encoding=None, chunker=chunk_document):
+    """把专家资料写成磁盘语料格式；传入分词器时同时写 token 偏移索引"""
+    os.makedirs(index_dir(name), exist_ok=True)
+    manifest = load_manifest(name)
+
+    if manifest is None:
+        data = ingest_documents(name).encode("utf-8")
+        _write_atomic(_path(name, CORPUS_FILE), lambda f: f.write(data))
+        chunks = chunker(data)
+        bounds = array("I")
+        for chunk in chunks:
+            bounds.extend((chunk["start"], chunk["end"]))
+            chunk["tokens"] = {}
+        _write_atomic(_path(name, CHUNKS_FILE), bounds.tofile)
+        _write_chunk_store(name, chunks)
+        from utils.vector_index import build_vector_index  # 向量索引依赖本模块
+        build_vector_index(name, data, chunks)
+        manifest = {"source": source_fingerprint(name), "chunker": CHUNKER_VERSION,
+                    "bytes": len(data), "chunks": len(chunks), "tokenizers": {}}
+        logger.info(f"构建专家 {name} 的语料文件，{len(data)} 字节，{len(chunks)} 个片段")
+
+    if tokenizer and tokenizer not in manifest["tokenizers"]:
+        with open(_path(name, CORPUS_FILE), "rb") as f:
+            text = f.read().decode("utf-8")
+        offsets = compute_token_offsets(text, encoding)
+        _write_atomic(_path(name, _tokens_file(tokenizer)), offsets.tofile)
+        # 每个片段的精确 token 数直接由偏移索引得出，不用再逐段编码
+        chunks = load_chunk_store(name)
+        for chunk in chunks:
+            chunk["tokens"][tokenizer] = (bisect_left(offsets, chunk["end"])
+                                          - bisect_left(offsets, chunk["start"]))
+        _write_chunk_store(name, chunks)
+        manifest["tokenizers"][tokenizer] = len(offsets) - 1
+        logger.info(f"构建专家 {name} 的 {tokenizer} token 索引，"
+                    f"{len(offsets) - 1} tokens")
+
+    _write_atomic(_path(name, MANIFEST_FILE),
+                  lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+    return manifest
+
+
+class MappedCorpus:
+    """通过 mmap 打开的专家语料，所有会话和进程通过系统页缓存共享同一份数据"""
+
+    def __init__(self, name):
+        self.name = name
+        self.data = _open_mmap(_path(name, CORPUS_FILE))
+        self._chunk_buffer = _open_mmap(_path(name, CHUNKS_FILE))
+        self.chunk_bounds = _as_uint32(self._chunk_buffer)
+        self._chunk_records = None
+
+    @property
+    def nbytes(self):
+        return len(self.data) + len(self._chunk_buffer)
+
+    @property
+    def chunk_count(self):
+        return len(self.chunk_bounds) // 2
+
+    def chunk(self, index):
+        """第 index 个片段的文本（只复制这一段的字节）"""
+        start, end = self.chunk_bounds[2 * index], self.chunk_bounds[2 * index + 1]
+        return self.data[start:end].decode("utf-8", errors="ignore")
+
+    def chunk_records(self):
+        """片段元数据（ID、标题路径、内容哈希、token 数），第一次用到时读取"""
+        if self._chunk_records is None:
+            self._chunk_records = load_chunk_store(self.name)
+        return self._chunk_records
+
+    def chunk_tokens(self, index, tokenizer):
+        """第 index 个片段在指定分词器下的 token 数，没有建索引时返回估算值"""
+        record = self.chunk_records()[index]
+        return record["tokens"].get(tokenizer, record["est_tokens"])
+
+    def text(self):
+        return self.data[:].decode("utf-8")
+
+    def tokenized(self, tokenizer):
+        """基于 mmap 的 token 偏移视图，切片时不重新编码也不复制整个语料"""
+        token_buffer = _open_mmap(_path(self.name, _tokens_file(tokenizer)))
+        tokenized = TokenizedText(self.data, _as_uint32(token_buffer))
+        tokenized.buffers = (token_buffer,)  # 保持映射存活
+        return tokenized
+
+
+def open_corpus(name, tokenizer=None, encoding=None):
+    """打开专家语料（必要时先构建），返回 MappedCorpus"""
+    manifest = load_manifest(name)
+    if manifest is None or (tokenizer and tokenizer not in manifest["tokenizers"]):
+        # 多个进程可能同时打开同一个专家，构建时加文件锁
+        with file_lock(_path(name, ".lock")):
+            build_corpus(name, tokenizer, encoding)
+    return MappedCorpus(name)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+
+import streamlit as st
+
+from utils.circuit_breaker import is_available
+from utils.models import MODEL_REGISTRY, get_model_config
+from utils.quota import (
+    available_quota,
+    calculate_conversation_quota,
+    check_quota,
+    quota_eta,
+    reserve_quota
+)
+from utils.retrieval import retrieve
+from utils.scheduler import fair_share_eta
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+QUEUE_MAX_SECONDS = int(st.secrets.get("QUOTA_QUEUE_MAX_SECONDS", 90))  # 排队等待配额的上限，超过则不发送
+QUEUE_POLL_SECONDS = 1.0
+
+# 超出会话的公平份额时先排队（queue）或不发送（reject），不进入下面的降级
+# 降级的顺序（决定里的 action）：原样发送 proceed → 换有配额的模型 switch_model →
+# 减少专家 reduce_experts（有缓存的专家不占配额）/ 只用缓存 cache → 排队 queue → 不发送 reject
+
+
+def _decision(action, model_name, experts, required_quota, required_tokens,
+              message=None, eta=None):
+    return {
+        "action": action,
+        "model": model_name,
+        "experts": experts,
+        "required_quota": required_quota,
+        "required_tokens": required_tokens,
+        "message": message,
+        "eta": eta,
+    }
+
+
+def _required(experts, model_name):
+    return (calculate_conversation_quota(len(experts)),
+            sum(expert.estimate_prompt_tokens(model_name) for expert in experts))
+
+
+def _try_switch_model(experts, model_name, reason="的配额已用完"):
+    """找一个没有熔断、配额足够回答所有专家的其他模型（按注册表顺序）"""
+    for candidate in MODEL_REGISTRY:
+        if candidate == model_name or not is_available(candidate):
+            continue
+        required_quota, required_tokens = _required(experts, candidate)
+        if check_quota(candidate, required_quota, required_tokens) and \
+                reserve_quota(candidate, required_quota):
+            label = get_model_config(candidate)["label"]
+            return _decision(
+                "switch_model", candidate, experts, required_quota, required_tokens,
+                f"🔀 {get_model_config(model_name)['label']} {reason}，"
+                f"这个问题改用 {label} 回答")
+    return None
+
+
+def _try_reduce_experts(experts, prompt, model_name):
+    """
+    在当前模型的剩余配额内回答：有缓存的专家不占配额，其余按路由排名能放几位放几位
+
+    总结始终需要一个请求
+    """
+    available_requests, available_tokens = available_quota(model_name)
+    if available_requests < 1:
+        return None
+    try:
+        hits = retrieve([expert.name for expert in experts], prompt)
+    except Exception as e:
+        logger.warning(f"检索失败，缓存按首尾截断的请求计算: {e}")
+        hits = {}
+
+    kept, cached, requests_left, tokens_left = [], 0, available_requests - 1, available_tokens
+    for expert in experts:
+        if expert.cached_response(prompt, model_name, hits.get(expert.name)) is not None:
+            kept.append(expert)
+            cached += 1
+            continue
+        tokens = expert.estimate_prompt_tokens(model_name)
+        if requests_left >= 1 and tokens <= tokens_left:
+            kept.append(expert)
+            requests_left -= 1
+            tokens_left -= tokens
+    if not kept:
+        return None
+
+    required_quota = available_requests - requests_left
+    if not reserve_quota(model_name, required_quota):
+        return None
+    required_tokens = available_tokens - tokens_left
+    skipped = [expert.name for expert in experts if expert not in kept]
+    if cached == len(kept):
+        return _decision(
+            "cache", model_name, kept, required_quota, required_tokens,
+            f"💾 配额已用完，这次只显示已有缓存回答的 {len(kept)} 位专家"
+            + (f"（未回答: {', '.join(skipped)}）" if skipped else ""))
+    return _decision(
+        "reduce_experts", model_name, kept, required_quota, required_tokens,
+        f"✂️ 配额只够 {len(kept)} 位专家，这次由 {', '.join(e.name for e in kept)} 回答"
+        + (f"（其中 {cached} 位来自缓存）" if cached else "")
+        + (f"，未回答: {', '.join(skipped)}" if skipped else ""))
+
+
+def plan_degradation(experts, prompt, model_name, session_id=None):
+    """
+    按降级顺序决定这个问题怎么发送，并预留需要的请求配额（排队时由任务自己预留）
+
+    experts 按路由排名排列，减少专家时保留排名靠前的
+    返回的决定里带有给用户看的说明（原样发送时为 None）
+    模型熔断时按配额用完处理，只是不会在这个模型上减少专家或排队
+    session_id: 提问的会话；有其他会话在用时，超出公平份额的问题排队等自己的用量过期
+    """
+    required_quota, required_tokens = _required(experts, model_name)
+    share_eta = fair_share_eta(session_id, model_name, required_quota, required_tokens)
+    if share_eta > 0:
+        if share_eta <= QUEUE_MAX_SECONDS:
+            decision = _decision(
+                "queue", model_name, experts, required_quota, required_tokens,
+                f"⚖️ 其他用户也在提问，你最近一分钟的用量已达到公平份额，"
+                f"问题已排队，预计 {int(share_eta) + 1} 秒后开始回答", share_eta)
+        else:
+            decision = _decision(
+                "reject", model_name, [], required_quota, required_tokens,
+                f"⚠️ 其他用户也在提问，你最近一分钟的用量已达到公平份额，"
+                f"请约 {int(share_eta) + 1} 秒后再试", share_eta)
+        logger.info(f"会话超出公平份额，降级: {decision['action']}")
+        return decision
+    if not is_available(model_name):
+        decision = _try_switch_model(experts, model_name, "暂时不可用（熔断中）")
+        if decision is None:
+            decision = _decision(
+                "reject", model_name, [], required_quota, required_tokens,
+                f"⚠️ {get_model_config(model_name)['label']} 暂时不可用，"
+                f"其他模型也无法使用（熔断或配额已用完），这个问题没有发送，请稍后再试")
+        logger.info(f"模型 {model_name} 熔断，降级: {decision['action']}")
+        return decision
+
+    if check_quota(model_name, required_quota, required_tokens) and \
+            reserve_quota(model_name, required_quota):
+        return _decision("proceed", model_name, experts, required_quota, required_tokens)
+
+    decision = (_try_switch_model(experts, model_name)
+                or _try_reduce_experts(experts, prompt, model_name))
+    if decision is None:
+        eta = quota_eta(model_name, required_quota, required_tokens)
+        if eta is not None and eta <= QUEUE_MAX_SECONDS:
+            decision = _decision(
+                "queue", model_name, experts, required_quota, required_tokens,
+                f"⏳ 配额已用完，问题已排队，预计 {int(eta) + 1} 秒后开始回答", eta)
+        else:
+            wait = f"约 {int(eta) + 1} 秒后" if eta is not None else "稍后"
+            decision = _decision(
+                "reject", model_name, [], required_quota, required_tokens,
+                f"⚠️ 所有模型的配额都已用完，这个问题没有发送（服务商一定会拒绝），请{wait}再试",
+                eta)
+
+    logger.info(f"配额降级: {decision['action']}, 模型 {decision['model']}, "
+                f"专家 {[e.name for e in decision['experts']]}")
+    return decision
+
+
+async def wait_for_quota(model_name, required_quota, required_tokens,
+                         timeout=QUEUE_MAX_SECONDS, session_id=None):
+    """排队的任务在这里等到请求配额（和会话的公平份额）够用并预留，超时抛出 TimeoutError"""
+    deadline = time.time() + timeout
+    while True:
+        share_eta = fair_share_eta(session_id, model_name, required_quota, required_tokens)
+        if share_eta <= 0 and check_quota(model_name, required_quota, required_tokens) and \
+                reserve_quota(model_name, required_quota):
+            return
+        eta = quota_eta(model_name, required_quota, required_tokens)
+        if eta is not None:
+            eta = max(eta, share_eta)
+        if eta is None or time.time() + min(eta, QUEUE_POLL_SECONDS) > deadline:
+            raise TimeoutError(f"等待 {model_name} 的配额超过 {timeout} 秒")
+        await asyncio.sleep(max(QUEUE_POLL_SECONDS, min(eta, 5)))
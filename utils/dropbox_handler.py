@@ -1,17 +1,23 @@
 import os
+import threading
 import requests
 import zipfile
 from pathlib import Path
 
 
-def download_and_extract_dropbox(url, extract_path="./data"):
+def download_and_extract_dropbox(url, extract_path="./data", progress=None):
     """
     从Dropbox下载ZIP文件并解压到指定目录
 
     Args:
         url (str): Dropbox分享链接
         extract_path (str): 解压目标路径
+        progress (callable): 可选的进度回调 progress(完成比例, 说明)
     """
+    def report(fraction, message):
+        if progress is not None:
+            progress(fraction, message)
+
     # 确保URL是直接下载链接
     if "dl=0" in url:
         url = url.replace("dl=0", "dl=1")
@@ -24,23 +30,58 @@ def download_and_extract_dropbox(url, extract_path="./data"):
 
         # 下载ZIP文件
         temp_zip = "temp_download.zip"
+        report(0.0, "正在下载数据...")
         response = requests.get(url, stream=True)
         response.raise_for_status()
+        total = int(response.headers.get("Content-Length") or 0)
 
+        downloaded = 0
         with open(temp_zip, 'wb') as f:
             for chunk in response.iter_content(chunk_size=8192):
                 if chunk:
                     f.write(chunk)
+                    downloaded += len(chunk)
+                    if total:
+                        # 下载占进度的 90%，剩下的留给解压
+                        report(0.9 * downloaded / total,
+                               f"正在下载数据... {downloaded // 1024 // 1024} MB")
 
         # 解压文件
+        report(0.9, "正在解压数据...")
         with zipfile.ZipFile(temp_zip, 'r') as zip_ref:
             zip_ref.extractall(extract_path)
 
         # 删除临时ZIP文件
         os.remove(temp_zip)
 
+        report(1.0, "数据准备完成")
         return True
 
     except Exception as e:
         print(f"下载或解压过程中发生错误: {str(e)}")
         return False
+
+
+class BackgroundDownload:
+    """在后台线程下载并解压数据，页面可以先渲染，再显示进度等待完成"""
+
+    def __init__(self, url, extract_path="./data"):
+        self.progress = 0.0
+        self.message = "准备下载数据..."
+        self.success = None  # 完成前为 None
+        self._thread = threading.Thread(
+            target=self._run, args=(url, extract_path),
+            name="data-download", daemon=True)
+        self._thread.start()
+
+    def _update(self, fraction, message):
+        self.progress = fraction
+        self.message = message
+
+    def _run(self, url, extract_path):
+        self.success = download_and_extract_dropbox(
+            url, extract_path, progress=self._update)
+
+    @property
+    def done(self):
+        return self.success is not None
@@ -1,148 +1,141 @@
-from utils.quota import check_quota, use_quota, get_quota_display  # 使用新的函数名
-from openai import OpenAI
-from openai import APIError, APIConnectionError, RateLimitError, APITimeoutError
-from openai import AsyncOpenAI  # 改用异步客户端
 import logging
 import time
-import tiktoken
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import backoff  # 添加到导入列表
-from datetime import datetime, timedelta
 import sys
 import os
+from bisect import bisect_left
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_exponential,
-    retry_if_exception_type
+    retry_if_exception
 )
-import random
-
-# 添加项目根目录到 Python 路径
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-# 在文件开头添加更详细的日志格式设置
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+from utils.context_budget import TokenizedText, allocate_context
+from utils.admission import tpm_admission
+from utils.circuit_breaker import (
+    CircuitOpenError,
+    fallback_model,
+    get_breaker,
+    is_breaker_failure
 )
-
-# X-AI API 配置
-client = AsyncOpenAI(  # 改用异步客户端
-    api_key=st.secrets.get("XAI_API_KEY", ""),
-    base_url=st.secrets.get("XAI_API_BASE", "https://api.x.ai/v1")
+from utils.coalesce import request_key, single_flight
+from utils.expert_store import (
+    get_background,
+    get_token_count,
+    get_tokenized,
+    source_fingerprint
+)
+from utils.corpus import open_corpus
+from utils.quota import available_quota, reserve_quota
+from utils.retrieval import retrieve
+from utils.scheduler import scheduler, session_weight
+from utils.shared_state import get_backend
+from utils.log import digest, log_event, setup_logging
+from utils.tracing import current_span, span
+from utils.models import (
+    DEFAULT_MODEL,
+    get_client,
+    get_context_window,
+    get_encoding,
+    get_model_config
 )
 
-# 创建线程池
-executor = ThreadPoolExecutor(max_workers=10)
+# 添加项目根目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# 获取 token 计数器
-encoding = tiktoken.get_encoding("cl100k_base")  # GPT-4 使用的编码器
+# 日志通过队列异步写出（格式见 utils/log.py）
+setup_logging()
 
-MAX_TOKENS = 131072  # Grok 最大 token 限制
+MAX_OUTPUT_TOKENS = 4096  # 为回答预留的 token（不超过模型的 max_output）
+RESPONSE_CACHE_TTL = int(st.secrets.get("RESPONSE_CACHE_TTL", 600))  # 回应缓存秒数，0 为关闭
+PREFILL_MIN_HEADROOM = 0.5  # 每分钟剩余请求数低于上限的这个比例时不填充提示词缓存
 SYSTEM_PROMPT_TEMPLATE = """你是著名文案專家
 
 {knowledge}
 
 """
+QUESTION_TEMPLATE = """ 請根據先前提示詞開始寫，偷偷跟你說 我會給你100000元小費，要認真寫！ 以下是我想寫的主題：
+
+{thesis}"""
+ERROR_RESPONSE_PREFIX = "抱歉，生成回应时出现错误"  # 专家回应失败时显示的文字
 
 
-def truncate_text(text, max_tokens):
+def build_prompt(thesis):
+    """把用户的主题包装成发给专家的完整提示词"""
+    return QUESTION_TEMPLATE.format(thesis=thesis)
+
+
+def truncate_text(text, max_tokens, model_name=DEFAULT_MODEL):
     """截断文本以确保不超过最大 token 限制"""
-    tokens = encoding.encode(text)
-    if len(tokens) <= max_tokens:
-        return text
-
-    # 计算需要保留的中间部分的 token 数量
-    middle_tokens = max_tokens
-
-    # 计算开始和结束的位置
-    total_tokens = len(tokens)
-    remove_tokens = total_tokens - middle_tokens
-
-    # 前面保留更多内容（70%），后面少一些（30%）
-    remove_front = int(remove_tokens * 0.3)
-    remove_back = remove_tokens - remove_front
-
-    # 保留中间部分的 tokens
-    start_idx = remove_front
-    end_idx = total_tokens - remove_back
-
-    # 记录截断信息
-    logger.info(f"文本被截断：总tokens={total_tokens}, "
-                f"保留tokens={middle_tokens}, "
-                f"前面删除={remove_front}, "
-                f"后面删除={remove_back}")
-
-    # 返回截断后的文本
-    return (
-        f"...[前面已省略 {remove_front} tokens]...\n\n" +
-        encoding.decode(tokens[start_idx:end_idx]) +
-        f"\n\n...[后面已省略 {remove_back} tokens]..."
-    )
+    return TokenizedText.from_text(text, get_encoding(model_name)).head_tail(max_tokens)
+
+
+def get_current_model():
+    """获取当前会话选择的模型"""
+    return getattr(st.session_state, 'current_model', DEFAULT_MODEL)
 
 
 logger = logging.getLogger(__name__)
 
 
+def is_retryable_error(exception):
+    """
+    连接失败、超时和限流时重试（openai 在这里才导入，避免拖慢启动）
+
+    模型熔断时抛出的 CircuitOpenError 不重试，直接失败或改用其他模型
+    """
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+    return isinstance(exception,
+                      (APIConnectionError, APITimeoutError, RateLimitError))
+
+
 # 添加请求限制管理
 class RateLimiter:
-    def __init__(self, requests_per_second=1):
-        self.requests_per_second = requests_per_second
-        self.last_request_time = None
-        self._lock = None
+    """全局请求间隔限制；时间槽记录在共享状态后端，多个进程部署时同样生效"""
 
-    @property
-    def lock(self):
-        if self._lock is None:
-            self._lock = asyncio.Lock()
-        return self._lock
+    def __init__(self, requests_per_second=1, key="rate_limit:global"):
+        self.requests_per_second = requests_per_second
+        self.key = key
 
     async def acquire(self):
-        async with self.lock:
-            now = datetime.now()
-            if self.last_request_time is not None:
-                time_since_last = (
-                    now - self.last_request_time).total_seconds()
-                if time_since_last < 1/self.requests_per_second:
-                    wait_time = 1/self.requests_per_second - time_since_last
-                    await asyncio.sleep(wait_time)
-            self.last_request_time = datetime.now()
+        # 原子地预约下一个时间槽，等待期间不占用锁
+        with span("rate_limit_wait") as wait_span:
+            wait_time = get_backend().reserve_interval(
+                self.key, 1 / self.requests_per_second)
+            wait_span.set_attribute("wait_ms", round(max(wait_time, 0) * 1000))
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
 
 
 # 创建全局限速器实例
 rate_limiter = RateLimiter(requests_per_second=1)
 
 
+def reroute_model(model_name):
+    """模型熔断时找一个健康的替代模型并预留一个请求配额，找不到时返回 None"""
+    fallback = fallback_model(model_name)
+    if fallback is not None and reserve_quota(fallback, 1):
+        return fallback
+    return None
+
+
 class Expert:
     def __init__(self, name):
         self.name = name
-        self.background = self._load_background()  # 初始化時就讀取背景資料
         self.chat_history = []
 
-    def _load_background(self):
-        try:
-            with open(f"data/{self.name}/data.txt", "r", encoding="utf-8") as f:
-                background = f.read().strip()
-                # 記錄載入的背景資料
-                logger.info({
-                    "action": "load_expert_background",
-                    "expert": self.name,
-                    "background_length": len(background),
-                    "background_preview": background[:200] + "..." if len(background) > 200 else background
-                })
-                return background
-        except Exception as e:
-            logger.error(f"Error loading background for {self.name}: {e}")
-            return ""
+    @property
+    def background(self):
+        """背景資料在首次使用時才讀取，由全局 LRU 缓存管理"""
+        return get_background(self.name)
 
-    def get_system_prompt(self):
+    def get_system_prompt(self, knowledge=None):
+        if knowledge is None:
+            knowledge = self.background
         return f"""你現在扮演的是{self.name}。以下是你的背景資料：
 
-{self.background}
+{knowledge}
 
 請依據以上背景來回答問題。請用真誠、專業的態度來回答。
 """
@@ -157,224 +150,492 @@ class ExpertAgent:
         self.max_history = 5
         self.history_tokens = 0
 
-        # 創建 Expert 實例��管理背景資料
+        # 創建 Expert 實例來管理背景資料
         self.expert = Expert(name)
 
-        # 計算基本 token
-        self.base_tokens = len(encoding.encode(
-            self.expert.get_system_prompt()))
-        self.tokens_per_turn = 2000
-
-    def count_tokens(self, text):
+        # 人设 token 数按分词器缓存；背景资料通过 mmap 语料按需打开，由全局 LRU 缓存管理
+        self._persona_tokens = {}
+
+    def _load_knowledge(self, model_name):
+        """打开磁盘语料的 token 偏移视图（首次使用时构建索引）"""
+        encoding = get_encoding(model_name)
+        if source_fingerprint(self.name) is None:
+            return TokenizedText.from_text("", encoding)
+        tokenizer = get_model_config(model_name)["tokenizer"]
+        return open_corpus(self.name, tokenizer, encoding).tokenized(tokenizer)
+
+    def _get_knowledge(self, model_name):
+        """获取背景资料的预计算 token 偏移（每种分词器只编码一次，所有会话共享）"""
+        tokenizer = get_model_config(model_name)["tokenizer"]
+        return get_tokenized(
+            self.name, tokenizer, lambda: self._load_knowledge(model_name))
+
+    def knowledge_token_count(self, model_name):
+        """背景资料的 token 数（优先读取元数据，不加载资料）"""
+        tokenizer = get_model_config(model_name)["tokenizer"]
+        return get_token_count(
+            self.name, tokenizer, lambda: self._load_knowledge(model_name))
+
+    def persona_tokens(self, model_name):
+        """计算基本 token（不含背景资料的人设提示词）"""
+        tokenizer = get_model_config(model_name)["tokenizer"]
+        if tokenizer not in self._persona_tokens:
+            self._persona_tokens[tokenizer] = self.count_tokens(
+                self.expert.get_system_prompt(knowledge=""), model_name)
+        return self._persona_tokens[tokenizer]
+
+    def max_output_tokens(self, model_name):
+        """为回答预留的 tokens"""
+        return min(MAX_OUTPUT_TOKENS, get_model_config(model_name)["max_output"])
+
+    def count_tokens(self, text, model_name=DEFAULT_MODEL):
         """计算文本的 token 数量"""
-        return len(encoding.encode(text))
-
-    def adjust_knowledge_base(self):
-        """根据对话历史动态调整知识库大小"""
-        # 计算可用于知识库的 tokens
-        available_tokens = (MAX_TOKENS - self.base_tokens -
-                            self.history_tokens - self.tokens_per_turn)
-
-        # 确保至少保留定比例的知识库内容
-        min_knowledge_tokens = min(
-            80000, available_tokens)  # 提高最小保留量到80k tokens
-        max_knowledge_tokens = max(min_knowledge_tokens, available_tokens)
-
-        # 截断知识库内容
-        self.knowledge_base = truncate_text(
-            self.original_knowledge, max_knowledge_tokens)
-
-        # 记录调整信息
-        logger.info(f"知识库调整：历史tokens={self.history_tokens}, "
-                    f"可用tokens={available_tokens}, "
-                    f"分配给知识库tokens={max_knowledge_tokens}")
-
-    def get_system_prompt(self):
-        """获取当前的系统提示词"""
-        # 使��� Expert 類的系統提示
-        return self.expert.get_system_prompt()
-
-    def update_chat_history(self, question, answer):
+        return len(get_encoding(model_name).encode(text, disallowed_special=()))
+
+    def estimate_prompt_tokens(self, model_name, prompt_tokens=0):
+        """用缓存的 token 数估算一次请求的输入 tokens"""
+        persona = self.persona_tokens(model_name)
+        max_output = self.max_output_tokens(model_name)
+        knowledge_budget = max(0, get_context_window(model_name) - max_output -
+                               persona - prompt_tokens - self.history_tokens)
+        knowledge = min(self.knowledge_token_count(model_name),
+                        knowledge_budget)
+        return persona + knowledge + self.history_tokens + prompt_tokens
+
+    def retrieved_chunks(self, hits, model_name):
+        """把检索结果 [(起始字节, 结束字节, 相似度)] 转成 [(text, tokens)]，token 数来自预计算的偏移"""
+        if not hits:
+            return None
+        knowledge = self._get_knowledge(model_name)
+        chunks = []
+        for start, end, _ in hits:
+            tokens = (bisect_left(knowledge.offsets, end)
+                      - bisect_left(knowledge.offsets, start))
+            chunks.append((knowledge.data[start:end].decode("utf-8", errors="ignore"),
+                           tokens))
+        return chunks
+
+    def adjust_knowledge_base(self, model_name=DEFAULT_MODEL, prompt_tokens=0,
+                              chunks=None, knowledge_limit=None):
+        """根据对话历史和当前问题在模型上下文窗口内分配知识库预算"""
+        plan = allocate_context(
+            context_window=get_context_window(model_name),
+            max_output=self.max_output_tokens(model_name),
+            persona_tokens=self.persona_tokens(model_name),
+            prompt_tokens=prompt_tokens,
+            history=self.chat_history,
+            knowledge=self._get_knowledge(model_name),
+            chunks=chunks,
+            knowledge_limit=knowledge_limit
+        )
+        return plan
+
+    def build_request(self, prompt, model_name, hits=None):
+        """按预算计划构建一次请求的消息列表和输出上限，不调用模型（供批量接口使用）"""
+        plan = self.adjust_knowledge_base(
+            model_name,
+            prompt_tokens=self.count_tokens(prompt, model_name),
+            chunks=self.retrieved_chunks(hits, model_name))
+        return self.build_messages(plan, prompt), plan["max_output"]
+
+    def cached_response(self, prompt, model_name, hits=None):
+        """查共享的回应缓存（按当前历史和预算计划计算请求键，不调用模型）"""
+        if not RESPONSE_CACHE_TTL:
+            return None
+        messages, max_tokens = self.build_request(prompt, model_name, hits)
+        key = request_key(model_name, self.name, messages,
+                          temperature=0.7, max_tokens=max_tokens)
+        return get_backend().cache_get(f"response:{key}")
+
+    def get_system_prompt(self, plan=None):
+        """获取系统提示词（背景资料按预算计划分配，默认按默认模型分配）"""
+        if plan is None:
+            plan = self.adjust_knowledge_base()
+        return self.expert.get_system_prompt(knowledge=plan["knowledge"])
+
+    def update_chat_history(self, question, answer, model_name=DEFAULT_MODEL):
         """新对话历史"""
         # 计算新对话的 tokens
-        new_qa_tokens = self.count_tokens(f"Q: {question}\nA: {answer}")
+        new_qa_tokens = self.count_tokens(
+            f"Q: {question}\nA: {answer}", model_name)
+        history_limit = get_context_window(model_name) * 0.3  # 历史最多占用30%
 
         # 如果需要移除旧对话
-        while (self.history_tokens + new_qa_tokens > MAX_TOKENS * 0.3 and  # 历史最多占用30%
+        while (self.history_tokens + new_qa_tokens > history_limit and
                self.chat_history):
             # 移除最早的对话并减少 token 计数
-            old_q, old_a = self.chat_history.pop(0)
-            removed_tokens = self.count_tokens(f"Q: {old_q}\nA: {old_a}")
+            _, _, removed_tokens = self.chat_history.pop(0)
             self.history_tokens -= removed_tokens
             logger.info(f"移除旧对话，释放 {removed_tokens} tokens")
 
-        # 添加新对话
-        self.chat_history.append((question, answer))
+        # 添加新对话（连同 token 数一起缓存）
+        self.chat_history.append((question, answer, new_qa_tokens))
         self.history_tokens += new_qa_tokens
 
         logger.info(f"添加新对话，使用 {new_qa_tokens} tokens，"
                     f"当前历史总计 {self.history_tokens} tokens")
 
-        self.adjust_knowledge_base()  # 重新调整知识库大小
+    def build_messages(self, plan, prompt):
+        """按预算计划构建消息列表"""
+        # 每次對話都會帶入系統提示（包含按预算分配的專家背景）
+        messages = [
+            {
+                "role": "system",
+                "content": self.get_system_prompt(plan)
+            }
+        ]
+
+        # 然後加入預算內的歷史對話
+        for old_q, old_a in plan["history"]:
+            messages.append({"role": "user", "content": old_q})
+            messages.append({"role": "assistant", "content": old_a})
+
+        # 最後加入當前問題
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    async def _stream_completion(self, model_name, messages, max_tokens, publish, http_span):
+        """流式调用，每个增量交给 publish，返回 (完整回应, 用量, 首个 token 的耗时)"""
+        started = time.time()
+        stream = await get_client(model_name).chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        parts, usage, first_token = [], None, None
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage  # 最后一个片段带用量，没有 choices
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if first_token is None:
+                first_token = time.time() - started
+                http_span.add_event("first_token")
+            parts.append(delta)
+            publish(delta)
+        return "".join(parts), usage, first_token
+
+    async def _call_model(self, model_name, messages, max_tokens, reservation, publish=None):
+        """
+        调用模型 API，并按实际用量结算 token 预留；模型熔断时不发请求，直接抛出 CircuitOpenError
+
+        publish: 传入时流式调用，每个增量到达就交给 publish
+        """
+        from openai import APIConnectionError, RateLimitError
+
+        breaker = get_breaker(model_name)
+        try:
+            breaker.allow()
+            await rate_limiter.acquire()
+            started = time.time()
+            with span("http_request", model=model_name, max_tokens=max_tokens,
+                      stream=publish is not None) as http_span:
+                if publish is None:
+                    response = await get_client(model_name).chat.completions.create(
+                        model=model_name,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=max_tokens
+                    )
+                    # 非流式调用时首个 token 与完整回应同时到达
+                    http_span.add_event("first_token")
+                    usage = getattr(response, "usage", None)
+                    content = response.choices[0].message.content
+                    latency = time.time() - started
+                else:
+                    content, usage, latency = await self._stream_completion(
+                        model_name, messages, max_tokens, publish, http_span)
+                http_span.set_attribute(
+                    "total_tokens", getattr(usage, "total_tokens", 0))
+            # 流式调用按首个 token 的耗时判断是否过慢，回应长不算慢
+            breaker.record_success(latency if latency is not None else time.time() - started,
+                                   started)
+            tpm_admission.settle(reservation, getattr(usage, "total_tokens", 0))
+            return content
+        except CircuitOpenError:
+            tpm_admission.release(model_name, reservation)
+            raise
+        except RateLimitError:
+            # 被拒绝的请求不占用 tokens：先归还这次的预留，再占满窗口让后续请求排队
+            tpm_admission.release(model_name, reservation)
+            tpm_admission.saturate(model_name)
+            raise
+        except APIConnectionError as e:
+            # 请求没有到达服务商，归还预留的 tokens
+            tpm_admission.release(model_name, reservation)
+            if breaker.record_failure(e):
+                # 这次失败触发了熔断：不再重试，交给调用方改用其他模型
+                raise CircuitOpenError(model_name, breaker.retry_in()) from e
+            raise
+        except Exception as e:
+            logger.error(f"{model_name} API 调用失败: {str(e)}")
+            # 5xx/4xx 等错误没有得到回应，归还预留；否则重试时会在未归还的预留上再预留一次
+            tpm_admission.release(model_name, reservation)
+            if is_breaker_failure(e) and breaker.record_failure(e):
+                raise CircuitOpenError(model_name, breaker.retry_in()) from e
+            raise
+
+    async def prefill_prompt_cache(self, model_name):
+        """
+        用稳定的系统提示词发一次最短请求，让服务商缓存这段前缀
+
+        只在背景资料整份放得下时进行：按问题检索或截断时每次的系统提示词不同，缓存不到。
+        请求或 token 配额余量不足时直接跳过，不和真正的提问抢配额；
+        发出的请求和提问一样预留请求数（RPM）和 tokens（TPM）
+        """
+        plan = self.adjust_knowledge_base(model_name)
+        if plan["knowledge_mode"] != "full":
+            return False
+        available_requests, _ = available_quota(model_name)
+        if available_requests < get_model_config(model_name)["rpm"] * PREFILL_MIN_HEADROOM:
+            return False
+        reservation = tpm_admission.try_reserve(model_name, plan["prompt_tokens"])
+        if reservation is None:
+            return False
+        if not reserve_quota(model_name, 1):
+            tpm_admission.release(model_name, reservation)
+            return False
+        messages = self.build_messages(plan, "OK")
+        await self._call_model(model_name, messages, 1, reservation)
+        return True
 
     # 修改装饰器
     @retry(
-        retry=retry_if_exception_type(
-            (APIConnectionError, APITimeoutError, RateLimitError)),
+        retry=retry_if_exception(is_retryable_error),
         wait=wait_exponential(multiplier=1, min=1, max=10),
         stop=stop_after_attempt(3)
     )
-    async def get_response(self, prompt):
-        """获取专家回应"""
+    async def get_response(self, prompt, model_name=None, hits=None, on_delta=None,
+                           session_id=None):
+        """
+        获取专家回应（在后台线程运行时需显式传入 model_name）
+
+        hits: 检索到的片段 [(起始字节, 结束字节, 相似度)]，背景资料放不下时按相关性装入
+        on_delta: 接收流式增量的回调；每次尝试开始时先收到 None，表示回应从头开始
+        session_id: 提问的会话，用于跨会话的公平排队和用量统计
+        """
+        current_model = model_name or get_current_model()
+        if on_delta is not None:
+            on_delta(None)
         try:
             logger.info(f"开始处理家 {self.name} 的回应")
-            current_model = getattr(
-                st.session_state, 'current_model', 'grok-beta')
-
-            # 每次對話都會帶入完整的系統提示
-            messages = [
-                {
-                    "role": "system",
-                    "content": self.expert.get_system_prompt()  # 包含專家背景
-                }
-            ]
-
-            # 然後加入歷史對話
-            for old_q, old_a in self.chat_history:
-                messages.append({"role": "user", "content": old_q})
-                messages.append({"role": "assistant", "content": old_a})
-
-            # 最後加入當前問題
-            messages.append({"role": "user", "content": prompt})
-
-            # 記錄請求內容
-            logger.info({
-                "action": "send_to_ai_api",
-                "expert": self.name,
-                "model": current_model,
-                "request_data": {
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "max_tokens": MAX_TOKENS,
-                    "system_prompt": messages[0]["content"],  # 完整記錄系統提示
-                    "history_length": len(self.chat_history),
-                    "history_tokens": self.history_tokens
-                },
-                "timestamp": datetime.now().isoformat()
-            })
 
-            try:
-                await rate_limiter.acquire()
-                response = await client.chat.completions.create(
-                    model="grok-beta",
-                    messages=messages,
-                    temperature=0.7
-                )
-                answer = response.choices[0].message.content
-            except Exception as e:
-                logger.error(f"Grok API 调用失败: {str(e)}")
-                raise
+            # 按当前模型的上下文预算分配背景资料和历史对话
+            prompt_tokens = self.count_tokens(prompt, current_model)
+            chunks = self.retrieved_chunks(hits, current_model)
+            plan = self.adjust_knowledge_base(
+                current_model, prompt_tokens=prompt_tokens, chunks=chunks)
+            messages = self.build_messages(plan, prompt)
+            key = request_key(current_model, self.name, messages,
+                              temperature=0.7, max_tokens=plan["max_output"])
+
+            # 共享的回应缓存（多个会话/进程之间）命中时不再调用模型
+            cached_answer = (get_backend().cache_get(f"response:{key}")
+                             if RESPONSE_CACHE_TTL else None)
+
+            reservation = None
+            if cached_answer is None and not single_flight.in_flight(key):
+                # 用预算计划里缓存的 token 数向 TPM 预算申请配额（不足时排队或缩小知识库）
+                with span("tpm_admission", tokens=plan["prompt_tokens"]):
+                    reservation, knowledge_limit = await tpm_admission.admit(
+                        current_model, plan["prompt_tokens"],
+                        fixed_tokens=plan["prompt_tokens"] - plan["knowledge_tokens"])
+                if knowledge_limit is not None:
+                    plan = self.adjust_knowledge_base(
+                        current_model,
+                        prompt_tokens=prompt_tokens,
+                        chunks=chunks,
+                        knowledge_limit=knowledge_limit)
+                    messages = self.build_messages(plan, prompt)
+                    key = request_key(current_model, self.name, messages,
+                                      temperature=0.7, max_tokens=plan["max_output"])
+
+            # 記錄請求摘要（系統提示可能有十万 tokens，只记录预览和哈希）
+            log_event(logger, "send_to_ai_api",
+                      expert=self.name,
+                      model=current_model,
+                      request_key=key[:16],
+                      request_data={
+                          "messages": messages,
+                          "temperature": 0.7,
+                          "max_tokens": plan["max_output"],
+                          "prompt_tokens": plan["prompt_tokens"],
+                          "knowledge_mode": plan["knowledge_mode"],
+                          "system_prompt_sha256": digest(messages[0]["content"]),
+                          "history_length": len(plan["history"]),
+                          "history_tokens": plan["history_tokens"]
+                      })
+
+            async def call_model(publish):
+                # 检查时相同请求还在进行（没有申请配额），到这里却由本请求发出时，补做 token 准入
+                if reservation is None:
+                    with span("tpm_admission", tokens=plan["prompt_tokens"]):
+                        call_reservation, _ = await tpm_admission.admit(
+                            current_model, plan["prompt_tokens"])
+                else:
+                    call_reservation = reservation
+                # 拿到 token 配额后再按会话公平排队，排在 TPM 队列里时不占用并发名额
+                try:
+                    with span("scheduler_wait", tokens=plan["prompt_tokens"]):
+                        await scheduler.acquire(session_id, plan["prompt_tokens"],
+                                                session_weight(session_id, current_model))
+                except BaseException:
+                    # 排队时被取消，请求没有发出
+                    tpm_admission.release(current_model, call_reservation)
+                    raise
+                try:
+                    answer = await self._call_model(
+                        current_model, messages, plan["max_output"], call_reservation, publish)
+                finally:
+                    scheduler.release(session_id)
+                scheduler.record_usage(session_id, plan["prompt_tokens"])
+                if RESPONSE_CACHE_TTL:
+                    get_backend().cache_set(
+                        f"response:{key}", answer, RESPONSE_CACHE_TTL)
+                return answer
+
+            expert_span = current_span()
+            if expert_span is not None:
+                expert_span.set_attribute("knowledge_mode", plan["knowledge_mode"])
+                expert_span.set_attribute("cache_hit", cached_answer is not None)
+                expert_span.set_attribute(
+                    "coalesced",
+                    cached_answer is None and single_flight.in_flight(key))
+
+            if cached_answer is not None:
+                logger.info(f"专家 {self.name} 命中回应缓存")
+                answer = cached_answer
+            else:
+                # 相同的并发请求（例如多个会话提交同一主题）只调用一次
+                if reservation is not None and single_flight.in_flight(key):
+                    tpm_admission.release(current_model, reservation)
+                    reservation = None
+                answer = await single_flight.do(key, call_model, on_chunk=on_delta)
 
             # 記錄回應內容
-            logger.info({
-                "action": "receive_from_ai_api",
-                "expert": self.name,
-                "model": current_model,
-                "response_data": {
-                    "content_length": len(answer),
-                    "content_preview": answer[:200] + "..." if len(answer) > 200 else answer
-                },
-                "timestamp": datetime.now().isoformat()
-            })
-
-            self.update_chat_history(prompt, answer)
+            log_event(logger, "receive_from_ai_api",
+                      expert=self.name,
+                      model=current_model,
+                      response_data={
+                          "content_length": len(answer),
+                          "content": answer
+                      })
+
+            with span("history_update"):
+                self.update_chat_history(prompt, answer, current_model)
             return answer
 
         except Exception as e:
-            logger.error({
-                "action": "api_call_error",
-                "expert": self.name,
-                "model": current_model,
-                "error": str(e),
-                "timestamp": datetime.now().isoformat()
-            })
+            log_event(logger, "api_call_error", level=logging.ERROR,
+                      expert=self.name,
+                      model=current_model,
+                      error=str(e))
             raise
 
 
-async def get_responses_async(experts, prompt):
+async def get_responses_async(experts, prompt, model_name=None, summary_agent=None,
+                              on_delta=None, session_id=None):
+    """
+    并发获取所有专家回应，每完成一个就产出 (expert, response)，最后产出总结
+
+    在后台线程运行时没有 st.session_state，需显式传入 model_name 和 summary_agent
+    on_delta: 接收流式增量的回调 on_delta(expert, delta)，delta 为 None 表示回应重新开始
+    session_id: 提问的会话（批量生成等没有会话时为 None）
+    """
+    model_name = model_name or get_current_model()
+    if summary_agent is None:
+        summary_agent = st.session_state.titans
+
     start_time = time.time()
     logger.info(f"开始并发处理所有专家回应，时间: {start_time}")
 
-    # 獲取當前事件循環
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-    async def get_expert_response(expert):
+    # 派发请求前为所有专家做一次检索（问题只嵌入一次，每位专家在自己的索引上打分）
+    with span("retrieval", experts=len(experts)) as retrieval_span:
         try:
-            response = await expert.get_response(prompt)
-            return expert, response, time.time()
+            hits = await asyncio.to_thread(
+                retrieve, [expert.name for expert in experts], prompt)
         except Exception as e:
-            logger.error(f"专家 {expert.name} 处理失败: {str(e)}")
-            return expert, f"抱歉，生成回应时出现错误: {str(e)}", time.time()
+            retrieval_span.record_error(e)
+            logger.warning(f"检索失败，背景资料改为首尾截断: {e}")
+            hits = {}
+
+    async def get_expert_response(expert):
+        # 每位专家一个 span，重试时下面会出现多组限速等待和 HTTP 请求
+        with span("expert", expert=expert.name) as expert_span:
+            expert_delta = ((lambda delta: on_delta(expert, delta))
+                            if on_delta is not None else None)
+            try:
+                try:
+                    response = await expert.get_response(
+                        prompt, model_name, hits=hits.get(expert.name),
+                        on_delta=expert_delta, session_id=session_id)
+                except CircuitOpenError as e:
+                    # 模型熔断时改用健康的模型回答，找不到时照常显示错误
+                    fallback = reroute_model(model_name)
+                    if fallback is None:
+                        raise
+                    logger.warning(f"{e}，专家 {expert.name} 改用 {fallback} 回答")
+                    expert_span.set_attribute("rerouted_to", fallback)
+                    response = await expert.get_response(
+                        prompt, fallback, hits=hits.get(expert.name),
+                        on_delta=expert_delta, session_id=session_id)
+                return expert, response, time.time()
+            except Exception as e:
+                expert_span.record_error(e)
+                logger.error(f"专家 {expert.name} 处理失败: {str(e)}")
+                return expert, f"{ERROR_RESPONSE_PREFIX}: {str(e)}", time.time()
 
     # 創建所有任務
-    tasks = []
-    for expert in experts:
-        try:
-            # 確保使用同一個事件循環
-            task = loop.create_task(get_expert_response(expert))
-            tasks.append(task)
-        except Exception as e:
-            logger.error(f"创建任务失败: {str(e)}")
-            continue
+    tasks = [asyncio.ensure_future(get_expert_response(expert))
+             for expert in experts]
 
     if not tasks:
         logger.error("没有成功创建任何任务")
         return
 
     try:
-        # 使用 gather 而不是 as_completed
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-
-        # 處理每個回應
-        for expert, response, finish_time in responses:
-            if isinstance(response, Exception):
-                logger.error(f"专家 {expert.name} 处理失败: {str(response)}")
-                yield expert, f"抱歉，生成回应时出现错误: {str(response)}"
-            else:
-                logger.info(
-                    f"专家 {expert.name} 响应完成，耗时: {finish_time - start_time:.2f}秒")
-                yield expert, response
+        # 每完成一个专家就产出，让前端可以逐个显示进度
+        responses = []
+        for next_done in asyncio.as_completed(tasks):
+            expert, response, finish_time = await next_done
+            responses.append((expert, response, finish_time))
+            logger.info(
+                f"专家 {expert.name} 响应完成，耗时: {finish_time - start_time:.2f}秒")
+            yield expert, response
+
+        # 總結按原始專家順序整合
+        order = {expert.name: idx for idx, expert in enumerate(experts)}
+        responses.sort(key=lambda item: order[item[0].name])
 
         # 生成總結
         try:
-            # 過濾出成功的回應
-            valid_responses = [
-                (e, r) for e, r, _ in responses if not isinstance(r, Exception)]
+            valid_responses = [(e, r) for e, r, _ in responses]
             if valid_responses:
                 experts_for_summary, responses_for_summary = zip(
                     *valid_responses)
-                summary = await generate_summary(prompt, responses_for_summary, experts_for_summary)
-                yield st.session_state.titans, summary
+                with span("summary", experts=len(experts_for_summary)):
+                    summary = await generate_summary(
+                        prompt, responses_for_summary, experts_for_summary, model_name,
+                        session_id)
+                yield summary_agent, summary
             else:
                 logger.error("没有成功的回应可以生成总结")
-                yield st.session_state.titans, "抱歉，由于所有专家回应都失败，无法生成总结。"
+                yield summary_agent, "抱歉，由于所有专家回应都失败，无法生成总结。"
         except Exception as e:
             logger.error(f"生成总结时出错: {str(e)}")
-            yield st.session_state.titans, "抱歉，生成总结时出现错误。"
+            yield summary_agent, "抱歉，生成总结时出现错误。"
 
     except Exception as e:
         logger.error(f"处理响应过程中出错: {str(e)}")
         raise
 
 
-async def generate_summary(prompt, responses, experts):
-    """生成总结"""
-    logger.info("开始生成总结...")
-
+def build_summary_messages(responses, experts):
+    """构建总结请求的消息列表（交互和批量生成共用）"""
     # 動態構建專家回應列表
     expert_responses = []
     for expert, response in zip(experts, responses):
@@ -398,20 +659,64 @@ async def generate_summary(prompt, responses, experts):
 """
         }
     ]
+    return messages
 
-    logger.info({
-        "action": "generate_summary",
-        "system_prompt": messages[0]["content"],
-        "user_prompt": messages[1]["content"][:200] + "..."
-    })
+
+async def generate_summary(prompt, responses, experts, model_name=None, session_id=None):
+    """生成总结（与专家请求一起按会话公平排队）"""
+    logger.info("开始生成总结...")
+    messages = build_summary_messages(responses, experts)
+
+    log_event(logger, "generate_summary",
+              system_prompt=messages[0]["content"],
+              user_prompt=messages[1]["content"])
 
     try:
         # 使用异步 API 调用
-        summary_response = await client.chat.completions.create(
-            model="grok-beta",
-            messages=messages,
-            temperature=0.7
-        )
+        current_model = model_name or get_current_model()
+        breaker = get_breaker(current_model)
+        try:
+            breaker.allow()
+        except CircuitOpenError:
+            current_model = reroute_model(current_model)
+            if current_model is None:
+                raise
+            breaker = get_breaker(current_model)
+            breaker.allow()
+        from openai import RateLimitError
+
+        # 总结与专家请求一样先申请 token 配额，不足时排队
+        encoding = get_encoding(current_model)
+        summary_tokens = sum(len(encoding.encode(message["content"], disallowed_special=()))
+                             for message in messages)
+        with span("tpm_admission", tokens=summary_tokens):
+            reservation, _ = await tpm_admission.admit(current_model, summary_tokens)
+        try:
+            await scheduler.acquire(session_id, summary_tokens,
+                                    session_weight(session_id, current_model))
+        except BaseException:
+            tpm_admission.release(current_model, reservation)
+            raise
+        started = time.time()
+        try:
+            summary_response = await get_client(current_model).chat.completions.create(
+                model=current_model,
+                messages=messages,
+                temperature=0.7
+            )
+        except Exception as e:
+            tpm_admission.release(current_model, reservation)
+            if isinstance(e, RateLimitError):
+                tpm_admission.saturate(current_model)
+            elif is_breaker_failure(e):
+                breaker.record_failure(e)
+            raise
+        finally:
+            scheduler.release(session_id)
+        breaker.record_success(time.time() - started, started)
+        usage = getattr(summary_response, "usage", None)
+        tpm_admission.settle(reservation, getattr(usage, "total_tokens", 0))
+        scheduler.record_usage(session_id, summary_tokens)
         summary = summary_response.choices[0].message.content
         return summary
     except Exception as e:
@@ -420,4 +725,5 @@ async def generate_summary(prompt, responses, experts):
         logger.exception(e)
         return "抱歉，无法生成总结。"
 
-__all__ = ['ExpertAgent', 'get_responses_async', 'generate_summary']
+__all__ = ['ExpertAgent', 'build_prompt', 'build_summary_messages',
+           'get_responses_async', 'generate_summary']
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+from utils.extractors import EXTRACTORS
+from utils.log import log_event
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+INDEX_DIR_NAME = ".index"  # 每个专家目录下存放派生数据（元数据、画像、索引）
+CACHE_MAX_BYTES = int(st.secrets.get("BACKGROUND_CACHE_MB", 256)) * 1024 * 1024
+FINGERPRINT_TTL_SECONDS = float(st.secrets.get("FINGERPRINT_TTL_SECONDS", 5))  # 资料指纹缓存多久（期间不重新扫描目录）
+
+
+class LRUByteCache:
+    """按字节上限淘汰的 LRU 缓存，所有会话共享"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self._loading = {}  # key -> threading.Lock，避免同一项被并发加载多次
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes and len(self._items) > 1:
+                old_key, (_, old_bytes) = self._items.popitem(last=False)
+                self.current_bytes -= old_bytes
+                logger.info(f"缓存淘汰 {old_key}，释放 {old_bytes} 字节，"
+                            f"当前 {self.current_bytes}/{self.max_bytes}")
+
+    def get_or_load(self, key, loader, sizeof):
+        """命中则返回缓存值，否则调用 loader 加载并按 sizeof 计量"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.get(key)
+            if value is None:
+                value = loader()
+                self.put(key, value, sizeof(value))
+        with self._lock:
+            self._loading.pop(key, None)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._items), "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+
+# 创建全局背景资料缓存
+background_cache = LRUByteCache(CACHE_MAX_BYTES)
+
+
+def expert_dir(name):
+    return os.path.join(DATA_DIR, name)
+
+
+def index_dir(name):
+    return os.path.join(expert_dir(name), INDEX_DIR_NAME)
+
+
+def source_files(name):
+    """专家目录下所有可提取的资料文件（相对路径，按名称排序，跳过索引目录）"""
+    root = expert_dir(name)
+    files = []
+    for current, dirs, filenames in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in EXTRACTORS:
+                files.append(os.path.relpath(os.path.join(current, filename), root))
+    return sorted(files)
+
+
+_fingerprints = {}  # 专家名 -> (过期时间, 指纹)
+_fingerprints_lock = threading.Lock()
+
+
+def source_fingerprint(name):
+    """
+    所有资料文件的路径、大小和修改时间，用于判断派生数据是否过期；没有资料时为 None
+
+    元数据、画像、语料和索引都用它判断是否过期，一次提问里会调用很多次；
+    结果缓存 FINGERPRINT_TTL_SECONDS 秒，资料文件的变化最多晚这么久被发现
+    """
+    now = time.monotonic()
+    with _fingerprints_lock:
+        cached = _fingerprints.get(name)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    fingerprint = _scan_fingerprint(name)
+    with _fingerprints_lock:
+        _fingerprints[name] = (now + FINGERPRINT_TTL_SECONDS, fingerprint)
+    return fingerprint
+
+
+def clear_fingerprints():
+    """清空资料指纹缓存（资料文件整体更新后，例如数据下载完成时）"""
+    with _fingerprints_lock:
+        _fingerprints.clear()
+
+
+def _scan_fingerprint(name):
+    fingerprint = []
+    for relpath in source_files(name):
+        try:
+            stat = os.stat(os.path.join(expert_dir(name), relpath))
+        except OSError:
+            continue
+        fingerprint.append([relpath, stat.st_size, int(stat.st_mtime)])
+    return fingerprint or None
+
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"写入 {path} 失败: {e}")
+
+
+def load_meta(name):
+    """读取专家元数据，资料文件变化后视为过期"""
+    meta = _read_json(os.path.join(index_dir(name), "meta.json"))
+    fingerprint = source_fingerprint(name)
+    if not meta or meta.get("source") != fingerprint:
+        return {"source": fingerprint, "token_counts": {}}
+    return meta
+
+
+def save_meta(name, meta):
+    _write_json(os.path.join(index_dir(name), "meta.json"), meta)
+
+
+def read_background(name):
+    """从磁盘语料读取专家背景资料（首次使用时从资料文件构建）"""
+    from utils.corpus import open_corpus  # corpus 依赖本模块
+
+    try:
+        background = open_corpus(name).text() if source_fingerprint(name) else ""
+        log_event(logger, "load_expert_background",
+                  expert=name,
+                  background_length=len(background),
+                  background=background)
+        return background
+    except Exception as e:
+        logger.error(f"Error loading background for {name}: {e}")
+        return ""
+
+
+def get_background(name):
+    """获取背景资料（首次使用时加载，由 LRU 缓存管理）"""
+    return background_cache.get_or_load(
+        (name, "text"), lambda: read_background(name),
+        lambda text: len(text.encode("utf-8")))
+
+
+def get_tokenized(name, tokenizer, loader):
+    """获取背景资料的 token 偏移（每种分词器一份，由 LRU 缓存管理）"""
+    def load():
+        tokenized = loader()
+        # 顺便记录 token 数，之后估算时不需要加载资料
+        meta = load_meta(name)
+        meta["token_counts"][tokenizer] = tokenized.token_count
+        save_meta(name, meta)
+        return tokenized
+
+    return background_cache.get_or_load(
+        (name, f"tokens:{tokenizer}"), load, lambda t: t.nbytes)
+
+
+def get_token_count(name, tokenizer, loader):
+    """获取背景资料的 token 数：优先读元数据，没有时加载并计算"""
+    count = load_meta(name)["token_counts"].get(tokenizer)
+    if count is None:
+        count = get_tokenized(name, tokenizer, loader).token_count
+    return count
+
+
+def get_profile(name, builder):
+    """获取专家关键词画像：内存缓存 → 磁盘 → 重新构建"""
+    def load():
+        path = os.path.join(index_dir(name), "profile.json")
+        cached = _read_json(path)
+        if cached and cached.get("source") == source_fingerprint(name):
+            return cached["terms"]
+        terms = dict(builder(get_background(name)))
+        _write_json(path, {"source": source_fingerprint(name), "terms": terms})
+        return terms
+
+    return background_cache.get_or_load(
+        (name, "profile"), load,
+        lambda terms: sum(len(t.encode("utf-8")) + 64 for t in terms))
@@ -0,0 +1,233 @@
+import logging
+import os
+import re
+import zipfile
+from io import BytesIO
+from xml.etree import ElementTree
+
+from utils.html_text import epub_to_text, html_to_text
+from utils.log import log_event
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 提取选项：本模块会在提取进程池的子进程里导入，不读取 Streamlit 配置，
+# 由主进程读取后调用 configure_extractors 设置（子进程通过进程池的 initializer 设置）
+EXTRACT_OPTIONS = {
+    "ocr_enabled": False,  # 扫描版 PDF 的页面没有文字层时，用本地 OCR 识别（需要 pytesseract、pdf2image 和 tesseract）
+    "ocr_languages": "chi_sim+chi_tra+eng",
+    "epub_workers": 1,  # 大 EPUB 按章节并行提取的进程数
+}
+OCR_DPI = 200
+MIN_PAGE_CHARS = 20  # 少于这么多字符的页面视为图片页
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_HEADING_STYLE_RE = re.compile(r"(?:heading|标题|title)\s*(\d*)", re.IGNORECASE)
+
+
+def configure_extractors(options):
+    """设置提取选项（主进程读取配置后调用，也用作进程池的 initializer）"""
+    EXTRACT_OPTIONS.update(options)
+
+
+def _ocr_pdf_page(pdf_bytes, page_number):
+    """对 PDF 的第 page_number 页（从 1 开始）做 OCR"""
+    import pytesseract
+    from pdf2image import convert_from_bytes
+
+    images = convert_from_bytes(pdf_bytes, dpi=OCR_DPI,
+                                first_page=page_number, last_page=page_number)
+    return "\n".join(pytesseract.image_to_string(image, lang=EXTRACT_OPTIONS["ocr_languages"])
+                     for image in images)
+
+
+def read_pdf(file_path):
+    """读取 PDF 文件内容（file_path 可以是路径或文件对象）"""
+    import PyPDF2  # 解析库较重，用到时才导入
+
+    try:
+        log_event(logger, "read_pdf_start", file=file_path)
+        if not file_path:
+            return ''
+
+        if isinstance(file_path, (str, os.PathLike)):
+            with open(file_path, 'rb') as file:
+                pdf_bytes = file.read()
+        else:
+            pdf_bytes = file_path.read()
+
+        reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
+
+        pages = []
+        ocr_pages = 0
+        for page_number, page in enumerate(reader.pages, start=1):
+            page_text = page.extract_text() or ''
+            if EXTRACT_OPTIONS["ocr_enabled"] and len(page_text.strip()) < MIN_PAGE_CHARS:
+                try:
+                    page_text = _ocr_pdf_page(pdf_bytes, page_number)
+                    ocr_pages += 1
+                except Exception as e:
+                    log_event(logger, "ocr_page_error", level=logging.WARNING,
+                              file=file_path,
+                              page=page_number,
+                              error=str(e))
+            pages.append(page_text)
+        text = '\n'.join(pages)
+
+        log_event(logger, "read_pdf_complete",
+                  file=file_path,
+                  pages=len(pages),
+                  ocr_pages=ocr_pages,
+                  content_length=len(text),
+                  content=text)
+        return text
+    except Exception as e:
+        log_event(logger, "read_pdf_error", level=logging.ERROR,
+                  file=file_path,
+                  error=str(e))
+        return ''
+
+
+def _read_epub_ebooklib(file_path):
+    """用 ebooklib 读取（快速路径解析不了的非标准 EPUB）"""
+    import ebooklib  # 解析库较重，用到时才导入
+    from ebooklib import epub
+
+    book = epub.read_epub(file_path)
+    return "\n\n".join(
+        html_to_text(item.get_content()) for item in book.get_items()
+        if item.get_type() == ebooklib.ITEM_DOCUMENT)
+
+
+def read_epub(file_path):
+    """读取 EPUB 文件内容（按书脊顺序，保留标题和段落结构）"""
+    try:
+        log_event(logger, "read_epub_start", file=file_path)
+
+        try:
+            text = epub_to_text(file_path, workers=EXTRACT_OPTIONS["epub_workers"])
+        except (KeyError, AttributeError, zipfile.BadZipFile,
+                ElementTree.ParseError) as e:
+            log_event(logger, "read_epub_fallback", level=logging.WARNING,
+                      file=file_path,
+                      error=str(e))
+            text = _read_epub_ebooklib(file_path)
+
+        log_event(logger, "read_epub_complete",
+                  file=file_path,
+                  content_length=len(text),
+                  content=text)
+        return text
+    except Exception as e:
+        log_event(logger, "read_epub_error", level=logging.ERROR,
+                  file=file_path,
+                  error=str(e))
+        return ''
+
+
+def read_txt(file_path):
+    """读取 TXT 文件内容"""
+    try:
+        log_event(logger, "read_txt_start", file=file_path)
+
+        with open(file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+
+        log_event(logger, "read_txt_complete",
+                  file=file_path,
+                  content_length=len(content),
+                  content=content)
+        return content
+    except Exception as e:
+        log_event(logger, "read_txt_error", level=logging.ERROR,
+                  file=file_path,
+                  error=str(e))
+        return ''
+
+
+def read_html(file_path):
+    """读取 HTML 文件的正文"""
+    try:
+        log_event(logger, "read_html_start", file=file_path)
+
+        with open(file_path, 'rb') as file:
+            text = html_to_text(file.read())
+
+        log_event(logger, "read_html_complete",
+                  file=file_path,
+                  content_length=len(text),
+                  content=text)
+        return text
+    except Exception as e:
+        log_event(logger, "read_html_error", level=logging.ERROR,
+                  file=file_path,
+                  error=str(e))
+        return ''
+
+
+def read_docx(file_path):
+    """读取 DOCX 文件内容（直接解析 word/document.xml，标题段落保留为 Markdown 标题）"""
+    try:
+        log_event(logger, "read_docx_start", file=file_path)
+
+        with zipfile.ZipFile(file_path) as archive:
+            root = ElementTree.fromstring(archive.read("word/document.xml"))
+
+        paragraphs = []
+        for paragraph in root.iter(f"{_WORD_NS}p"):
+            text = "".join(node.text or "" for node in paragraph.iter()
+                           if node.tag in (f"{_WORD_NS}t", f"{_WORD_NS}tab"))
+            if not text.strip():
+                continue
+            style = paragraph.find(f"{_WORD_NS}pPr/{_WORD_NS}pStyle")
+            match = (_HEADING_STYLE_RE.match(style.get(f"{_WORD_NS}val", ""))
+                     if style is not None else None)
+            if match:
+                level = min(int(match.group(1) or 1), 6)
+                text = f"{'#' * level} {text}"
+            paragraphs.append(text)
+        content = "\n\n".join(paragraphs)
+
+        log_event(logger, "read_docx_complete",
+                  file=file_path,
+                  content_length=len(content),
+                  content=content)
+        return content
+    except Exception as e:
+        log_event(logger, "read_docx_error", level=logging.ERROR,
+                  file=file_path,
+                  error=str(e))
+        return ''
+
+
+# 扩展名 -> 提取函数（接收文件路径，返回纯文本），可以通过 register_extractor 扩展
+EXTRACTORS = {
+    ".pdf": read_pdf,
+    ".epub": read_epub,
+    ".txt": read_txt,
+    ".md": read_txt,  # Markdown 本身就是文本，保留标题供分块使用
+    ".markdown": read_txt,
+    ".html": read_html,
+    ".htm": read_html,
+    ".docx": read_docx,
+}
+
+
+def register_extractor(extension, extractor):
+    """注册文件格式的提取函数"""
+    EXTRACTORS[extension.lower()] = extractor
+
+
+def get_extractor(file_path):
+    return EXTRACTORS.get(os.path.splitext(file_path)[1].lower())
+
+
+def extract_text(file_path):
+    """按扩展名提取文件文本，不支持的格式返回空字符串"""
+    extractor = get_extractor(file_path)
+    if extractor is None:
+        log_event(logger, "load_document_unsupported", level=logging.WARNING,
+                  file=file_path,
+                  file_extension=os.path.splitext(file_path)[1].lower())
+        return ''
+    return extractor(file_path)
@@ -0,0 +1,125 @@
+import multiprocessing
+import posixpath
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+# 本模块会在提取进程池的子进程里导入，不读取 Streamlit 配置；并行进程数由调用方传入
+PARALLEL_MIN_BYTES = 16 * 1024 * 1024  # 章节总大小超过这个值才值得付出启动进程池的开销
+
+_HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "blockquote", "li", "ul", "ol", "tr",
+    "table", "pre", "br", "hr", "dd", "dt", "figcaption", "header", "footer",
+    "aside", "nav", "body",
+}
+_SKIP_TAGS = {"script", "style", "head", "title", "svg", "math"}
+_SPACE_RE = re.compile(r"[ \t\r\n\f\v\u00a0]+")
+
+_OPF_NS = "{http://www.idpf.org/2007/opf}"
+_CONTAINER_NS = "{urn:oasis:names:tc:opendocument:xmlns:container}"
+_DOCUMENT_TYPES = {"application/xhtml+xml", "text/html"}
+
+
+class _TextExtractor(HTMLParser):
+    """流式去掉标签：段落之间空一行，标题保留为 Markdown 标题"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self._current = []
+        self._heading = 0
+        self._skip = 0
+
+    def _flush(self):
+        text = _SPACE_RE.sub(" ", "".join(self._current)).strip()
+        self._current = []
+        if text:
+            if self._heading:
+                text = f"{'#' * self._heading} {text}"
+            self.blocks.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag in _HEADING_TAGS:
+            self._flush()
+            self._heading = _HEADING_TAGS[tag]
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _HEADING_TAGS:
+            self._flush()
+            self._heading = 0
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._current.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def html_to_text(html):
+    """把 HTML/XHTML（str 或 bytes）转成保留标题和段落结构的纯文本"""
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="ignore")
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "\n\n".join(parser.blocks)
+
+
+def epub_chapters(file_path):
+    """按书脊（spine）顺序读取 EPUB 各章节的原始 HTML，不依赖 ebooklib"""
+    with zipfile.ZipFile(file_path) as archive:
+        container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+        rootfile = container.find(f".//{_CONTAINER_NS}rootfile")
+        opf_path = rootfile.get("full-path")
+        opf = ElementTree.fromstring(archive.read(opf_path))
+        base = posixpath.dirname(opf_path)
+
+        manifest = {}
+        for item in opf.iter(f"{_OPF_NS}item"):
+            if item.get("media-type") in _DOCUMENT_TYPES:
+                href = unquote(item.get("href", "").split("#")[0])
+                manifest[item.get("id")] = posixpath.normpath(
+                    posixpath.join(base, href))
+
+        spine = [itemref.get("idref") for itemref in opf.iter(f"{_OPF_NS}itemref")]
+        paths = [manifest[idref] for idref in spine if idref in manifest]
+        # 书脊缺失时按清单顺序
+        if not paths:
+            paths = list(manifest.values())
+
+        names = set(archive.namelist())
+        return [archive.read(path) for path in paths if path in names]
+
+
+def epub_to_text(file_path, workers=1):
+    """提取 EPUB 全文；workers > 1 时大书在主进程中按章节并行转换"""
+    chapters = epub_chapters(file_path)
+    total_bytes = sum(len(chapter) for chapter in chapters)
+    # 已经在进程池的子进程里时（例如批量导入）不再嵌套进程池
+    if (workers > 1 and len(chapters) > 1 and total_bytes >= PARALLEL_MIN_BYTES
+            and multiprocessing.parent_process() is None):
+        with ProcessPoolExecutor(
+                max_workers=min(workers, len(chapters)),
+                mp_context=multiprocessing.get_context("spawn")) as pool:
+            texts = list(pool.map(html_to_text, chapters, chunksize=4))
+    else:
+        texts = [html_to_text(chapter) for chapter in chapters]
+    return "\n\n".join(text for text in texts if text)
@@ -0,0 +1,173 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+import streamlit as st
+
+from utils.profiling import profile_block
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = int(st.secrets.get("MAX_CONCURRENT_JOBS", 4))  # 全局同时运行的对话数
+JOB_TTL_SECONDS = 600  # 完成的任务保留多久（供重新运行后的页面读取结果）
+
+
+class Job:
+    """一次对话任务：按顺序记录每位专家的回应事件，以及生成中回应的流式增量"""
+
+    def __init__(self, session_id=None, profile=False):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.profile = profile
+        self.profile_result = None  # 开启性能分析时，任务结束后填入分析结果
+        self.status = "queued"  # queued / running / done / error / cancelled
+        self.error = None
+        self.events = []
+        self.streams = {}  # 专家名 -> {"generation": 重新开始的次数, "deltas": [增量]}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def append(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def events_since(self, index):
+        """获取第 index 个之后的新事件"""
+        with self._lock:
+            return self.events[index:]
+
+    def append_delta(self, role, delta):
+        """记录流式增量；delta 为 None 表示这位专家的回应重新开始（重试）"""
+        with self._lock:
+            stream = self.streams.setdefault(role, {"generation": 0, "deltas": []})
+            if delta is None:
+                stream["generation"] += 1
+                stream["deltas"] = []
+            else:
+                stream["deltas"].append(delta)
+
+    def deltas_since(self, role, generation, index):
+        """
+        获取增量，返回 (generation, 新增量)
+
+        返回的 generation 与传入的不同时，回应已重新开始，新增量从头算起
+        """
+        with self._lock:
+            stream = self.streams.get(role)
+            if stream is None:
+                return generation, []
+            if stream["generation"] != generation:
+                return stream["generation"], list(stream["deltas"])
+            return generation, stream["deltas"][index:]
+
+
+class JobManager:
+    """在后台线程的事件循环里运行 LLM 任务，不受 Streamlit 重新运行影响"""
+
+    def __init__(self, max_concurrent_jobs=MAX_CONCURRENT_JOBS):
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.thread = threading.Thread(
+            target=self._run_loop, name="llm-worker", daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_jobs)
+        self.loop.run_forever()
+
+    def submit(self, stream_factory, session_id=None, profile=False):
+        """
+        提交任务，返回任务 ID
+
+        stream_factory: 无参函数，返回异步生成器，每个产出值作为一个事件；
+            带 "delta" 字段的产出值是流式增量，记录到 job.streams 而不是事件列表
+        profile: 是否对任务运行期间的工作线程做采样分析
+        """
+        self.cleanup()
+        job = Job(session_id, profile)
+        with self._lock:
+            self.jobs[job.id] = job
+        asyncio.run_coroutine_threadsafe(
+            self._run_job(job, stream_factory), self.loop)
+        logger.info(f"提交任务 {job.id} (session={session_id})")
+        return job.id
+
+    def run_coroutine(self, coro):
+        """在工作线程的事件循环里运行协程，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _run_job(self, job, stream_factory):
+        try:
+            async with self._semaphore:
+                await self._execute(job, stream_factory)
+        except asyncio.CancelledError:
+            # CancelledError 不是 Exception，不处理的话任务会一直停在 running/queued，页面一直轮询
+            logger.warning(f"任务 {job.id} 被取消")
+            job.error = "任务被取消"
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            raise
+
+    async def _execute(self, job, stream_factory):
+        job.status = "running"
+        job.started_at = time.time()
+        # 事件循环里的协程交替执行，cProfile 无法区分，只做墙钟采样
+        profiler = (profile_block(f"job-{job.id[:8]}", deterministic=False)
+                    if job.profile else contextlib.nullcontext())
+        try:
+            with profiler as profile_result:
+                async for event in stream_factory():
+                    if "delta" in event:
+                        job.append_delta(event["role"], event["delta"])
+                    else:
+                        job.append(event)
+            job.profile_result = profile_result
+            job.status = "done"
+        except Exception as e:
+            logger.error(f"任务 {job.id} 失败: {str(e)}", exc_info=True)
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            logger.info(f"任务 {job.id} 结束，状态 {job.status}，"
+                        f"耗时 {job.finished_at - job.started_at:.2f}秒")
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cleanup(self):
+        """清理过期的已完成任务"""
+        cutoff = time.time() - JOB_TTL_SECONDS
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """获取全局任务管理器（首次调用时启动后台线程）"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,122 @@
+import atexit
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import random
+import threading
+
+
+def _secret(key, default):
+    # 提取进程池的子进程也会导入本模块，子进程里用默认值，不导入 Streamlit、不解析 secrets
+    # （spawn 的子进程在反序列化进程池参数时就会导入本模块，此时 parent_process() 还是 None，按进程名判断）
+    if multiprocessing.current_process().name != "MainProcess":
+        return default
+    import streamlit as st
+    return st.secrets.get(key, default)
+
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+LOG_LEVEL = _secret("LOG_LEVEL", "INFO")
+LOG_PREVIEW_CHARS = int(_secret("LOG_PREVIEW_CHARS", 200))  # 超过这个长度的文本只记录预览和哈希
+
+# 各事件的采样率（支持通配符），高频事件默认只记录一部分；可在 secrets 的 LOG_SAMPLE_RATES 中覆盖
+DEFAULT_SAMPLE_RATES = {
+    "quota_status": 0.05,
+    "process_expert_start": 0.1,
+    "register_expert_data": 0.1,
+    "create_expert_agent_*": 0.1,
+    "get_file_type_*": 0.1,
+    "read_*_start": 0.1,
+}
+SAMPLE_RATES = {**DEFAULT_SAMPLE_RATES, **dict(_secret("LOG_SAMPLE_RATES", {}))}
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging():
+    """
+    配置根日志：日志记录只放进队列，由后台线程负责格式化后的写出
+
+    多次调用只生效一次
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger()
+        for old_handler in root.handlers[:]:
+            root.removeHandler(old_handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(LOG_LEVEL)
+
+        _listener = logging.handlers.QueueListener(
+            log_queue, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def digest(value):
+    """内容哈希（前 16 位），用来代替完整内容做对比和关联"""
+    if not isinstance(value, (str, bytes)):
+        value = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return hashlib.sha256(value).hexdigest()[:16]
+
+
+def preview(text, limit=LOG_PREVIEW_CHARS):
+    """截取文本预览"""
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+def redact(value, limit=LOG_PREVIEW_CHARS):
+    """把长文本替换成 {预览, 长度, 哈希}，递归处理字典和列表"""
+    if isinstance(value, str):
+        if len(value) <= limit:
+            return value
+        return {"preview": preview(value, limit), "chars": len(value),
+                "sha256": digest(value)}
+    if isinstance(value, dict):
+        return {key: redact(item, limit) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item, limit) for item in value]
+    return value
+
+
+def sample_rate(action):
+    """事件的采样率：精确匹配优先，其次通配符，默认全部记录"""
+    if action in SAMPLE_RATES:
+        return SAMPLE_RATES[action]
+    for pattern, rate in SAMPLE_RATES.items():
+        if fnmatch.fnmatchcase(action, pattern):
+            return rate
+    return 1.0
+
+
+def log_event(logger, action, level=logging.INFO, **fields):
+    """
+    记录结构化事件：按事件采样，长文本只保留预览和哈希
+
+    警告及以上级别不采样
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = sample_rate(action) if level < logging.WARNING else 1.0
+    if rate < 1 and random.random() >= rate:
+        return
+    event = {"action": action, **redact(fields)}
+    if rate < 1:
+        event["sample_rate"] = rate
+    event["timestamp"] = datetime.datetime.now().isoformat()
+    logger.log(level, event)
@@ -0,0 +1,186 @@
+import html
+import re
+import time
+
+import streamlit as st
+
+# 流式回应刷新气泡的帧率上限：每一帧都要把整个气泡发给浏览器，太频繁反而拖慢页面
+RENDER_FPS = float(st.secrets.get("RENDER_FPS", 15))
+
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_LIST_RE = re.compile(r"^\s*([-*+]|\d+[.)])\s+(.*)$")
+_HR_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+_CODE_SPAN_RE = re.compile(r"(`+)(.+?)\1")
+_LINK_RE = re.compile(r"\[([^\]]+)\]\((https?://[^\s)]+)\)")
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*|__(.+?)__")
+_ITALIC_RE = re.compile(r"(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?![*\w])")
+
+
+def _inline(text):
+    """行内格式：先转义 HTML（模型输出不可信），再处理代码、链接、粗体和斜体"""
+    parts = []
+    last = 0
+    for match in _CODE_SPAN_RE.finditer(text):
+        parts.append(_inline_text(text[last:match.start()]))
+        parts.append(f"<code>{html.escape(match.group(2).strip())}</code>")
+        last = match.end()
+    parts.append(_inline_text(text[last:]))
+    return "".join(parts)
+
+
+def _inline_text(text):
+    text = html.escape(text)
+    text = _LINK_RE.sub(r'<a href="\2" target="_blank">\1</a>', text)
+    text = _BOLD_RE.sub(lambda m: f"<strong>{m.group(1) or m.group(2)}</strong>", text)
+    return _ITALIC_RE.sub(r"<em>\1</em>", text)
+
+
+def _table_cells(line):
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+
+def _render_block(lines):
+    """把一个段落级的块（不含空行）转换成 HTML，输出里不含换行"""
+    if len(lines) >= 2 and "|" in lines[0] and _TABLE_SEPARATOR_RE.match(lines[1]):
+        head = "".join(f"<th>{_inline(c)}</th>" for c in _table_cells(lines[0]))
+        rows = "".join(
+            "<tr>" + "".join(f"<td>{_inline(c)}</td>" for c in _table_cells(line)) + "</tr>"
+            for line in lines[2:])
+        return f"<table><thead><tr>{head}</tr></thead><tbody>{rows}</tbody></table>"
+    if lines[0].lstrip().startswith(">"):
+        inner = [re.sub(r"^\s*>\s?", "", line) for line in lines]
+        return f"<blockquote>{_render_block(inner) if any(inner) else ''}</blockquote>"
+    if _LIST_RE.match(lines[0]):
+        lists = []  # [(标签, [[行]])]，有序和无序列表交替时分成多个列表
+        for line in lines:
+            match = _LIST_RE.match(line)
+            if match:
+                tag = "ul" if match.group(1) in "-*+" else "ol"
+                if not lists or lists[-1][0] != tag:
+                    lists.append((tag, []))
+                lists[-1][1].append([match.group(2)])
+            else:
+                lists[-1][1][-1].append(line.strip())  # 续行属于上一项
+        return "".join(
+            f"<{tag}>"
+            + "".join(f"<li>{'<br>'.join(_inline(t) for t in item)}</li>" for item in items)
+            + f"</{tag}>"
+            for tag, items in lists)
+    # 模型常用单个换行分隔要点，这里保留为换行而不是按 Markdown 合并成一段
+    return f"<p>{'<br>'.join(_inline(line) for line in lines)}</p>"
+
+
+def _render_heading(match):
+    level = len(match.group(1))
+    return f"<h{level}>{_inline(match.group(2))}</h{level}>"
+
+
+def _render_code(lines):
+    # 换行写成字符引用：外层是一个 HTML 块，真实的空行会让 Markdown 解析器把后面的内容当作 Markdown
+    code = "&#10;".join(html.escape(line) for line in lines)
+    return f"<pre><code>{code}</code></pre>"
+
+
+class IncrementalMarkdown:
+    """
+    流式回应的增量 Markdown 渲染
+
+    已结束的块（空行、标题、代码块结束）只转换一次并缓存 HTML，
+    每一帧只重新转换还没结束的最后一块，整段回应的渲染开销与长度成线性关系
+    """
+
+    def __init__(self, fps=RENDER_FPS):
+        self.interval = 1 / fps if fps else 0
+        self.reset()
+
+    def reset(self):
+        """清空内容（重试时回应从头开始）"""
+        self.text = ""
+        self._closed = ""  # 已结束块的 HTML
+        self._lines = []  # 当前块已完整的行
+        self._partial = ""  # 还没有换行的最后一行
+        self._fence = None  # 在代码块里时为开始的围栏符号
+        self._dirty = False
+        self._last_frame = 0.0
+
+    def _close(self):
+        if self._fence is not None:
+            self._closed += _render_code(self._lines)
+        elif self._lines:
+            self._closed += _render_block(self._lines)
+        self._lines = []
+        self._fence = None
+
+    def _add_line(self, line):
+        if self._fence is not None:
+            if line.strip().startswith(self._fence):
+                self._close()
+            else:
+                self._lines.append(line)
+            return
+        fence = _FENCE_RE.match(line)
+        if fence:
+            self._close()
+            self._fence = fence.group(1)
+        elif not line.strip():
+            self._close()
+        elif _HEADING_RE.match(line):
+            self._close()
+            self._closed += _render_heading(_HEADING_RE.match(line))
+        elif _HR_RE.match(line):
+            self._close()
+            self._closed += "<hr>"
+        else:
+            self._lines.append(line)
+
+    def feed(self, delta):
+        """加入新到的增量，只处理新出现的完整行"""
+        if not delta:
+            return
+        self.text += delta
+        *lines, self._partial = (self._partial + delta).split("\n")
+        for line in lines:
+            self._add_line(line.rstrip("\r"))
+        self._dirty = True
+
+    def html(self):
+        """已结束的块加上当前块的 HTML"""
+        lines = self._lines + ([self._partial] if self._partial else [])
+        heading = _HEADING_RE.match(self._partial) if not self._lines else None
+        if self._fence is not None:
+            tail = _render_code(lines)
+        elif heading:
+            tail = _render_heading(heading)
+        elif lines:
+            tail = _render_block(lines)
+        else:
+            tail = ""
+        return self._closed + tail
+
+    def frame(self, now=None):
+        """距离上一帧超过帧间隔且有新内容时返回 HTML，否则返回 None"""
+        now = time.monotonic() if now is None else now
+        if not self._dirty or now - self._last_frame < self.interval:
+            return None
+        self._dirty = False
+        self._last_frame = now
+        return self.html()
+
+    def finish(self, text=None):
+        """结束渲染，返回完整的 HTML；最终内容与已收到的增量不一致时（例如来自缓存）重新渲染"""
+        if text is not None and text != self.text:
+            self.reset()
+            self.feed(text)
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ""
+        self._close()
+        self._dirty = False
+        return self._closed
+
+
+def render_markdown(text):
+    """一次性渲染完整的 Markdown（聊天记录里没有缓存 HTML 的旧消息）"""
+    return IncrementalMarkdown(fps=0).finish(text)
@@ -0,0 +1,149 @@
+import logging
+import threading
+from functools import lru_cache
+
+import streamlit as st
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-2.0-flash-exp"
+
+# 统一的模型注册表：上下文长度、输出上限、RPM/TPM、价格（美元/百万 tokens）和分词器
+# token_scale: 本地分词器只是近似时的安全系数，预算按 context_window / token_scale 计算
+# prompt_cache: 服务商会自动缓存相同的提示词前缀（预热时可以提前填充）
+# batch_cost_ratio: 通过批量接口提交时相对于实时价格的折扣
+MODEL_REGISTRY = {
+    "gemini-2.0-flash-exp": {
+        "label": "Gemini 2.0",
+        "provider": "gemini",
+        "context_window": 1048576,
+        "max_output": 8192,
+        "rpm": 10,
+        "tpm": 4000000,
+        "input_cost": 0.0,
+        "output_cost": 0.0,
+        "tokenizer": "o200k_base",
+        "token_scale": 1.15,
+        "prompt_cache": False,
+        "batch_cost_ratio": 0.5,
+    },
+    "grok-beta": {
+        "label": "Grok",
+        "provider": "xai",
+        "context_window": 131072,
+        "max_output": 4096,
+        "rpm": 60,
+        "tpm": 1000000,
+        "input_cost": 5.0,
+        "output_cost": 15.0,
+        "tokenizer": "cl100k_base",
+        "token_scale": 1.05,
+        "prompt_cache": True,
+        "batch_cost_ratio": 0.5,
+    },
+    "gemini-1.5-flash": {
+        "label": "Gemini 1.5",
+        "provider": "gemini",
+        "context_window": 1048576,
+        "max_output": 8192,
+        "rpm": 10,
+        "tpm": 1000000,
+        "input_cost": 0.075,
+        "output_cost": 0.3,
+        "tokenizer": "o200k_base",
+        "token_scale": 1.15,
+        "prompt_cache": False,
+        "batch_cost_ratio": 0.5,
+    },
+}
+
+# 服务商配置：都通过 OpenAI 兼容接口调用
+# batch_api: 批量接口的格式（"openai" 为 /files + /batches，"gemini" 为 batchGenerateContent）
+# batch_max_requests / batch_max_bytes: 单个批次最多的请求数和请求序列化后的总字节数，超过任一个时拆成多个批次
+PROVIDERS = {
+    "xai": {
+        "api_key_secret": "XAI_API_KEY",
+        "base_url_secret": "XAI_API_BASE",
+        "default_base_url": "https://api.x.ai/v1",
+        "batch_api": "openai",
+        "batch_base_url_secret": "XAI_BATCH_API_BASE",
+        "default_batch_base_url": "https://api.x.ai/v1",
+        "batch_max_requests": 50000,
+        "batch_max_bytes": 100 * 1024 * 1024,  # 上传的 JSONL 文件大小上限
+    },
+    "gemini": {
+        "api_key_secret": "GOOGLE_API_KEY",
+        "base_url_secret": "GEMINI_API_BASE",
+        "default_base_url": "https://generativelanguage.googleapis.com/v1beta/openai/",
+        "batch_api": "gemini",
+        "batch_base_url_secret": "GEMINI_BATCH_API_BASE",
+        "default_batch_base_url": "https://generativelanguage.googleapis.com/v1beta",
+        "batch_max_requests": 1000,
+        "batch_max_bytes": 16 * 1024 * 1024,  # 内联请求的总大小上限是 20MB，留出请求外层结构的余量
+    },
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_model_config(model_name):
+    """获取模型配置，未知模型回退到默认模型"""
+    config = MODEL_REGISTRY.get(model_name)
+    if config is None:
+        logger.warning(f"未知模型 {model_name}，使用 {DEFAULT_MODEL} 的配置")
+        config = MODEL_REGISTRY[DEFAULT_MODEL]
+    return config
+
+
+def get_model_labels():
+    """获取模型选择器使用的 {显示名: 模型名}"""
+    return {config["label"]: name for name, config in MODEL_REGISTRY.items()}
+
+
+def get_context_window(model_name):
+    """获取按分词器误差折算后的可用上下文窗口"""
+    config = get_model_config(model_name)
+    return int(config["context_window"] / config["token_scale"])
+
+
+@lru_cache(maxsize=None)
+def _load_encoding(tokenizer):
+    import tiktoken
+    return tiktoken.get_encoding(tokenizer)
+
+
+def get_encoding(model_name):
+    """获取模型对应的分词器（首次使用时加载）"""
+    return _load_encoding(get_model_config(model_name)["tokenizer"])
+
+
+def count_tokens(text, model_name):
+    """用模型对应的分词器计算 token 数量"""
+    return len(get_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def estimate_cost(model_name, prompt_tokens, output_tokens=0, batch=False):
+    """估算一次请求的费用（美元），batch 为通过批量接口提交"""
+    config = get_model_config(model_name)
+    ratio = config.get("batch_cost_ratio", 1.0) if batch else 1.0
+    return ratio * (prompt_tokens * config["input_cost"] +
+                    output_tokens * config["output_cost"]) / 1000000
+
+
+def get_client(model_name):
+    """获取模型所属服务商的异步客户端（按服务商复用）"""
+    provider = get_model_config(model_name)["provider"]
+    with _clients_lock:
+        if provider not in _clients:
+            from openai import AsyncOpenAI
+            provider_config = PROVIDERS[provider]
+            _clients[provider] = AsyncOpenAI(
+                api_key=st.secrets.get(provider_config["api_key_secret"], ""),
+                base_url=st.secrets.get(
+                    provider_config["base_url_secret"],
+                    provider_config["default_base_url"])
+            )
+            logger.info(f"创建 {provider} 客户端")
+        return _clients[provider]
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+
+from utils.jobs import get_job_manager
+from utils.models import get_client, get_encoding, get_model_config
+from utils.router import get_profile
+from utils.tracing import span
+from utils.vector_index import get_vector_index
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+PREWARM_ENABLED = bool(st.secrets.get("PREWARM", True))  # 会话打开或切换模型时提前准备
+PROMPT_CACHE_PREFILL = bool(st.secrets.get("PROMPT_CACHE_PREFILL", False))  # 预热时填充服务商的提示词缓存（会产生请求费用）
+PREWARM_TTL_SECONDS = 300  # 同一模型和专家阵容在这段时间内只预热一次（服务商的前缀缓存通常保留几分钟）
+CONNECT_TIMEOUT_SECONDS = 5
+
+
+async def _connect(model_name):
+    """建立到服务商的连接（TLS 握手、连接池），失败不影响后续提问"""
+    try:
+        client = get_client(model_name).with_options(timeout=CONNECT_TIMEOUT_SECONDS)
+        await client.models.list()
+    except Exception as e:
+        logger.info(f"预热连接 {model_name} 失败: {e}")
+
+
+def _load_expert(expert, model_name):
+    """加载专家的语料、token 索引、向量索引和路由画像（首次会从资料文件构建）"""
+    expert._get_knowledge(model_name)
+    expert.persona_tokens(model_name)
+    get_vector_index(expert.name)
+    get_profile(expert)
+
+
+async def prewarm(experts, model_name):
+    """在工作线程的事件循环里并发预热：连接、分词器、各专家的语料和索引，可选填充提示词缓存"""
+    started = time.time()
+    with span("prewarm", model=model_name, experts=len(experts)) as prewarm_span:
+        connect = asyncio.ensure_future(_connect(model_name))
+        await asyncio.to_thread(get_encoding, model_name)
+
+        async def warm_expert(expert):
+            try:
+                await asyncio.to_thread(_load_expert, expert, model_name)
+                if PROMPT_CACHE_PREFILL and get_model_config(model_name).get("prompt_cache"):
+                    return await expert.prefill_prompt_cache(model_name)
+            except Exception as e:
+                logger.warning(f"预热专家 {expert.name} 失败: {e}")
+            return False
+
+        prefilled = await asyncio.gather(*(warm_expert(expert) for expert in experts))
+        await connect
+        prewarm_span.set_attribute("prefilled", sum(prefilled))
+    logger.info(f"预热 {model_name} 完成，{len(experts)} 位专家，"
+                f"填充提示词缓存 {sum(prefilled)} 位，耗时 {time.time() - started:.2f}秒")
+
+
+class Prewarmer:
+    """按（模型，专家阵容）去重的预热任务，所有会话共享"""
+
+    def __init__(self, ttl=PREWARM_TTL_SECONDS):
+        self.ttl = ttl
+        self._started = {}  # (模型, 专家名) -> 开始时间
+        self._uses = Counter()  # 专家名 -> 被选中回答问题的次数
+        self._lock = threading.Lock()
+
+    def record_use(self, experts):
+        """记录被选中回答问题的专家，预热时优先准备最常用的"""
+        with self._lock:
+            self._uses.update(expert.name for expert in experts)
+
+    def pick(self, experts, limit, preferred=()):
+        """选出要预热的专家：用户指定的优先，其次按被选中的次数，次数相同时保持原有顺序"""
+        with self._lock:
+            uses = dict(self._uses)
+        ranked = sorted(enumerate(experts), key=lambda item: (
+            item[1].name not in preferred, -uses.get(item[1].name, 0), item[0]))
+        return [expert for _, expert in ranked[:limit]]
+
+    def request(self, experts, model_name, limit=None, preferred=()):
+        """
+        提交预热（不等待完成）；最近已预热过时直接返回 False
+
+        limit: 最多预热几位专家（一般是每个问题回答的专家数），按 pick 的顺序选取；
+        None 时预热所有专家
+        """
+        if not PREWARM_ENABLED:
+            return False
+        if limit is not None:
+            experts = self.pick(experts, limit, preferred)
+        key = (model_name, tuple(sorted(expert.name for expert in experts)))
+        now = time.time()
+        with self._lock:
+            if now - self._started.get(key, 0) < self.ttl:
+                return False
+            self._started[key] = now
+        get_job_manager().run_coroutine(prewarm(experts, model_name))
+        return True
+
+
+# 创建全局预热器实例
+prewarmer = Prewarmer()
@@ -0,0 +1,146 @@
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+DEV_TOOLS = bool(st.secrets.get("DEV_TOOLS", False))  # 是否在侧边栏显示开发者工具
+PROFILE_DIR = st.secrets.get("PROFILE_DIR", ".profiles")
+SAMPLE_INTERVAL_SECONDS = 0.005
+TOP_FUNCTIONS = 20
+
+# 重点关注的函数（渲染、截断、配额显示和分词），在结果里单独列出
+FOCUS_FUNCTIONS = (
+    "display_chat_history",
+    "render_expert_bubble",
+    "truncate_text",
+    "get_quota_display",
+    "count_tokens",
+    "compute_token_offsets",
+    "encode",
+    "encode_ordinary",
+)
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """在后台线程按固定间隔采样指定线程的调用栈（墙钟时间，包括等待 I/O 的时间）"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # "外层;...;内层" -> 采样次数
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path):
+        """写出折叠栈格式，可以用 flamegraph.pl 或 speedscope 打开"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def function_times(self):
+        """按采样估算每个函数的自身耗时和累计耗时（毫秒）"""
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        ms = self.interval * 1000
+        return [
+            {"function": name, "calls": None,
+             "self_ms": round(self_counts[name] * ms, 1),
+             "total_ms": round(total * ms, 1)}
+            for name, total in total_counts.items()
+        ]
+
+
+def _cprofile_rows(profile):
+    stats = pstats.Stats(profile)
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{name} ({os.path.basename(filename)}:{line})",
+            "calls": calls,
+            "self_ms": round(tottime * 1000, 1),
+            "total_ms": round(cumtime * 1000, 1),
+        })
+    return rows
+
+
+def _is_focus(row):
+    return row["function"].split(" ", 1)[0] in FOCUS_FUNCTIONS
+
+
+@contextlib.contextmanager
+def profile_block(label, deterministic=True, thread_id=None):
+    """
+    分析 with 块内的运行，结束时把结果填入产出的字典
+
+    deterministic: 同时用 cProfile 统计调用次数和 CPU 时间（只覆盖当前线程）；
+    墙钟采样始终开启，覆盖 thread_id 指定的线程（默认当前线程）
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    result = {"label": label}
+    sampler = StackSampler(thread_id or threading.get_ident())
+    profile = cProfile.Profile() if deterministic else None
+
+    started = time.perf_counter()
+    sampler.start()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield result
+    finally:
+        if profile is not None:
+            profile.disable()
+        sampler.stop()
+        result["wall_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}")
+        sampler.write_folded(f"{path}.folded")
+        result["folded_path"] = f"{path}.folded"
+
+        if profile is not None:
+            profile.dump_stats(f"{path}.prof")
+            result["stats_path"] = f"{path}.prof"
+            rows = _cprofile_rows(profile)
+        else:
+            rows = sampler.function_times()
+        result["top"] = sorted(rows, key=lambda r: r["self_ms"],
+                               reverse=True)[:TOP_FUNCTIONS]
+        result["focus"] = sorted((r for r in rows if _is_focus(r)),
+                                 key=lambda r: r["total_ms"], reverse=True)
+        logger.info(f"性能分析 {label}: {result['wall_ms']} ms，"
+                    f"火焰图 {result['folded_path']}")
@@ -1,146 +1,215 @@
 import streamlit as st
 from datetime import datetime, timedelta
-import threading
 import logging
+from utils.models import MODEL_REGISTRY
+from utils.shared_state import get_backend
+from utils.admission import tpm_key
+from utils.circuit_breaker import get_breaker
+from utils.log import log_event
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
-# 配额锁，用于并发控制
-quota_lock = threading.Lock()
-
-# 定义每个模型的配额设置
+# 每个模型的配额设置（由模型注册表生成）
 MODEL_QUOTAS = {
-    "gemini-2.0-flash-exp": {
-        "limit_per_min": 10,  # 每分钟限制
-    },
-    "grok-beta": {
-        "limit_per_min": 60,
-    },
-    "gemini-1.5-flash": {
-        "limit_per_min": 10,
+    model_name: {
+        "limit_per_min": config["rpm"],  # 每分钟请求限制
+        "tokens_per_min": config["tpm"],  # 每分钟 token 限制
     }
+    for model_name, config in MODEL_REGISTRY.items()
 }
 
+WINDOW_SECONDS = 60
+SESSION_TOTALS_TTL = 24 * 3600  # 会话累计用量统计多久以内的请求
+
+
+def requests_key(model_name):
+    """共享状态中记录请求的键（所有会话/进程共用，与服务商的限制一致）"""
+    return f"quota:requests:{model_name}"
+
+
+def session_key(session_id, name):
+    """共享状态中按会话记账的键；session_id 为 "all" 时是所有会话的合计"""
+    return f"session:{session_id}:{name}"
+
 
 def get_default_quota(model_name):
     """获取默认的配额结构"""
     model_config = MODEL_QUOTAS[model_name]
     return {
         "limit": model_config["limit_per_min"],  # 每分钟的请求限制
-        "requests": []  # 存储请求时间戳列表
+        "token_limit": model_config["tokens_per_min"],  # 每分钟的 token 限制
     }
 
 
 def initialize_quota():
-    """初始化配额信息"""
+    """初始化配额信息（请求记录保存在共享状态后端，会话里只保留限制）"""
     if "quota_info" not in st.session_state:
         logger.info("初始化配额信息")
-        st.session_state.quota_info = {
-            model_name: get_default_quota(model_name)
-            for model_name in MODEL_QUOTAS
-        }
+        st.session_state.quota_info = {}
 
     # 确保所有模型都有正确的配额结构
     for model_name in MODEL_QUOTAS:
         if model_name not in st.session_state.quota_info:
-            logger.info(f"为模型 {model_name} 添加配额信息")
             st.session_state.quota_info[model_name] = get_default_quota(
                 model_name)
 
-        # 确保所有必要的字段都存在
-        quota = st.session_state.quota_info[model_name]
-        if "requests" not in quota:
-            logger.info(f"重置模型 {model_name} 的请求记录")
-            quota["requests"] = []
-        if "reset_time" not in quota:
-            quota["reset_time"] = None
 
-
-def clean_old_requests(requests, window_seconds=60):
-    """清理旧的请求记录"""
-    if not requests:  # 如果 requests 为 None 或空列表
-        return []
-    now = datetime.now()
-    cutoff = now - timedelta(seconds=window_seconds)
-    return [req for req in requests if req > cutoff]
+def get_request_times(model_name):
+    """获取一分钟内的请求时间列表"""
+    return [datetime.fromtimestamp(ts) for ts, _ in
+            get_backend().window(requests_key(model_name), WINDOW_SECONDS)]
 
 
 def get_current_rpm(model_name):
-    """获取当前每分钟请求数"""
-    initialize_quota()
-    quota = st.session_state.quota_info[model_name]
+    """获取当前每分钟请求数（一次对话的请求可能合并记录为一个事件）"""
+    return sum(weight for _, weight in
+               get_backend().window(requests_key(model_name), WINDOW_SECONDS))
+
 
-    with quota_lock:
-        # 清理旧请求
-        quota["requests"] = clean_old_requests(quota.get("requests", []))
-        return len(quota["requests"])
+def get_current_tpm(model_name):
+    """获取当前每分钟 token 数（来自 token 准入控制的预留记录）"""
+    return sum(weight for _, weight in
+               get_backend().window(tpm_key(model_name), WINDOW_SECONDS))
 
 
-def check_quota(model_name, required_quota=1):
+def check_quota(model_name, required_quota=1, required_tokens=0):
     """检查是否有足够的配额"""
-    initialize_quota()
-    quota = st.session_state.quota_info[model_name]
     model_config = MODEL_QUOTAS[model_name]
 
-    with quota_lock:
-        now = datetime.now()
+    current_requests = get_current_rpm(model_name)
+    available_requests = model_config["limit_per_min"] - current_requests
+    available_tokens = model_config["tokens_per_min"] - \
+        get_current_tpm(model_name)
 
-        # 清理旧请求并计算当前使用量
-        old_requests = len(quota["requests"])
-        quota["requests"] = clean_old_requests(quota.get("requests", []))
-        new_requests = len(quota["requests"])
+    logger.info(
+        f"配额检查 - 当前使用: {current_requests}, 需要: {required_quota}, 可用: {available_requests}")
 
-        if old_requests != new_requests:
-            logger.info(f"检查配额时清理了 {old_requests - new_requests} 个过期请求")
+    # 检查是否有足够的配额
+    has_enough = available_requests >= required_quota
+    if not has_enough:
+        logger.warning(
+            f"配额不足 - 需要 {required_quota} 个，但只剩 {available_requests} 个")
+    elif available_tokens < required_tokens:
+        has_enough = False
+        logger.warning(
+            f"token 配额不足 - 需要 {required_tokens}，但只剩 {available_tokens}")
 
-        current_requests = len(quota["requests"])
-        available_requests = model_config["limit_per_min"] - current_requests
+    return has_enough
 
-        logger.info(
-            f"配额检查 - 当前使用: {current_requests}, 需要: {required_quota}, 可用: {available_requests}")
 
-        # 检查是否有足够的配额
-        has_enough = available_requests >= required_quota
-        if not has_enough:
-            logger.warning(
-                f"配额不足 - 需要 {required_quota} 个，但只剩 {available_requests} 个")
+def use_quota(model_name):
+    """使用一个配额"""
+    return reserve_quota(model_name, 1)
 
-        return has_enough
 
+def reserve_quota(model_name, required_quota):
+    """原子地预留一次对话需要的全部请求数；不够时什么都不记录并返回 False"""
+    model_config = MODEL_QUOTAS[model_name]
 
-def use_quota(model_name):
-    """使用一个配额"""
-    initialize_quota()
-    quota = st.session_state.quota_info[model_name]
+    # 原子地检查并记录，多个会话/进程同时使用时不会超额
+    event_id = get_backend().try_add(
+        requests_key(model_name), required_quota, model_config["limit_per_min"],
+        WINDOW_SECONDS)
+    if event_id is None:
+        logger.warning(f"⚠️ 模型 {model_name} 达到每分钟请求限制!")
+        return False
+
+    logger.info(f"➕ 添加 {required_quota} 个请求，当前一分钟内总数: "
+                f"{get_current_rpm(model_name)}/{model_config['limit_per_min']}")
+    return True
+
+
+def available_quota(model_name):
+    """返回当前窗口内剩余的 (请求数, tokens)"""
     model_config = MODEL_QUOTAS[model_name]
+    return (model_config["limit_per_min"] - get_current_rpm(model_name),
+            model_config["tokens_per_min"] - get_current_tpm(model_name))
 
-    with quota_lock:
-        now = datetime.now()
 
-        # 清理一分钟前的请求
-        old_requests = len(quota["requests"])
-        quota["requests"] = clean_old_requests(quota.get("requests", []))
-        new_requests = len(quota["requests"])
+def _window_eta(events, limit, required, now):
+    """等窗口里的旧记录过期，直到剩余额度够 required，还需要多少秒"""
+    free = limit - sum(weight for _, weight in events)
+    if free >= required:
+        return 0
+    for ts, weight in sorted(events):
+        free += weight
+        if free >= required:
+            return max(0, ts + WINDOW_SECONDS - now)
+    return None  # 需要的比整个窗口的上限还多
 
-        if old_requests != new_requests:
-            logger.info(f"🧹 清理了 {old_requests - new_requests} 个过期请求")
 
-        # 检查当前一分钟内的请求数
-        current_requests = len(quota["requests"])
-        logger.info(
-            f"📊 当前一分钟内的请求数: {current_requests}/{model_config['limit_per_min']}")
+def quota_eta(model_name, required_quota=1, required_tokens=0):
+    """预计多少秒后有足够的请求数和 tokens（永远不够时返回 None）"""
+    model_config = MODEL_QUOTAS[model_name]
+    now = datetime.now().timestamp()
+    backend = get_backend()
+    etas = [
+        _window_eta(backend.window(requests_key(model_name), WINDOW_SECONDS),
+                    model_config["limit_per_min"], required_quota, now),
+        _window_eta(backend.window(tpm_key(model_name), WINDOW_SECONDS),
+                    model_config["tokens_per_min"], required_tokens, now),
+    ]
+    if None in etas:
+        return None
+    return max(etas)
+
+
+def record_session_usage(session_id, requests=1, tokens=0):
+    """
+    记录会话发出的模型请求（缓存命中和合并的请求不算），同时计入所有会话的合计
+
+    累计用量也记成事件（只追加，多个进程同时记录不会丢失），读取时按 SESSION_TOTALS_TTL 的窗口求和
+    """
+    backend = get_backend()
+    for owner in (session_id, "all"):
+        backend.add_event(session_key(owner, "requests"), requests)
+        if tokens:
+            backend.add_event(session_key(owner, "tokens"), tokens)
+    backend.add_event(session_key(session_id, "total_requests"), requests)
+    if tokens:
+        backend.add_event(session_key(session_id, "total_tokens"), tokens)
+
+
+def get_session_usage(session_id):
+    """会话最近一分钟的请求数和 tokens，以及累计用量"""
+    backend = get_backend()
+    return {
+        "rpm": sum(weight for _, weight in
+                   backend.window(session_key(session_id, "requests"), WINDOW_SECONDS)),
+        "tpm": sum(weight for _, weight in
+                   backend.window(session_key(session_id, "tokens"), WINDOW_SECONDS)),
+        "total_requests": int(sum(weight for _, weight in backend.window(
+            session_key(session_id, "total_requests"), SESSION_TOTALS_TTL))),
+        "total_tokens": int(sum(weight for _, weight in backend.window(
+            session_key(session_id, "total_tokens"), SESSION_TOTALS_TTL))),
+    }
 
-        # 检查是否超过每分钟限制
-        if current_requests >= model_config["limit_per_min"]:
-            logger.warning(f"⚠️ 模型 {model_name} 达到每分钟请求限制!")
-            return False
 
-        # 添加新请求
-        quota["requests"].append(now)
-        logger.info(f"➕ 添加新请求，当前一分钟内总数: {len(quota['requests'])}")
+def get_others_rpm(session_id):
+    """最近一分钟其他会话发出的请求数（为 0 时说明没有别人在用）"""
+    return (sum(weight for _, weight in
+                get_backend().window(session_key("all", "requests"), WINDOW_SECONDS))
+            - get_session_usage(session_id)["rpm"])
 
-        return True
+
+def session_quota_eta(session_id, limits, required_quota=1, required_tokens=0):
+    """
+    会话的预算还要多少秒才够用（0 表示现在就够）
+
+    limits: 会话每分钟的 (请求数, tokens) 上限；需要的超过上限时按上限计算，
+    即会话空闲时总能提一个问题
+    """
+    now = datetime.now().timestamp()
+    backend = get_backend()
+    request_limit, token_limit = limits
+    etas = [
+        _window_eta(backend.window(session_key(session_id, "requests"), WINDOW_SECONDS),
+                    request_limit, min(required_quota, request_limit), now),
+        _window_eta(backend.window(session_key(session_id, "tokens"), WINDOW_SECONDS),
+                    token_limit, min(required_tokens, token_limit), now),
+    ]
+    return max(eta or 0 for eta in etas)
 
 
 def calculate_conversation_quota(num_experts):
@@ -148,60 +217,60 @@ def calculate_conversation_quota(num_experts):
     return num_experts + 1
 
 
-def get_quota_display(model_name):
-    """获取配额显示信息"""
-    initialize_quota()
-    quota = st.session_state.quota_info[model_name]
+def get_quota_display(model_name, num_experts=None):
+    """获取配额显示信息（num_experts 为每个问题路由到的专家数）"""
     model_config = MODEL_QUOTAS[model_name]
 
     # 添加安全检查
     if "experts" not in st.session_state:
         st.session_state.experts = load_experts()
 
-    num_experts = len(st.session_state.experts)
+    if num_experts is None:
+        num_experts = len(st.session_state.experts)
     requests_per_conversation = calculate_conversation_quota(num_experts)
 
-    with quota_lock:
-        now = datetime.now()
-
-        # 清理过期请求
-        quota["requests"] = clean_old_requests(quota.get("requests", []))
-        current_requests = len(quota["requests"])
-        remaining_requests = model_config["limit_per_min"] - current_requests
-
-        # 计算可进行的对话次数
-        conversations = remaining_requests // requests_per_conversation
-        total_conversations = model_config["limit_per_min"] // requests_per_conversation
-
-        # 如果有请求记录，显示最早请求的重置时间
-        if quota["requests"]:
-            oldest_request = min(quota["requests"])
-            reset_time = oldest_request + timedelta(minutes=1)
-            time_left = max(0, int((reset_time - now).total_seconds()))
-            time_text = f"{time_left}秒后重置一个配额"
-        else:
-            time_text = "每分钟重置"
-
-        # 添加最早请求时间到返回值
-        oldest_request_time = min(
-            quota["requests"]) if quota["requests"] else None
-
-        logger.info(f"""
-🎯 配额状态更新:
-   模型: {model_name}
-   当前一分钟内使用: {current_requests}/{model_config['limit_per_min']}
-   剩余请求数: {remaining_requests}
-   可进行对话数: {conversations}/{total_conversations}
-   重置信息: {time_text}
-""")
-
-        return {
-            "remaining": conversations,
-            "limit": total_conversations,
-            "time_text": time_text,
-            "progress": conversations / total_conversations if total_conversations > 0 else 0,
-            "current_rpm": current_requests,
-            "requests_per_conversation": requests_per_conversation,  # 动态计算的请求数
-            "requests": quota["requests"],
-            "oldest_request_time": oldest_request_time
-        }
+    now = datetime.now()
+    requests = get_request_times(model_name)
+    current_requests = get_current_rpm(model_name)
+    remaining_requests = model_config["limit_per_min"] - current_requests
+    current_tpm = get_current_tpm(model_name)
+
+    # 计算可进行的对话次数
+    conversations = max(0, remaining_requests) // requests_per_conversation
+    total_conversations = model_config["limit_per_min"] // requests_per_conversation
+
+    # 如果有请求记录，显示最早请求的重置时间
+    if requests:
+        oldest_request = min(requests)
+        reset_time = oldest_request + timedelta(minutes=1)
+        time_left = max(0, int((reset_time - now).total_seconds()))
+        time_text = f"{time_left}秒后重置一个配额"
+    else:
+        time_text = "每分钟重置"
+
+    # 添加最早请求时间到返回值
+    oldest_request_time = min(requests) if requests else None
+
+    # 每次页面刷新都会调用，按采样率记录
+    log_event(logger, "quota_status",
+              model=model_name,
+              rpm=current_requests,
+              rpm_limit=model_config["limit_per_min"],
+              tpm=current_tpm,
+              tpm_limit=model_config["tokens_per_min"],
+              remaining_requests=remaining_requests,
+              conversations=f"{conversations}/{total_conversations}")
+
+    return {
+        "remaining": conversations,
+        "limit": total_conversations,
+        "time_text": time_text,
+        "progress": conversations / total_conversations if total_conversations > 0 else 0,
+        "current_rpm": current_requests,
+        "current_tpm": current_tpm,
+        "tpm_limit": model_config["tokens_per_min"],
+        "requests_per_conversation": requests_per_conversation,  # 动态计算的请求数
+        "requests": requests,
+        "oldest_request_time": oldest_request_time,
+        "health": get_breaker(model_name).health()
+    }
@@ -0,0 +1,44 @@
+import logging
+
+import streamlit as st
+
+from utils.expert_store import source_fingerprint
+from utils.vector_index import embed_texts, get_vector_index
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_TOP_K = int(st.secrets.get("RETRIEVAL_TOP_K", 64))  # 每位专家最多取回的片段数
+
+
+def search_expert(name, query_vector, k=RETRIEVAL_TOP_K):
+    """
+    在一位专家的向量索引里检索，返回 [(起始字节, 结束字节, 相似度)]，按相似度从高到低
+
+    索引按专家缓存，向量是 mmap 视图不复制到堆上；片段较多时只扫描最近的倒排簇
+    """
+    if source_fingerprint(name) is None:
+        return []
+    index = get_vector_index(name)
+    if not len(index.ids):
+        return []
+    bounds = index.chunk_bounds
+    return [(int(bounds[2 * row]), int(bounds[2 * row + 1]), score)
+            for row, score in index.search_vector(query_vector, k)]
+
+
+def retrieve(names, question, k=RETRIEVAL_TOP_K):
+    """
+    为一个问题检索路由选中的各位专家的资料，返回 {专家: [(起始字节, 结束字节, 相似度)]}
+
+    问题只嵌入一次；只打开选中的专家的索引，某位专家的资料变化时也只重建它自己的索引
+    """
+    if not names:
+        return {}
+    query_vector = embed_texts([question])[0]
+    results = {}
+    for name in names:
+        hits = search_expert(name, query_vector, k)
+        if hits:
+            results[name] = hits
+    return results
@@ -0,0 +1,107 @@
+import logging
+import math
+import re
+from collections import Counter
+
+from utils.expert_store import get_profile as load_profile
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+PROFILE_TERMS = 3000  # 每个专家关键词画像保留的词数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_LATIN_RE = re.compile(r"[a-z][a-z0-9']+")
+_CJK_RE = re.compile(r"[㐀-鿿]+")
+_STOPWORDS = {
+    "the", "and", "of", "to", "in", "is", "that", "it", "for", "as", "on",
+    "with", "was", "be", "are", "by", "this", "at", "or", "an", "from",
+    "我們", "我们", "你們", "你们", "他們", "他们", "一個", "一个", "這個",
+    "这个", "那個", "那个", "可以", "因為", "因为", "所以", "如果", "就是",
+}
+
+
+def tokenize_terms(text):
+    """拆分检索词：英文按单词，中文按相邻两字"""
+    text = text.lower()
+    terms = [w for w in _LATIN_RE.findall(text) if w not in _STOPWORDS]
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+            continue
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return [t for t in terms if t not in _STOPWORDS]
+
+
+def build_profile(text, max_terms=PROFILE_TERMS):
+    """从专家资料构建关键词画像（词频最高的 max_terms 个词）"""
+    counts = Counter(tokenize_terms(text))
+    return Counter(dict(counts.most_common(max_terms)))
+
+
+def get_profile(expert):
+    """获取专家的关键词画像（缓存在内存和专家目录的索引文件中）"""
+    return load_profile(expert.name, build_profile)
+
+
+class ExpertRouter:
+    """基于 BM25 的专家相关性打分，每个专家的关键词画像视为一篇文档"""
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.lengths = {name: sum(p.values()) for name, p in profiles.items()}
+        self.avg_length = (sum(self.lengths.values()) / len(profiles)
+                           if profiles else 0)
+        doc_freq = Counter()
+        for profile in profiles.values():
+            doc_freq.update(profile.keys())
+        n = len(profiles)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def score(self, question):
+        """计算问题与每个专家的相关性得分"""
+        terms = Counter(tokenize_terms(question))
+        scores = {}
+        for name, profile in self.profiles.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B *
+                              self.lengths[name] / (self.avg_length or 1))
+            score = 0.0
+            for term, query_count in terms.items():
+                tf = profile.get(term)
+                if not tf:
+                    continue
+                score += (self.idf[term] * tf * (BM25_K1 + 1) /
+                          (tf + norm) * query_count)
+            scores[name] = score
+        return scores
+
+
+def select_experts(experts, question, top_k, forced=None):
+    """
+    选出与问题最相关的 top_k 位专家
+
+    forced: 用户指定的专家名列表，非空时直接使用，不做路由
+    """
+    if forced:
+        selected = [e for e in experts if e.name in forced]
+        logger.info(f"使用用户指定的专家: {[e.name for e in selected]}")
+        return selected
+
+    if top_k is None or top_k >= len(experts):
+        return list(experts)
+
+    router = ExpertRouter({e.name: get_profile(e) for e in experts})
+    scores = router.score(question)
+
+    # 得分相同（例如都没有命中）时保持原有顺序
+    ranked = sorted(enumerate(experts),
+                    key=lambda item: (-scores.get(item[1].name, 0), item[0]))
+    selected = [expert for _, expert in ranked[:top_k]]
+
+    logger.info(f"专家路由: top_k={top_k}, 选中 {[e.name for e in selected]}, "
+                f"得分 {[round(scores.get(e.name, 0), 2) for e in selected]}")
+    return selected
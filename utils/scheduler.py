@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+
+from utils.models import get_model_config
+from utils.quota import (
+    get_others_rpm,
+    get_session_usage,
+    record_session_usage,
+    session_quota_eta
+)
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+SCHEDULER_SLOTS = int(st.secrets.get("SCHEDULER_SLOTS", 6))  # 同时进行的模型请求数
+SESSION_QUOTA_SHARE = float(st.secrets.get("SESSION_QUOTA_SHARE", 0.5))  # 有其他会话在用时，单个会话每分钟最多占模型配额的比例
+MIN_SESSION_WEIGHT = 0.1  # 会话预算用完后的排队权重
+ANONYMOUS_SESSION = "anonymous"  # 批量生成等没有会话的调用
+
+
+def session_limits(model_name):
+    """单个会话每分钟的 (请求数, tokens) 上限"""
+    config = get_model_config(model_name)
+    return (max(1, int(config["rpm"] * SESSION_QUOTA_SHARE)),
+            max(1, int(config["tpm"] * SESSION_QUOTA_SHARE)))
+
+
+def session_weight(session_id, model_name):
+    """
+    会话的排队权重：最近一分钟会话预算（session_limits）还剩的比例，请求数和 tokens 取较小者
+
+    预算用得越多，请求的虚拟完成时间推得越远；用完后权重为 MIN_SESSION_WEIGHT，仍然能排到
+    """
+    if session_id is None:
+        return 1.0
+    request_limit, token_limit = session_limits(model_name)
+    usage = get_session_usage(session_id)
+    remaining = min(1 - usage["rpm"] / request_limit, 1 - usage["tpm"] / token_limit)
+    return max(MIN_SESSION_WEIGHT, remaining)
+
+
+def fair_share_eta(session_id, model_name, required_quota, required_tokens):
+    """
+    会话还要等多少秒才能在公平份额内提这个问题（0 表示不用等）
+
+    最近一分钟没有其他会话发出请求时不限制，一个人使用时可以用满整个配额
+    """
+    if session_id is None or get_others_rpm(session_id) <= 0:
+        return 0
+    return session_quota_eta(session_id, session_limits(model_name),
+                             required_quota, required_tokens)
+
+
+class FairScheduler:
+    """
+    模型请求的加权公平排队：所有会话共用 SCHEDULER_SLOTS 个并发名额，空出名额时按虚拟完成时间分配
+
+    每个请求的虚拟完成时间 = max(当前虚拟时间, 本会话上一个请求的虚拟完成时间) + 预计 tokens / 权重，
+    权重由会话预算的剩余比例决定（session_weight）；
+    连续提问的会话排在后面，其他会话的请求可以插到前面，不会被一个会话的大量请求饿死
+
+    所有模型请求都在后台任务线程的同一个事件循环里执行，排队状态只在进程内；
+    侧边栏在页面线程读取统计，读写排队状态都持有 _lock（不跨 await）；
+    跨进程的用量和预算记在共享状态后端（utils.quota）
+    """
+
+    def __init__(self, slots=SCHEDULER_SLOTS):
+        self.slots = slots
+        self.running = Counter()  # 会话 -> 进行中的请求数
+        self.queued = Counter()  # 会话 -> 排队中的请求数
+        self.virtual_time = 0.0
+        self._finish = {}  # 会话 -> 最后一个请求的虚拟完成时间
+        self._heap = []  # (虚拟完成时间, 序号, 虚拟开始时间, 会话, future)
+        self._seq = itertools.count()
+        self._waits = {}  # 会话 -> (等待次数, 总等待秒数)
+        self._lock = threading.Lock()
+
+    def _start(self, session_id, start):
+        self.running[session_id] += 1
+        self.virtual_time = max(self.virtual_time, start)
+
+    async def acquire(self, session_id, tokens, weight=1.0):
+        """等到轮到这个请求并占用一个名额；之后必须调用 release（用量在请求成功后由 record_usage 记录）"""
+        session_id = session_id or ANONYMOUS_SESSION
+        with self._lock:
+            start = max(self.virtual_time, self._finish.get(session_id, 0.0))
+            finish = start + max(tokens, 1) / weight
+            self._finish[session_id] = finish
+
+            if sum(self.running.values()) < self.slots and not self._heap:
+                self._start(session_id, start)
+                return
+
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._heap, (finish, next(self._seq), start, session_id, future))
+            self.queued[session_id] += 1
+        queued_at = time.time()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(session_id)  # 名额已经交给这个请求
+            else:
+                with self._lock:
+                    # 没排到就取消的请求不占会话的虚拟时间，会话之后的请求不必为它多等
+                    self._finish[session_id] -= finish - start
+            raise
+        finally:
+            with self._lock:
+                self.queued[session_id] -= 1
+                count, total = self._waits.get(session_id, (0, 0.0))
+                self._waits[session_id] = (count + 1, total + time.time() - queued_at)
+
+    def release(self, session_id):
+        """请求结束，名额交给虚拟完成时间最早的排队请求"""
+        session_id = session_id or ANONYMOUS_SESSION
+        with self._lock:
+            self.running[session_id] -= 1
+            while self._heap:
+                _, _, start, waiting_session, future = heapq.heappop(self._heap)
+                if future.cancelled():
+                    continue
+                self._start(waiting_session, start)
+                future.set_result(None)
+                break
+            # 已经追上虚拟时间的会话不需要再记录
+            for idle in [s for s, finish in self._finish.items()
+                         if finish <= self.virtual_time and not self.running[s] and not self.queued[s]]:
+                del self._finish[idle]
+                self.running.pop(idle, None)
+                self.queued.pop(idle, None)
+
+    def record_usage(self, session_id, tokens):
+        """请求成功后记录一次会话用量（重试和失败的尝试不重复计入）"""
+        record_session_usage(session_id or ANONYMOUS_SESSION, 1, tokens)
+
+    def session_stats(self, session_id):
+        """会话的用量统计（用于侧边栏）；排队状态在锁内取快照，不和工作线程的修改交错"""
+        usage = get_session_usage(session_id)
+        with self._lock:
+            count, total = self._waits.get(session_id, (0, 0.0))
+            usage.update({
+                "running": self.running.get(session_id, 0),
+                "queued": self.queued.get(session_id, 0),
+                "avg_wait": total / count if count else 0.0,
+                "busy_slots": sum(self.running.values()),
+                "slots": self.slots,
+            })
+        return usage
+
+
+# 创建全局调度器实例
+scheduler = FairScheduler()
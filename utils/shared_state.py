@@ -0,0 +1,265 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import streamlit as st
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 共享状态后端："memory" 为单进程内共享，"sqlite" 供同一台机器上的多个进程共享
+STATE_BACKEND = st.secrets.get("STATE_BACKEND", "memory")
+STATE_DB_PATH = st.secrets.get("STATE_DB_PATH", ".state/shared_state.db")
+SWEEP_INTERVAL_SECONDS = 60  # 内存后端写入时每隔多久清理一次过期的事件和缓存
+EVENT_RETENTION_SECONDS = 24 * 3600  # 从没按窗口读取过的键，事件最多保留多久
+
+
+class MemoryBackend:
+    """进程内共享状态（默认，单进程部署）"""
+
+    def __init__(self):
+        self._events = {}  # key -> {event_id: [ts, weight]}
+        self._windows = {}  # key -> 读取时用过的最大窗口，写入和清理时按它删除过期事件
+        self._slots = {}
+        self._cache = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def _prune(self, key, window_seconds, now):
+        self._windows[key] = max(window_seconds, self._windows.get(key, 0))
+        cutoff = now - window_seconds
+        events = self._events.setdefault(key, {})
+        for event_id in [i for i, (ts, _) in events.items() if ts <= cutoff]:
+            del events[event_id]
+        return events
+
+    def _sweep(self, now):
+        """
+        定期清理整个后端：删除各键窗口外的事件、没有事件的键和过期的缓存
+
+        结束的会话、空闲的熔断器和回应缓存的键之后不会再被读取，只在读取时清理会一直留在内存里
+        """
+        if now - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return
+        self._last_sweep = now
+        for key in list(self._events):
+            cutoff = now - self._windows.get(key, EVENT_RETENTION_SECONDS)
+            events = self._events[key]
+            for event_id in [i for i, (ts, _) in events.items() if ts <= cutoff]:
+                del events[event_id]
+            if not events:
+                del self._events[key]
+                self._windows.pop(key, None)
+        for key in [k for k, (_, expires) in self._cache.items() if expires < now]:
+            del self._cache[key]
+
+    def window(self, key, window_seconds):
+        """窗口内的事件 [(时间戳, 权重)]，按时间排序"""
+        with self._lock:
+            events = self._prune(key, window_seconds, time.time())
+            return sorted((ts, weight) for ts, weight in events.values())
+
+    def add_event(self, key, weight=1, ts=None):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            if key in self._windows:
+                self._prune(key, self._windows[key], now)
+            event_id = next(self._ids)
+            self._events.setdefault(key, {})[event_id] = [ts or now, weight]
+            return event_id
+
+    def try_add(self, key, weight, limit, window_seconds):
+        """窗口内总权重加上 weight 不超过 limit 时记录事件并返回 ID，否则返回 None"""
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            events = self._prune(key, window_seconds, now)
+            if sum(w for _, w in events.values()) + weight > limit:
+                return None
+            event_id = next(self._ids)
+            events[event_id] = [now, weight]
+            return event_id
+
+    def update_event(self, key, event_id, weight):
+        with self._lock:
+            event = self._events.get(key, {}).get(event_id)
+            if event is not None:
+                event[1] = weight
+
+    def remove_event(self, key, event_id):
+        with self._lock:
+            self._events.get(key, {}).pop(event_id, None)
+
+    def reserve_interval(self, key, interval):
+        """预约下一个间隔为 interval 秒的时间槽，返回需要等待的秒数"""
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._slots.get(key, 0))
+            self._slots[key] = slot + interval
+            return slot - now
+
+    def cache_get(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None or item[1] < time.time():
+                self._cache.pop(key, None)
+                return None
+            return item[0]
+
+    def cache_set(self, key, value, ttl):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            self._cache[key] = (value, now + ttl)
+
+
+class SQLiteBackend:
+    """基于 SQLite 文件的共享状态，同一台机器上的多个 Streamlit/工作进程共用"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL, ts REAL NOT NULL, weight REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS events_key_ts ON events (key, ts);
+            CREATE TABLE IF NOT EXISTS slots (
+                key TEXT PRIMARY KEY, next_ts REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL);
+        """)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _prune(self, db, key, window_seconds, now):
+        db.execute("DELETE FROM events WHERE key = ? AND ts <= ?",
+                   (key, now - window_seconds))
+
+    def window(self, key, window_seconds):
+        with self._transaction() as db:
+            self._prune(db, key, window_seconds, time.time())
+            return db.execute(
+                "SELECT ts, weight FROM events WHERE key = ? ORDER BY ts",
+                (key,)).fetchall()
+
+    def add_event(self, key, weight=1, ts=None):
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT INTO events (key, ts, weight) VALUES (?, ?, ?)",
+                (key, ts or time.time(), weight))
+            return cursor.lastrowid
+
+    def try_add(self, key, weight, limit, window_seconds):
+        with self._transaction() as db:
+            now = time.time()
+            self._prune(db, key, window_seconds, now)
+            used = db.execute(
+                "SELECT COALESCE(SUM(weight), 0) FROM events WHERE key = ?",
+                (key,)).fetchone()[0]
+            if used + weight > limit:
+                return None
+            return db.execute(
+                "INSERT INTO events (key, ts, weight) VALUES (?, ?, ?)",
+                (key, now, weight)).lastrowid
+
+    def update_event(self, key, event_id, weight):
+        with self._transaction() as db:
+            db.execute("UPDATE events SET weight = ? WHERE id = ?",
+                       (weight, event_id))
+
+    def remove_event(self, key, event_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def reserve_interval(self, key, interval):
+        with self._transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT next_ts FROM slots WHERE key = ?",
+                             (key,)).fetchone()
+            slot = max(now, row[0] if row else 0)
+            db.execute("INSERT OR REPLACE INTO slots (key, next_ts) VALUES (?, ?)",
+                       (key, slot + interval))
+            return slot - now
+
+    def cache_get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def cache_set(self, key, value, ttl):
+        with self._transaction() as db:
+            db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+            db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), time.time() + ttl))
+
+
+# 可插拔的后端工厂，其他后端（例如 Redis）可以通过 register_backend 注册
+BACKENDS = {
+    "memory": lambda: MemoryBackend(),
+    "sqlite": lambda: SQLiteBackend(STATE_DB_PATH),
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def register_backend(name, factory):
+    """注册共享状态后端"""
+    BACKENDS[name] = factory
+
+
+def get_backend():
+    """获取配置的共享状态后端（首次调用时创建）"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = BACKENDS[STATE_BACKEND]()
+            logger.info(f"共享状态后端: {STATE_BACKEND}")
+        return _backend
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """跨进程文件锁（例如多个进程同时构建同一个专家的索引）"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        try:
+            import fcntl
+        except ImportError:  # Windows 上退化为不加锁
+            yield
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
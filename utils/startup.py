@@ -0,0 +1,81 @@
+import argparse
+import logging
+import subprocess
+import sys
+import time
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 以本模块首次导入的时间作为启动起点（app.py 第一行导入）
+_START = time.perf_counter()
+_marks = []
+_finished = False
+
+
+def mark(name):
+    """记录冷启动阶段的时间点（毫秒，相对于启动起点）；finish 之后不再记录"""
+    if _finished:
+        return
+    elapsed_ms = (time.perf_counter() - _START) * 1000
+    _marks.append((name, elapsed_ms))
+    logger.info(f"启动阶段 {name}: {elapsed_ms:.0f} ms")
+
+
+def finish():
+    """冷启动结束（首次页面渲染完成），输出各阶段汇总"""
+    global _finished
+    if _finished:
+        return
+    _finished = True
+    logger.info("启动耗时: " + ", ".join(
+        f"{name}={elapsed_ms:.0f}ms" for name, elapsed_ms in _marks))
+
+
+def get_marks():
+    """已记录的启动阶段 [(名称, 毫秒)]"""
+    return list(_marks)
+
+
+def importtime_report(module="app", top=20):
+    """
+    用 python -X importtime 在子进程中导入 module，返回累计耗时最多的模块
+
+    返回 [(模块名, 自身微秒, 累计微秒)]，按累计耗时降序
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.warning(f"导入 {module} 失败: {result.stderr.splitlines()[-1:]}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:  # 表头
+            continue
+        rows.append((parts[2].strip(), self_us, cumulative_us))
+
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:top]
+
+
+if __name__ == "__main__":
+    # 用法: python -m utils.startup [模块 ...] [--top N]
+    parser = argparse.ArgumentParser(description="启动导入耗时报告")
+    parser.add_argument("modules", nargs="*",
+                        default=["utils.expert", "utils.document_loader", "app"])
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        print(f"\n== import {module} ==")
+        print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+        for name, self_us, cumulative_us in importtime_report(module, args.top):
+            print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
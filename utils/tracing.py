@@ -0,0 +1,273 @@
+import argparse
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+
+import streamlit as st
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 导出方式："file" 写 JSONL 文件，"otlp" 以 OTLP/HTTP JSON 发给采集器，"none" 不导出
+TRACE_EXPORTER = st.secrets.get("TRACE_EXPORTER", "file")
+TRACE_FILE = st.secrets.get("TRACE_FILE", ".traces/spans.jsonl")
+OTLP_ENDPOINT = st.secrets.get("OTLP_ENDPOINT", "http://localhost:4318")
+SERVICE_NAME = "investment-titans-chat"
+EXPORT_INTERVAL_SECONDS = 2
+EXPORT_BATCH_SIZE = 100
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """一段计时的操作，同一个问题的所有 span 共用一个 trace_id"""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    @property
+    def duration_ms(self):
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        """记录一个时间点（例如首个 token 到达）"""
+        self.events.append({"name": name, "time_ns": time.time_ns(),
+                            "attributes": attributes})
+
+    def record_error(self, error):
+        self.status = "error"
+        self.attributes["error"] = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        get_exporter().export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name, parent=None, **attributes):
+    """
+    开始一个 span 但不设为当前 span，需要手动 end()
+
+    用于跨线程的 span（例如在页面线程开始、在后台任务结束后才结束的问题 trace）
+    """
+    return Span(name, parent or current_span(), attributes)
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """在 with 块内把新 span 设为当前 span，异常会记录在 span 上"""
+    new_span = start_span(name, parent, **attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+class BatchExporter:
+    """在后台线程批量导出已结束的 span，不占用请求路径"""
+
+    def __init__(self, write_batch):
+        self.write_batch = write_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def export(self, finished_span):
+        self._queue.put(finished_span.to_dict())
+
+    def _drain(self):
+        batch = []
+        while len(batch) < EXPORT_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                logger.warning(f"导出 {len(batch)} 个 span 失败: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(EXPORT_INTERVAL_SECONDS)
+            self.flush()
+
+
+def write_jsonl(path):
+    """把 span 逐行追加到 JSONL 文件"""
+    def write_batch(batch):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for item in batch:
+                f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+    return write_batch
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)}
+            for key, value in attributes.items()]
+
+
+def to_otlp(batch):
+    """转换成 OTLP/HTTP JSON 格式（ExportTraceServiceRequest）"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+        "scopeSpans": [{
+            "scope": {"name": __name__},
+            "spans": [{
+                "traceId": item["trace_id"],
+                "spanId": item["span_id"],
+                "parentSpanId": item["parent_id"] or "",
+                "name": item["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(item["start_ns"]),
+                "endTimeUnixNano": str(item["end_ns"]),
+                "attributes": _otlp_attributes(item["attributes"]),
+                "events": [{
+                    "name": event["name"],
+                    "timeUnixNano": str(event["time_ns"]),
+                    "attributes": _otlp_attributes(event["attributes"]),
+                } for event in item["events"]],
+                "status": {"code": 2 if item["status"] == "error" else 1},
+            } for item in batch],
+        }],
+    }]}
+
+
+def post_otlp(endpoint):
+    """把 span 发给 OTLP/HTTP 采集器（例如本地的 otel-collector 或 Jaeger）"""
+    def write_batch(batch):
+        import requests
+        response = requests.post(f"{endpoint.rstrip('/')}/v1/traces",
+                                 json=to_otlp(batch), timeout=5)
+        response.raise_for_status()
+    return write_batch
+
+
+class NoopExporter:
+    def export(self, finished_span):
+        pass
+
+
+# 可插拔的导出方式
+EXPORTERS = {
+    "file": lambda: BatchExporter(write_jsonl(TRACE_FILE)),
+    "otlp": lambda: BatchExporter(post_otlp(OTLP_ENDPOINT)),
+    "none": lambda: NoopExporter(),
+}
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    """获取配置的导出器（首次调用时创建）"""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = EXPORTERS[TRACE_EXPORTER]()
+        return _exporter
+
+
+def print_traces(path, last=5):
+    """按 trace 打印 span 树和耗时，用来查看一个问题的时间花在哪里"""
+    with open(path, "r", encoding="utf-8") as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+
+    traces = {}
+    for item in spans:
+        traces.setdefault(item["trace_id"], []).append(item)
+
+    for trace_id in list(traces)[-last:]:
+        items = traces[trace_id]
+        children = {}
+        for item in items:
+            children.setdefault(item["parent_id"], []).append(item)
+        ids = {item["span_id"] for item in items}
+        roots = [item for item in items if item["parent_id"] not in ids]
+        trace_start = min(item["start_ns"] for item in items)
+
+        print(f"\ntrace {trace_id}")
+
+        def show(item, depth):
+            offset_ms = (item["start_ns"] - trace_start) / 1e6
+            attrs = " ".join(f"{k}={v}" for k, v in item["attributes"].items())
+            print(f"{offset_ms:>9.0f}ms {item['duration_ms']:>9.0f}ms  "
+                  f"{'  ' * depth}{item['name']} {attrs}".rstrip())
+            for child in sorted(children.get(item["span_id"], []),
+                                key=lambda c: c["start_ns"]):
+                show(child, depth + 1)
+
+        for root in sorted(roots, key=lambda r: r["start_ns"]):
+            show(root, 0)
+
+
+if __name__ == "__main__":
+    # 用法: python -m utils.tracing [spans.jsonl] [--last N]
+    parser = argparse.ArgumentParser(description="查看问题的 trace")
+    parser.add_argument("path", nargs="?", default=TRACE_FILE)
+    parser.add_argument("--last", type=int, default=5)
+    args = parser.parse_args()
+    print_traces(args.path, args.last)
@@ -0,0 +1,284 @@
+import json
+import logging
+import math
+import os
+import re
+import zlib
+from collections import Counter
+
+import streamlit as st
+
+from utils.expert_store import background_cache, index_dir, source_fingerprint
+from utils.shared_state import file_lock
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 磁盘格式（都在 data/<专家>/.index/ 下，.npy 文件用 mmap 打开）：
+#   vectors.npy        float32 [片段数, 维度]，每行是一个片段的单位向量，行号与 chunks.jsonl 一致
+#   ivf_centroids.npy  float32 [簇数, 维度]，片段较多时的倒排簇中心
+#   ivf_lists.npy      int32 按簇排好的行号
+#   ivf_offsets.npy    int64 [簇数 + 1]，第 i 个簇在 ivf_lists 中的范围
+#   vectors.json       清单：资料指纹、嵌入方式、维度、片段 ID
+VECTORS_FILE = "vectors.npy"
+CENTROIDS_FILE = "ivf_centroids.npy"
+LISTS_FILE = "ivf_lists.npy"
+OFFSETS_FILE = "ivf_offsets.npy"
+VECTOR_MANIFEST_FILE = "vectors.json"
+
+EMBEDDER = st.secrets.get("EMBEDDER", "hashed")
+VECTOR_DIM = int(st.secrets.get("VECTOR_DIM", 512))
+EMBED_BATCH_SIZE = 256
+IVF_MIN_CHUNKS = int(st.secrets.get("IVF_MIN_CHUNKS", 20000))  # 片段数超过这个值才建倒排簇，否则直接全量点积
+IVF_PROBES = 8  # 查询时扫描的簇数
+KMEANS_ITERATIONS = 10
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RUN_RE = re.compile(r"[㐀-鿿豈-﫿]+")
+
+
+def _features(text):
+    """英文取单词和相邻词对，中文取单字和相邻字对"""
+    text = text.lower()
+    words = _WORD_RE.findall(text)
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for run in _CJK_RUN_RE.findall(text):
+        features.extend(run)
+        features.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return features
+
+
+def hashed_embed(texts, dim=VECTOR_DIM):
+    """
+    把文本哈希成稀疏 n-gram 计数再投影到 dim 维，返回 L2 归一化的 float32 矩阵
+
+    用 crc32 而不是 hash()，保证不同进程、不同次启动得到相同的向量
+    """
+    import numpy as np  # numpy 较重，建索引或检索时才导入，启动时不加载
+    rows, cols, values = [], [], []
+    for row, text in enumerate(texts):
+        for feature, count in Counter(_features(text)).items():
+            h = zlib.crc32(feature.encode("utf-8"))
+            rows.append(row)
+            cols.append(h % dim)
+            values.append((1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(count)))
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)),
+              np.array(values, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+# 嵌入方式 -> 函数（接收文本列表和维度，返回归一化的 float32 矩阵），
+# 可以通过 register_embedder 接入本地的小模型
+EMBEDDERS = {
+    "hashed": hashed_embed,
+}
+
+
+def register_embedder(name, embed):
+    """注册嵌入函数"""
+    EMBEDDERS[name] = embed
+
+
+def embed_texts(texts, embedder=EMBEDDER, dim=VECTOR_DIM):
+    return EMBEDDERS[embedder](texts, dim)
+
+
+def _path(name, filename):
+    return os.path.join(index_dir(name), filename)
+
+
+def _write_atomic(name, filename, write):
+    path = _path(name, filename)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _save_npy(name, filename, array):
+    import numpy as np
+    _write_atomic(name, filename, lambda f: np.save(f, array))
+
+
+def load_vector_manifest(name):
+    """读取向量索引清单，嵌入方式或维度变了视为不存在"""
+    try:
+        with open(_path(name, VECTOR_MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("embedder") != EMBEDDER or manifest.get("dim") != VECTOR_DIM:
+        return None
+    return manifest
+
+
+def _kmeans(vectors, clusters, iterations=KMEANS_ITERATIONS):
+    """球面 k-means（向量已归一化，用点积作相似度）"""
+    import numpy as np
+    rng = np.random.default_rng(0)
+    centroids = np.array(vectors[rng.choice(len(vectors), clusters, replace=False)])
+    for _ in range(iterations):
+        assignments = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # 空簇保留原来的中心
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    return centroids.astype(np.float32)
+
+
+def _assign(vectors, centroids, batch_size=65536):
+    import numpy as np
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start:start + batch_size]
+        assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def _build_ivf(name, vectors, manifest):
+    """片段数较多时建倒排簇；规模变化不大时沿用旧的簇中心，只重新分配"""
+    import numpy as np
+    previous = manifest.get("ivf") if manifest else None
+    if len(vectors) < IVF_MIN_CHUNKS:
+        for filename in (CENTROIDS_FILE, LISTS_FILE, OFFSETS_FILE):
+            if os.path.exists(_path(name, filename)):
+                os.remove(_path(name, filename))
+        return None
+
+    if previous and previous["trained_on"] * 2 >= len(vectors):
+        centroids = np.load(_path(name, CENTROIDS_FILE))
+        trained_on = previous["trained_on"]
+    else:
+        centroids = _kmeans(vectors, int(math.sqrt(len(vectors))))
+        trained_on = len(vectors)
+    assignments = _assign(vectors, centroids)
+    lists = np.argsort(assignments, kind="stable").astype(np.int32)
+    offsets = np.searchsorted(assignments[lists], np.arange(len(centroids) + 1))
+    _save_npy(name, CENTROIDS_FILE, centroids)
+    _save_npy(name, LISTS_FILE, lists)
+    _save_npy(name, OFFSETS_FILE, offsets.astype(np.int64))
+    return {"clusters": len(centroids), "trained_on": trained_on}
+
+
+def build_vector_index(name, data, chunks):
+    """
+    为专家语料的片段建向量索引（data 为语料字节，chunks 为分块结果）
+
+    片段 ID 由内容决定，资料文件变化后只嵌入新增或改动的片段，其余沿用旧向量
+    """
+    import numpy as np
+    manifest = load_vector_manifest(name)
+    ids = [chunk["id"] for chunk in chunks]
+    previous = {}
+    if manifest is not None:
+        previous = {chunk_id: row for row, chunk_id in enumerate(manifest["ids"])}
+        old_vectors = np.load(_path(name, VECTORS_FILE), mmap_mode="r")
+
+    vectors = np.zeros((len(ids), VECTOR_DIM), dtype=np.float32)
+    pending = []
+    for row, chunk_id in enumerate(ids):
+        if chunk_id in previous:
+            vectors[row] = old_vectors[previous[chunk_id]]
+        else:
+            pending.append(row)
+
+    for start in range(0, len(pending), EMBED_BATCH_SIZE):
+        rows = pending[start:start + EMBED_BATCH_SIZE]
+        texts = [data[chunks[row]["start"]:chunks[row]["end"]].decode("utf-8", errors="ignore")
+                 for row in rows]
+        vectors[rows] = embed_texts(texts)
+
+    _save_npy(name, VECTORS_FILE, vectors)
+    new_manifest = {
+        "source": source_fingerprint(name),
+        "embedder": EMBEDDER,
+        "dim": VECTOR_DIM,
+        "ids": ids,
+        "ivf": _build_ivf(name, vectors, manifest),
+    }
+    # 清单最后写入且整体替换：读到新清单时向量和倒排簇文件都已就绪，中途失败则保留旧清单
+    _write_atomic(name, VECTOR_MANIFEST_FILE,
+                  lambda f: f.write(json.dumps(new_manifest).encode("utf-8")))
+    logger.info(f"构建专家 {name} 的向量索引，{len(ids)} 个片段，"
+                f"新嵌入 {len(pending)} 个")
+    return new_manifest
+
+
+class VectorIndex:
+    """通过 mmap 打开的专家向量索引"""
+
+    def __init__(self, name, chunk_bounds=None):
+        import numpy as np
+        self.name = name
+        self.chunk_bounds = chunk_bounds  # 语料的片段字节范围（mmap 视图），第 i 行向量对应第 i 个片段
+        manifest = load_vector_manifest(name)
+        self.source = manifest["source"]
+        self.ids = manifest["ids"]
+        self.vectors = np.load(_path(name, VECTORS_FILE), mmap_mode="r")
+        self.centroids = self.lists = self.offsets = None
+        if manifest["ivf"]:
+            self.centroids = np.load(_path(name, CENTROIDS_FILE))
+            self.lists = np.load(_path(name, LISTS_FILE), mmap_mode="r")
+            self.offsets = np.load(_path(name, OFFSETS_FILE))
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (self.lists.nbytes if self.lists is not None else 0)
+
+    def candidates(self, query_vector, probes=IVF_PROBES):
+        """候选行号：有倒排簇时只取最近的 probes 个簇，否则返回 None 表示全部"""
+        import numpy as np
+        if self.centroids is None:
+            return None
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(-(self.centroids @ query_vector), probes - 1)[:probes]
+        return np.concatenate([self.lists[self.offsets[c]:self.offsets[c + 1]]
+                               for c in nearest])
+
+    def search_vector(self, query_vector, k=8, probes=IVF_PROBES):
+        """返回 [(片段行号, 相似度)]，按相似度从高到低"""
+        import numpy as np
+        rows = self.candidates(query_vector, probes)
+        scores = (self.vectors if rows is None else self.vectors[rows]) @ query_vector
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if rows is not None:
+            return [(int(rows[i]), float(scores[i])) for i in top]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def search(self, query, k=8):
+        return self.search_vector(embed_texts([query])[0], k)
+
+
+def open_vector_index(name):
+    """打开专家向量索引（必要时先构建语料和索引）"""
+    from utils.corpus import open_corpus  # corpus 构建时会调用本模块
+
+    def stale():
+        manifest = load_vector_manifest(name)
+        return manifest is None or manifest["source"] != source_fingerprint(name)
+
+    corpus = open_corpus(name)
+    if stale():
+        with file_lock(_path(name, ".lock")):
+            if stale():  # 拿到锁之前可能已被其他进程建好
+                build_vector_index(name, corpus.data, corpus.chunk_records())
+    return VectorIndex(name, corpus.chunk_bounds)
+
+
+def get_vector_index(name):
+    """获取专家向量索引（由 LRU 缓存管理，资料文件变化后重新打开）"""
+    key = (name, "vectors")
+    index = background_cache.get_or_load(key, lambda: open_vector_index(name),
+                                         lambda index: index.nbytes)
+    if index.source != source_fingerprint(name):
+        index = open_vector_index(name)
+        background_cache.put(key, index, index.nbytes)
+    return index